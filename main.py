@@ -6,49 +6,73 @@
 # @File     :   main.py
 # @Desc     :   
 
-from numpy import random as np_random
+import sys
+from argparse import ArgumentParser
+from contextlib import nullcontext, redirect_stdout
+from functools import partial
+from itertools import chain
+from numpy import ndarray, arange, broadcast_to, concatenate, zeros, int32, random as np_random
+from os import replace
+from pandas import DataFrame
+from pathlib import Path
 from random import randint
-from torch import optim, nn
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from torch import optim, nn, load
 from tqdm import tqdm
+from typing import TYPE_CHECKING, Sequence
 
+from utils.archive import pack_corpus
+from utils.cache import TokenCache, PredictionCache
+from utils.checkpoint import CheckpointWriter
+from utils.compiled import compile_model as compile_torchscript
 from utils.config import CONFIG
+from utils.distributed import TorchDistributed
 from utils.helper import load_text_data_in_dir, save_json
-from utils.models import RNNClassificationTorchModel
-from utils.nlp import spacy_tokeniser, regular_english, count_frequency
-from utils.PT import SeqClassificationTorchDataset, TorchDataLoader, TorchRandomSeed
+from utils.predictor import RNNClassificationTorchPredictor
+from utils.server import SentimentServer
+from utils.PT import (SeqClassificationTorchDataset, TorchDataLoader, TorchRandomSeed, TorchCPUProfile,
+                      BucketBatchSampler)
 from utils.stats import split_data
-from utils.trainer import RNNClassificationTorchTrainer
+from utils.store import RaggedArray
+from utils.subword import SubwordTokeniser
+from utils.vocab import Vocabulary, FrequencyStore
 
+if TYPE_CHECKING:
+    from utils.nlp import SpacyTokeniser, SpacyTokeniserPool
 
-def tokenize_texts(texts: list[str]) -> list[list[str]]:
-    """ Tokenize a list of texts using spaCy
-    :param texts: list of texts to tokenize
-    :return: list of tokenized texts
+
+def build_tokeniser(
+        workers: int = CONFIG.PREPROCESSOR.TOKENISER_WORKERS
+) -> "SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser":
+    """ Build the configured tokeniser, spaCy using a process pool if more than one worker is requested, or subword
+    :param workers: number of spaCy worker processes, the subword tokeniser uses its own native threads
+    :return: the tokeniser
     """
-    new: list[list[str]] = []
-    for text in tqdm(texts, total=len(texts), desc="Tokenizing texts"):
-        words = spacy_tokeniser(text, "en")
-        words = regular_english(words)
-        new.append(words)
-    return new
+    if CONFIG.PREPROCESSOR.TOKENISER_BACKEND == "subword":
+        return SubwordTokeniser(CONFIG.FILEPATHS.SUBWORD_TOKENISER, batch_size=CONFIG.PREPROCESSOR.TOKENISER_BATCH_SIZE)
+    # spaCy is only imported for its backend, the subword backend predicts and serves without it
+    from utils.nlp import SpacyTokeniser, SpacyTokeniserPool
+
+    if workers > 1:
+        return SpacyTokeniserPool(
+            "en",
+            workers=workers,
+            chunk_size=CONFIG.PREPROCESSOR.TOKENISER_CHUNK_SIZE,
+            batch_size=CONFIG.PREPROCESSOR.TOKENISER_BATCH_SIZE
+        )
+    return SpacyTokeniser("en", batch_size=CONFIG.PREPROCESSOR.TOKENISER_BATCH_SIZE)
 
 
-def build_word2id_seqs(contents: list[list[str]], dictionary: dict[str, int]) -> list[list[int]]:
-    """ Build word2id sequences from contents using the provided dictionary
-    :param contents: list of texts to convert
-    :param dictionary: word2id mapping dictionary
-    :return: list of word2id sequences
-    """
-    sequences: list[list[int]] = []
-    for content in contents:
-        sequence: list[int] = []
-        for word in content:
-            if word in dictionary:
-                sequence.append(dictionary[word])
-            else:
-                sequence.append(dictionary["<UNK>"])
-        sequences.append(sequence)
-    return sequences
+def build_token_cache(tokeniser: "SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser") -> TokenCache | nullcontext:
+    """ Build the token cache for the tokeniser config, or an empty context if caching is disabled
+    :param tokeniser: the tokeniser whose outputs are cached
+    :return: the token cache
+    """
+    # Subword encoding is cheaper than a cache lookup
+    if not CONFIG.PREPROCESSOR.IS_TOKEN_CACHED or isinstance(tokeniser, SubwordTokeniser):
+        return nullcontext()
+    return TokenCache(CONFIG.FILEPATHS.TOKEN_CACHE, {**tokeniser.config, "filter": "regular_english"})
 
 
 def check_seq_coverage(dictionary: dict, test_seqs: list) -> float:
@@ -67,69 +91,219 @@ def check_seq_coverage(dictionary: dict, test_seqs: list) -> float:
     return coverage
 
 
-def preprocess_data():
-    """ Data Preprocessing Function """
-    # Load dataset
-    train = load_text_data_in_dir(CONFIG.FILEPATHS.DATASET_TRAIN)
-    test = load_text_data_in_dir(CONFIG.FILEPATHS.DATASET_TEST)
-    index = randint(0, len(train["ids"]) - 1)
-    # print(f"Train | ID: {train["ids"][index]}, Rate: {train["ratings"][index]}, Label: {train["labels"][index]}")
-    # print(f"Test  | ID: {test["ids"][index]}, Rate: {test["ratings"][index]}, Label: {test["labels"][index]}")
-    # print(f"Train | Labels: {train["labels"][12495:12505]}")
-    # print(f"Test  | Labels: {test["labels"][12495:12505]}")
+def encode_words(
+        splits: list[tuple[Sequence[str], list[str], bool | ndarray]], token_spool: str | Path, id_store: str | Path,
+        rank: int = 0
+) -> tuple[RaggedArray, Vocabulary]:
+    """ Tokenise the texts with spaCy, build or grow the word vocabulary from their frequencies and encode them
+    :param splits: the texts, their file paths and which of them are counted, per split in store order
+    :param token_spool: the path prefix of the token spool
+    :param id_store: the path prefix of the encoded id store
+    :param rank: the rank of this process, only rank 0 saves the pending frequency store
+    :return: the id store of all texts and the vocabulary
+    """
+    from utils.nlp import count_frequency
+    from utils.pipeline import stream_tokens, stream_digested_tokens, TokenSpool, encode_spool
+
+    # Only the documents missing from the frequency store are counted, so adding reviews does not recount the corpus.
+    # They are keyed by the digest of their content hashed for the token cache, a moved review is not recounted
+    is_incremental: bool = CONFIG.PREPROCESSOR.IS_VOCAB_INCREMENTAL
+    frequencies = FrequencyStore.load(CONFIG.FILEPATHS.FREQUENCY_STORE) if is_incremental else FrequencyStore()
+    counted: list[str] = []
+
+    # Pass 1: tokenize, filter and count the texts, spooling the tokens to disk
+    with (
+        build_tokeniser() as tokeniser,
+        build_token_cache(tokeniser) as cache,
+        TokenSpool(token_spool) as spool
+    ):
+        config: dict = tokeniser.config
+        for texts, paths, is_selected in splits:
+            if is_incremental:
+                documents = stream_digested_tokens(
+                    texts, tokeniser, cache, paths, CONFIG.PREPROCESSOR.PIPELINE_CHUNK_SIZE
+                )
+                documents = tqdm(documents, total=len(paths), desc="Tokenizing texts")
+                counted.extend(spool.extend_unseen(documents, frequencies, is_selected))
+            else:
+                tokens = stream_tokens(texts, tokeniser, cache, paths, CONFIG.PREPROCESSOR.PIPELINE_CHUNK_SIZE)
+                spool.extend(tqdm(tokens, total=len(paths), desc="Tokenizing texts"), is_selected)
+    frequencies.update(spool.counter, counted)
 
-    # Tokenize texts
-    amount: int | None = None
-    if amount is None:
-        content_train = tokenize_texts(train["contents"])
-        label_train = train["labels"]
-        content_test = tokenize_texts(test["contents"])
-        label_test = test["labels"]
+    # Count frequency
+    freq_words, _ = count_frequency(frequencies.counter)
+    # print(freq_words)
+
+    # Create a vocabulary/word2id mapping words to indices, an existing one only grows so its ids stay valid
+    special: list[str] = ["<PAD>", "<UNK>"]
+    existing: Vocabulary | None = None
+    if is_incremental and CONFIG.FILEPATHS.VOCABULARY.exists():
+        existing = Vocabulary.load(CONFIG.FILEPATHS.VOCABULARY)
+        # A vocabulary of subword pieces is replaced rather than grown
+        existing = existing if existing.tokeniser.get("backend") == "spacy" else None
+    if existing is not None:
+        vocabulary: Vocabulary = existing.extend(freq_words)
     else:
-        train_indices = np_random.choice(len(train["contents"]), amount, replace=False)
-        test_indices = np_random.choice(len(test["contents"]), amount, replace=False)
+        vocabulary: Vocabulary = Vocabulary.build(freq_words, special, config)
+    # print(vocabulary)
+    print(len(vocabulary))
+    # The grown frequencies are kept aside until train deploys them with the vocabulary and the model
+    if rank == 0 and is_incremental:
+        frequencies.save(CONFIG.FILEPATHS.PENDING_FREQUENCY_STORE)
+
+    # Pass 2: encode the spooled tokens to an id store, the splits are views on it
+    return encode_spool(token_spool, vocabulary, id_store), vocabulary
+
+
+def encode_subwords(
+        splits: list[tuple[Sequence[str], list[str], bool | ndarray]], id_store: str | Path, rank: int = 0
+) -> tuple[RaggedArray, Vocabulary]:
+    """ Encode the texts straight to subword ids, the subword model is trained on the counted texts if missing or
+    trained with other settings
+    :param splits: the texts, their file paths and which of them are counted, per split in store order
+    :param id_store: the path prefix of the encoded id store
+    :param rank: the rank of this process, only rank 0 trains the subword model
+    :return: the id store of all texts and the vocabulary of the subword model
+    """
+    if rank == 0 and not SubwordTokeniser.is_trained(
+            CONFIG.FILEPATHS.SUBWORD_TOKENISER,
+            model=CONFIG.PREPROCESSOR.SUBWORD_MODEL,
+            vocab_size=CONFIG.PREPROCESSOR.SUBWORD_VOCAB_SIZE,
+            min_frequency=CONFIG.PREPROCESSOR.SUBWORD_MIN_FREQUENCY
+    ):
+        SubwordTokeniser.train(
+            (
+                text
+                for texts, paths, is_selected in splits
+                for text, is_counted in zip(texts, broadcast_to(is_selected, len(paths)))
+                if is_counted
+            ),
+            CONFIG.FILEPATHS.SUBWORD_TOKENISER,
+            model=CONFIG.PREPROCESSOR.SUBWORD_MODEL,
+            vocab_size=CONFIG.PREPROCESSOR.SUBWORD_VOCAB_SIZE,
+            min_frequency=CONFIG.PREPROCESSOR.SUBWORD_MIN_FREQUENCY
+        )
+
+    # The subword model fixes the vocabulary, unseen words are split into known pieces instead of growing it
+    with build_tokeniser() as tokeniser:
+        store: RaggedArray = tokeniser.encode_to(chain.from_iterable(texts for texts, _, _ in splits), id_store)
+        vocabulary: Vocabulary = tokeniser.vocabulary
+    print(len(vocabulary))
 
-        content_train = tokenize_texts([train["contents"][i] for i in train_indices])
-        label_train = [train["labels"][i] for i in train_indices]
-        content_test = tokenize_texts([test["contents"][i] for i in test_indices])
-        label_test = [test["labels"][i] for i in test_indices]
+    return store, vocabulary
 
-    # Spilt validation set from test set
-    content_valid, content_test, label_valid, label_test = split_data(
-        content_test, label_test,
+
+def split_test(labels: ndarray) -> tuple[ndarray, ndarray, ndarray, ndarray]:
+    """ Split the test reviews into validation and test positions, the split is the same every run
+    :param labels: the labels of the test reviews
+    :return: the validation positions, the test positions, the validation labels and the test labels
+    """
+    return split_data(
+        arange(len(labels)), labels,
         valid_size=CONFIG.PREPROCESSOR.VALID_SIZE,
         random_state=CONFIG.PREPROCESSOR.RANDOM_STATE,
         is_shuffle=CONFIG.PREPROCESSOR.IS_SHUFFLE
     )
 
-    # Count frequency
-    contents = content_train + content_valid
-    content_words = [word for content in contents for word in content]
-    freq_words, _ = count_frequency(content_words)
-    # print(freq_words)
 
-    # Create a dictionary/word2id mapping words to indices
-    special: list[str] = ["<PAD>", "<UNK>"]
-    dictionary: dict[str, int] = {word: idx for idx, word in enumerate(special + freq_words)}
-    # print(dictionary)
-    print(len(dictionary))
-    save_json(dictionary, CONFIG.FILEPATHS.DICTIONARY)
+def load_test_split() -> tuple[RaggedArray, ndarray]:
+    """ Read the encoded test reviews from the id store saved by preprocess_data, nothing is re-encoded or written
+    :return: the word ids and the labels of the test reviews
+    """
+    if not Path(f"{CONFIG.FILEPATHS.ID_STORE}.json").exists():
+        raise FileNotFoundError(f"No encoded corpus at {CONFIG.FILEPATHS.ID_STORE}, preprocess the corpus first.")
+
+    # Listing the splits is enough to locate the test reviews in the store
+    train, test = [
+        load_text_data_in_dir(
+            path,
+            workers=CONFIG.PREPROCESSOR.LOADER_WORKERS,
+            queue_size=CONFIG.PREPROCESSOR.LOADER_QUEUE_SIZE,
+            archive=CONFIG.FILEPATHS.DATASET_PACK,
+            is_streamed=True
+        )
+        for path in [CONFIG.FILEPATHS.DATASET_TRAIN, CONFIG.FILEPATHS.DATASET_TEST]
+    ]
+    store: RaggedArray = RaggedArray.load(CONFIG.FILEPATHS.ID_STORE)
+    offset: int = len(train["ids"])
+    if len(store) != offset + len(test["ids"]):
+        raise ValueError(f"The id store holds {len(store)} reviews but the dataset has {offset + len(test["ids"])}, "
+                         f"preprocess the corpus again.")
+
+    _, test_positions, _, label_test = split_test(test["labels"])
+    return store.subset(offset + test_positions), label_test
+
+
+def preprocess_data(rank: int = 0):
+    """ Data Preprocessing Function
+    :param rank: the rank of this process, the other ranks use their own spool and id store
+    """
+    # Give each process its own working files, the token cache is shared
+    token_spool = CONFIG.FILEPATHS.TOKEN_SPOOL if rank == 0 else f"{CONFIG.FILEPATHS.TOKEN_SPOOL}.{rank}"
+    id_store = CONFIG.FILEPATHS.ID_STORE if rank == 0 else f"{CONFIG.FILEPATHS.ID_STORE}.{rank}"
+
+    # List the dataset, the contents are streamed rather than loaded
+    train = load_text_data_in_dir(
+        CONFIG.FILEPATHS.DATASET_TRAIN,
+        workers=CONFIG.PREPROCESSOR.LOADER_WORKERS,
+        queue_size=CONFIG.PREPROCESSOR.LOADER_QUEUE_SIZE,
+        archive=CONFIG.FILEPATHS.DATASET_PACK,
+        is_streamed=True
+    )
+    test = load_text_data_in_dir(
+        CONFIG.FILEPATHS.DATASET_TEST,
+        workers=CONFIG.PREPROCESSOR.LOADER_WORKERS,
+        queue_size=CONFIG.PREPROCESSOR.LOADER_QUEUE_SIZE,
+        archive=CONFIG.FILEPATHS.DATASET_PACK,
+        is_streamed=True
+    )
+    index = randint(0, len(train["ids"]) - 1)
+    # print(f"Train | ID: {train["ids"][index]}, Rate: {train["ratings"][index]}, Label: {train["labels"][index]}")
+    # print(f"Test  | ID: {test["ids"][index]}, Rate: {test["ratings"][index]}, Label: {test["labels"][index]}")
+    # print(f"Train | Labels: {train["labels"][12495:12505]}")
+    # print(f"Test  | Labels: {test["labels"][12495:12505]}")
 
-    # Build 2D index representation of texts
-    sequences: list[list[int]] = build_word2id_seqs(contents, dictionary)
+    # Select the texts
+    amount: int | None = None
+    if amount is None:
+        train_indices = arange(len(train["ids"]))
+        test_indices = arange(len(test["ids"]))
+    else:
+        train_indices = np_random.choice(len(train["ids"]), amount, replace=False)
+        test_indices = np_random.choice(len(test["ids"]), amount, replace=False)
+    label_train = train["labels"][train_indices]
+    label_test = test["labels"][test_indices]
+
+    # Spilt validation set from test set by position, so that only train and valid texts are counted
+    valid_positions, test_positions, label_valid, label_test = split_test(label_test)
+    is_valid = zeros(len(test_indices), dtype=bool)
+    is_valid[valid_positions] = True
+
+    # The texts, their file paths and which of them are counted towards the vocabulary, in store order
+    splits: list[tuple[Sequence[str], list[str], bool | ndarray]] = []
+    for data, indices, is_selected in [(train, train_indices, True), (test, test_indices, is_valid)]:
+        texts = data["contents"] if amount is None else [data["contents"][int(i)] for i in indices]
+        splits.append((texts, [data["paths"][i] for i in indices], is_selected))
+
+    if CONFIG.PREPROCESSOR.TOKENISER_BACKEND == "subword":
+        store, vocabulary = encode_subwords(splits, id_store, rank)
+    else:
+        store, vocabulary = encode_words(splits, token_spool, id_store, rank)
+    offset: int = len(train_indices)
+    sequences: RaggedArray = store.subset(concatenate([arange(offset), offset + valid_positions]))
     # print(sequences)
 
     # Padding the sequences to a fixed length
-    lengths: list[int] = [len(seq) for seq in sequences]
-    max_len: int = max(lengths)
-    min_len: int = min(lengths)
-    avg_len: float = sum(lengths) / len(lengths)
+    lengths = sequences.lengths
+    max_len: int = int(lengths.max())
+    min_len: int = int(lengths.min())
+    avg_len: float = float(lengths.mean())
     print(f"Max Length: {max_len}, Min Length: {min_len}, Avg Length: {avg_len:.2f}")
 
     # Setup features and labels
-    X_train: list[list[int]] = build_word2id_seqs(content_train, dictionary)
-    X_valid: list[list[int]] = build_word2id_seqs(content_valid, dictionary)
-    X_test: list[list[int]] = build_word2id_seqs(content_test, dictionary)
+    X_train: RaggedArray = store.subset(arange(offset))
+    X_valid: RaggedArray = store.subset(offset + valid_positions)
+    X_test: RaggedArray = store.subset(offset + test_positions)
     y_train: list[list[int]] = label_train
     y_valid: list[list[int]] = label_valid
     y_test: list[list[int]] = label_test
@@ -140,57 +314,167 @@ def preprocess_data():
     # print(f"{len(X_test)} X Test: {X_test}")
     # print(f"{len(y_test)} y Test: {y_test}")
 
-    return X_train, y_train, X_valid, y_valid, X_test, y_test, sequences, dictionary, max_len
+    return X_train, y_train, X_valid, y_valid, X_test, y_test, sequences, vocabulary, max_len
 
 
-def prepare_dataset():
-    """ Dataset Preparation Function """
-    X_train, y_train, X_valid, y_valid, _, _, sequences, dictionary, max_len = preprocess_data()
+def build_cpu_profile(workers: int | None = None) -> TorchCPUProfile | None:
+    """ Lay the training threads and the loading workers out over the CPU cores, None if disabled
+    :param workers: the loading workers cores are reserved for, the configured DataLoader workers if None
+    """
+    if not CONFIG.CPU.IS_ENABLED:
+        return None
+    if workers is None:
+        workers = CONFIG.PREPROCESSOR.DATALOADER_WORKERS
+    if workers is None:
+        workers = TorchDataLoader.auto_workers(CONFIG.HYPERPARAMETERS.ACCELERATOR)
+    return TorchCPUProfile(CONFIG.CPU.THREADS, CONFIG.CPU.INTEROP_THREADS, workers, CONFIG.CPU.IS_PINNED)
+
+
+def build_loader(
+        dataset: SeqClassificationTorchDataset, is_shuffle: bool, rank: int = 0, world_size: int = 1,
+        profile: TorchCPUProfile | None = None
+) -> TorchDataLoader:
+    """ Build a data loader over a dataset, bucketing the sequences by length if enabled
+    :param dataset: the dataset to load
+    :param is_shuffle: whether to shuffle the data at every epoch
+    :param rank: the rank of this process
+    :param world_size: the number of processes sharing the dataset
+    :param profile: the CPU profile pinning the loading workers to their cores
+    :return: the data loader
+    """
+    options: dict = {
+        "collate_fn": dataset.collator,
+        "workers": CONFIG.PREPROCESSOR.DATALOADER_WORKERS if profile is None else profile.workers,
+        "worker_init_fn": None if profile is None else profile.init_worker,
+        "is_pinned": CONFIG.PREPROCESSOR.IS_PIN_MEMORY,
+        "prefetch": CONFIG.PREPROCESSOR.PREFETCH_FACTOR,
+        "is_persistent": CONFIG.PREPROCESSOR.IS_PERSISTENT_WORKERS,
+        "accelerator": CONFIG.HYPERPARAMETERS.ACCELERATOR,
+        "rank": rank,
+        "world_size": world_size,
+    }
+    if not CONFIG.PREPROCESSOR.IS_BUCKETED:
+        return TorchDataLoader(
+            dataset=dataset,
+            batch_size=CONFIG.PREPROCESSOR.BATCH_SIZE,
+            is_shuffle=is_shuffle,
+            **options,
+        )
+
+    sampler = BucketBatchSampler(
+        dataset.lengths,
+        batch_size=CONFIG.PREPROCESSOR.BATCH_SIZE,
+        boundaries=CONFIG.PREPROCESSOR.BUCKET_BOUNDARIES,
+        is_shuffle=is_shuffle,
+        seed=CONFIG.PREPROCESSOR.RANDOM_STATE,
+        rank=rank,
+        world_size=world_size,
+    )
+
+    return TorchDataLoader(dataset=dataset, batch_sampler=sampler, **options)
+
+
+def prepare_dataset(distributed: TorchDistributed | None = None, profile: TorchCPUProfile | None = None):
+    """ Dataset Preparation Function
+    :param distributed: the process group of a distributed run, each process loads its own share of the batches
+    :param profile: the CPU profile applied once the preprocessing, which uses every core, is done
+    """
+    distributed = distributed or TorchDistributed()
+    # Rank 0 fills the token cache first, the other ranks then read it
+    if not distributed.is_main:
+        distributed.barrier()
+    X_train, y_train, X_valid, y_valid, _, _, sequences, vocabulary, max_len = preprocess_data(distributed.rank)
+    if distributed.is_main:
+        distributed.barrier()
+    if profile is not None:
+        profile.apply()
     print(len(X_train))
     print(len(y_train))
     print(len(X_valid))
     print(len(y_valid))
 
     # Create PyTorch Datasets
-    train_dataset = SeqClassificationTorchDataset(X_train, y_train, max_len)
-    valid_dataset = SeqClassificationTorchDataset(X_valid, y_valid, max_len)
+    train_dataset = SeqClassificationTorchDataset(X_train, y_train, max_len, vocabulary.pad_id)
+    valid_dataset = SeqClassificationTorchDataset(X_valid, y_valid, max_len, vocabulary.pad_id)
 
-    # Create DataLoaders
-    train_loader = TorchDataLoader(
-        dataset=train_dataset,
-        batch_size=CONFIG.PREPROCESSOR.BATCH_SIZE,
-        is_shuffle=CONFIG.PREPROCESSOR.IS_SHUFFLE,
-    )
-    valid_loader = TorchDataLoader(
-        dataset=valid_dataset,
-        batch_size=CONFIG.PREPROCESSOR.BATCH_SIZE,
-        is_shuffle=CONFIG.PREPROCESSOR.IS_SHUFFLE,
+    # Create DataLoaders, batches of similar lengths are padded to their own longest sequence
+    train_loader = build_loader(
+        train_dataset, CONFIG.PREPROCESSOR.IS_SHUFFLE, distributed.rank, distributed.world_size, profile
     )
+    valid_loader = build_loader(valid_dataset, False, distributed.rank, distributed.world_size, profile)
 
     print(f"Number of training batches: {len(train_loader)}")
     print(f"Number of validation batches: {len(valid_loader)}")
 
-    return train_loader, valid_loader, sequences, dictionary, max_len
+    return train_loader, valid_loader, sequences, vocabulary, max_len
 
 
-def main() -> None:
-    """ Main Function """
-    with TorchRandomSeed("IMDB RNN Classification"):
-        train_loader, valid_loader, sequences, dictionary, max_len = prepare_dataset()
+def pack_dataset() -> None:
+    """ Pack the train and test directories into a single archive """
+    splits: dict[str, dict] = {
+        path.name: load_text_data_in_dir(
+            path,
+            workers=CONFIG.PREPROCESSOR.LOADER_WORKERS,
+            queue_size=CONFIG.PREPROCESSOR.LOADER_QUEUE_SIZE
+        )
+        for path in [CONFIG.FILEPATHS.DATASET_TRAIN, CONFIG.FILEPATHS.DATASET_TEST]
+    }
+    pack_corpus(splits, CONFIG.FILEPATHS.DATASET_PACK)
+
+
+def deploy_vocabulary(vocabulary: Vocabulary) -> None:
+    """ Save the vocabulary paired with a saved model, with the frequencies it was grown from
+    :param vocabulary: the vocabulary the model was built for
+    """
+    save_json(vocabulary.to_dict(), CONFIG.FILEPATHS.DICTIONARY)
+    vocabulary.save(CONFIG.FILEPATHS.VOCABULARY)
+    # The next run grows the deployed vocabulary from the deployed frequencies, so they are replaced together
+    pending: Path = CONFIG.FILEPATHS.PENDING_FREQUENCY_STORE
+    if CONFIG.PREPROCESSOR.IS_VOCAB_INCREMENTAL and vocabulary.tokeniser.get("backend") == "spacy" and pending.exists():
+        replace(pending, CONFIG.FILEPATHS.FREQUENCY_STORE)
+        print(f"The frequency store has been deployed to {CONFIG.FILEPATHS.FREQUENCY_STORE}")
+
+
+def train(is_resumed: bool = False, is_finetuned: bool = False) -> None:
+    """ Training Function
+    :param is_resumed: whether to resume from the last checkpoint
+    :param is_finetuned: whether to start from the trained model, its embedding grown to the extended vocabulary
+    """
+    # The model class and the trainer, with PySide6, are only imported by the commands which train
+    from utils.models import RNNClassificationTorchModel
+    from utils.trainer import RNNClassificationTorchTrainer
+
+    with TorchDistributed(CONFIG.HYPERPARAMETERS.BACKEND) as distributed, TorchRandomSeed("IMDB RNN Classification"):
+        train_loader, valid_loader, sequences, vocabulary, max_len = prepare_dataset(distributed, build_cpu_profile())
         # index: int = randint(0, len(train_loader) - 1)
         # print(f"Sample batch index: {index}")
         # print(train_loader[index][0])
         # print(train_loader[index][1])
 
         # Setup model
-        model = RNNClassificationTorchModel(
-            vocab_size=len(dictionary),
-            embedding_dim=CONFIG.PARAMETERS.RNN_EMBEDDING_DIM,
-            hidden_size=CONFIG.PARAMETERS.RNN_HIDDEN_SIZE,
-            num_layers=CONFIG.PARAMETERS.RNN_LAYERS,
-            num_classes=2,  # Binary classification
-            dropout_rate=CONFIG.PARAMETERS.DROPOUT_RATE
-        )
+        if is_finetuned:
+            # The appended words start from the unknown token they were mapped to before
+            model = RNNClassificationTorchModel.from_state_dict(
+                load(CONFIG.FILEPATHS.MODEL, map_location="cpu", weights_only=True),
+                dropout_rate=CONFIG.PARAMETERS.DROPOUT_RATE
+            )
+            model.resize_embedding(len(vocabulary), vocabulary.unk_id)
+        else:
+            model = RNNClassificationTorchModel(
+                vocab_size=len(vocabulary),
+                embedding_dim=CONFIG.PARAMETERS.RNN_EMBEDDING_DIM,
+                hidden_size=CONFIG.PARAMETERS.RNN_HIDDEN_SIZE,
+                num_layers=CONFIG.PARAMETERS.RNN_LAYERS,
+                num_classes=2,  # Binary classification
+                dropout_rate=CONFIG.PARAMETERS.DROPOUT_RATE
+            )
+
+        # The vocabulary is only deployed with a model built for it, so predict and serve never see a mismatched pair
+        if is_finetuned and distributed.is_main:
+            # The resized model predicts as the trained one did, so the pair is valid before any further training
+            with CheckpointWriter() as writer:
+                writer.save(model.state_dict(), CONFIG.FILEPATHS.MODEL)
+            deploy_vocabulary(vocabulary)
 
         # Setup optimizer and loss function
         optimizer = optim.AdamW(model.parameters(), lr=CONFIG.HYPERPARAMETERS.ALPHA, weight_decay=1e-4)
@@ -202,15 +486,268 @@ def main() -> None:
             model=model,
             optimiser=optimizer,
             criterion=criterion,
-            accelerator=CONFIG.HYPERPARAMETERS.ACCELERATOR
+            accelerator=CONFIG.HYPERPARAMETERS.ACCELERATOR,
+            precision=CONFIG.HYPERPARAMETERS.PRECISION,
+            sync_steps=CONFIG.HYPERPARAMETERS.SYNC_STEPS,
+            accumulation_steps=CONFIG.HYPERPARAMETERS.ACCUMULATION_STEPS,
+            is_lr_scaled=CONFIG.HYPERPARAMETERS.IS_LR_SCALED
         )
         # Train the model
         trainer.fit(
             train_loader=train_loader,
             valid_loader=valid_loader,
             epochs=CONFIG.HYPERPARAMETERS.EPOCHS,
-            model_save_path=str(CONFIG.FILEPATHS.MODEL)
+            model_save_path=str(CONFIG.FILEPATHS.MODEL),
+            checkpoint_path=str(CONFIG.FILEPATHS.CHECKPOINT),
+            is_resumed=is_resumed,
+            # A model trained from scratch deploys the vocabulary once it has been saved
+            on_saved=None if is_finetuned else partial(deploy_vocabulary, vocabulary)
+        )
+
+
+def benchmark(batches: int, seq_len: int, epochs: int) -> None:
+    """ Benchmark the training steps per second on synthetic reviews
+    :param batches: number of batches per epoch
+    :param seq_len: length of every synthetic review
+    :param epochs: number of timed epochs
+    """
+    from utils.models import RNNClassificationTorchModel
+    from utils.trainer import RNNClassificationTorchTrainer
+
+    with TorchRandomSeed("IMDB RNN Benchmark"):
+        samples: int = batches * CONFIG.PREPROCESSOR.BATCH_SIZE
+        vocab_size: int = 10000
+        features = RaggedArray(
+            np_random.randint(2, vocab_size, samples * seq_len).astype(int32),
+            arange(0, samples * seq_len + 1, seq_len)
+        )
+        dataset = SeqClassificationTorchDataset(features, np_random.randint(0, 2, samples), seq_len)
+        profile = build_cpu_profile()
+        if profile is not None:
+            profile.apply()
+        loader = build_loader(dataset, True, profile=profile)
+
+        model = RNNClassificationTorchModel(
+            vocab_size=vocab_size,
+            embedding_dim=CONFIG.PARAMETERS.RNN_EMBEDDING_DIM,
+            hidden_size=CONFIG.PARAMETERS.RNN_HIDDEN_SIZE,
+            num_layers=CONFIG.PARAMETERS.RNN_LAYERS,
+            num_classes=2,
+            dropout_rate=CONFIG.PARAMETERS.DROPOUT_RATE
         )
+        trainer = RNNClassificationTorchTrainer(
+            model=model,
+            optimiser=optim.AdamW(model.parameters(), lr=CONFIG.HYPERPARAMETERS.ALPHA, weight_decay=1e-4),
+            criterion=nn.CrossEntropyLoss(),
+            accelerator=CONFIG.HYPERPARAMETERS.ACCELERATOR,
+            precision=CONFIG.HYPERPARAMETERS.PRECISION,
+            sync_steps=CONFIG.HYPERPARAMETERS.SYNC_STEPS,
+            accumulation_steps=CONFIG.HYPERPARAMETERS.ACCUMULATION_STEPS,
+            is_lr_scaled=CONFIG.HYPERPARAMETERS.IS_LR_SCALED
+        )
+        trainer.benchmark(loader, epochs)
+
+
+def build_prediction_cache(model: str | Path) -> PredictionCache | None:
+    """ Build the prediction cache of a model, the spill is kept apart per model and vocabulary file
+    :param model: path to the model file served
+    :return: the cache, None if caching is disabled
+    """
+    if not CONFIG.PREPROCESSOR.IS_PREDICTION_CACHED:
+        return None
+
+    # Retrained models or rebuilt vocabularies change the files, and so the namespace
+    namespace: str = "|".join(
+        f"{Path(path).resolve()}:{Path(path).stat().st_size}:{Path(path).stat().st_mtime_ns}"
+        for path in (model, CONFIG.FILEPATHS.VOCABULARY)
+    )
+    return PredictionCache(
+        max_bytes=CONFIG.PREPROCESSOR.PREDICTION_CACHE_MB << 20,
+        ttl=CONFIG.PREPROCESSOR.PREDICTION_CACHE_TTL,
+        directory=CONFIG.FILEPATHS.PREDICTION_CACHE if CONFIG.PREPROCESSOR.IS_PREDICTION_SPILLED else None,
+        namespace=namespace
+    )
+
+
+def predict(source: str, target: str, field: str, model: str | None = None) -> None:
+    """ Classify the reviews of a JSON Lines file with the trained model
+    :param source: path to the input file, '-' for stdin
+    :param target: path to the output file, '-' for stdout
+    :param field: the key of the review in the input objects
+    :param model: path to the model parameters, a quantised or a compiled artifact, the trained model if None
+    """
+    # Keep stdout clean for the predictions, the logs go to stderr
+    output = sys.stdout
+    model = model or CONFIG.FILEPATHS.MODEL
+    cache: PredictionCache | None = build_prediction_cache(model)
+    with (
+        redirect_stdout(sys.stderr),
+        build_tokeniser() as tokeniser,
+        cache if cache is not None else nullcontext(),
+        open(source, "r", encoding="utf-8") if source != "-" else nullcontext(sys.stdin) as reader,
+        open(target, "w", encoding="utf-8") if target != "-" else nullcontext(output) as writer
+    ):
+        predictor = RNNClassificationTorchPredictor(
+            model,
+            CONFIG.FILEPATHS.VOCABULARY,
+            tokeniser=tokeniser,
+            accelerator=CONFIG.HYPERPARAMETERS.ACCELERATOR,
+            batch_size=CONFIG.PREPROCESSOR.PREDICT_BATCH_SIZE,
+            boundaries=CONFIG.PREPROCESSOR.BUCKET_BOUNDARIES,
+            cache=cache,
+            chunk_len=CONFIG.PREPROCESSOR.INFERENCE_CHUNK_LEN
+        )
+        print(predictor)
+        count: int = predictor.predict_jsonl(reader, writer, field, CONFIG.PREPROCESSOR.PREDICT_CHUNK_SIZE)
+        print(f"Classified {count} reviews.")
+        if cache is not None:
+            print(f"Prediction cache: {cache.stats}")
+
+
+def serve(host: str | None = None, port: int | None = None, model: str | None = None) -> None:
+    """ Serve the trained model over HTTP, concurrent reviews are scored in micro-batches
+    :param host: the interface to listen on, the configured host if None
+    :param port: the port to listen on, the configured port if None
+    :param model: path to the model parameters, a quantised or a compiled artifact, the trained model if None
+    """
+    # Inference starts no DataLoader workers, every core computes
+    profile = build_cpu_profile(workers=0)
+    if profile is not None:
+        profile.apply()
+
+    # Micro-batches are small, tokenising them in the inference thread beats shipping them to a process pool
+    model = model or CONFIG.FILEPATHS.MODEL
+    cache: PredictionCache | None = build_prediction_cache(model)
+    with build_tokeniser(workers=1) as tokeniser, cache if cache is not None else nullcontext():
+        predictor = RNNClassificationTorchPredictor(
+            model,
+            CONFIG.FILEPATHS.VOCABULARY,
+            tokeniser=tokeniser,
+            accelerator=CONFIG.HYPERPARAMETERS.ACCELERATOR,
+            batch_size=CONFIG.SERVER.MAX_BATCH_SIZE,
+            boundaries=CONFIG.PREPROCESSOR.BUCKET_BOUNDARIES,
+            cache=cache,
+            chunk_len=CONFIG.PREPROCESSOR.INFERENCE_CHUNK_LEN
+        )
+        print(predictor)
+        server = SentimentServer(
+            predictor.predict,
+            host=host or CONFIG.SERVER.HOST,
+            port=CONFIG.SERVER.PORT if port is None else port,
+            max_batch_size=CONFIG.SERVER.MAX_BATCH_SIZE,
+            max_wait_ms=CONFIG.SERVER.MAX_WAIT_MS,
+            max_body_bytes=CONFIG.SERVER.MAX_BODY_BYTES,
+            cache=cache
+        )
+        server.run()
+
+
+def compile_model() -> None:
+    """ Compile the trained model into a TorchScript artifact served without the Python model class """
+    from utils.quantise import load_model
+
+    compile_torchscript(load_model(CONFIG.FILEPATHS.MODEL), CONFIG.FILEPATHS.COMPILED_MODEL)
+
+
+def quantise(limit: int | None = None) -> None:
+    """ Export the int8 model and compare its accuracy and latency with the float32 model on the test split
+    :param limit: number of test reviews used for the report, all if None
+    """
+    from utils.quantise import EMBEDDINGS, load_model, save_quantised
+
+    X_test, y_test = load_test_split()
+    if limit is not None:
+        X_test, y_test = X_test.subset(arange(min(limit, len(X_test)))), y_test[:limit]
+    # Inference starts no DataLoader workers, every core computes
+    profile = build_cpu_profile(workers=0)
+    if profile is not None:
+        profile.apply()
+
+    model = load_model(CONFIG.FILEPATHS.MODEL)
+    save_quantised(model, CONFIG.FILEPATHS.QUANTISED_MODEL, CONFIG.PARAMETERS.QUANTISED_EMBEDDING)
+
+    rows: list[dict] = []
+    reference = None
+    with TemporaryDirectory() as directory:
+        # The exported artifact plus the other embedding storages, for comparison
+        variants: dict[str, Path] = {"fp32": CONFIG.FILEPATHS.MODEL}
+        for embedding_dtype in EMBEDDINGS:
+            path = CONFIG.FILEPATHS.QUANTISED_MODEL
+            if embedding_dtype != CONFIG.PARAMETERS.QUANTISED_EMBEDDING:
+                path = Path(directory) / f"model.int8.{embedding_dtype}.pth"
+                save_quantised(model, path, embedding_dtype)
+            variants[f"int8 + {embedding_dtype} embedding"] = path
+
+        for name, path in variants.items():
+            predictor = RNNClassificationTorchPredictor(
+                path,
+                CONFIG.FILEPATHS.VOCABULARY,
+                accelerator="cpu",
+                batch_size=CONFIG.PREPROCESSOR.PREDICT_BATCH_SIZE,
+                boundaries=CONFIG.PREPROCESSOR.BUCKET_BOUNDARIES
+            )
+            start: float = perf_counter()
+            labels, probabilities = predictor.predict_encoded(X_test)
+            elapsed: float = perf_counter() - start
+            reference = probabilities if reference is None else reference
+
+            rows.append({
+                "model": name,
+                "size (MB)": round(path.stat().st_size / 1024 ** 2, 2),
+                "accuracy": round(float((labels == y_test).mean()), 4),
+                "agreement": round(float((labels == reference.argmax(axis=1)).mean()), 4),
+                "max prob diff": float(abs(probabilities - reference).max()),
+                "reviews/s": round(len(labels) / elapsed, 1),
+                "ms/review": round(elapsed * 1000 / len(labels), 3),
+            })
+
+    print(f"Quantisation report on {len(X_test)} test reviews:")
+    print(DataFrame(rows).to_string(index=False))
+
+
+def main() -> None:
+    """ Main Function """
+    parser = ArgumentParser(description="IMDB sentiment classification with an RNN")
+    commands = parser.add_subparsers(dest="command")
+    training = commands.add_parser("train", help="preprocess the dataset and train the model (default)")
+    # A checkpoint already holds the grown model, an interrupted fine-tune resumes with --resume alone
+    start = training.add_mutually_exclusive_group()
+    start.add_argument("--resume", action="store_true", help="resume from the last checkpoint")
+    start.add_argument("--finetune", action="store_true", help="start from the trained model, grown to new words")
+    commands.add_parser("pack", help="pack the train and test directories into a single archive")
+    bench = commands.add_parser("bench", help="benchmark the training steps per second on synthetic reviews")
+    bench.add_argument("--batches", type=int, default=50, help="number of batches per epoch")
+    bench.add_argument("--seq-len", type=int, default=256, help="length of every synthetic review")
+    bench.add_argument("--epochs", type=int, default=1, help="number of timed epochs")
+    predicting = commands.add_parser("predict", help="classify the reviews of a JSON Lines file")
+    predicting.add_argument("--input", default="-", help="input JSON Lines file, stdin by default")
+    predicting.add_argument("--output", default="-", help="output JSON Lines file, stdout by default")
+    predicting.add_argument("--field", default="text", help="the key of the review in the input objects")
+    predicting.add_argument("--model", default=None, help="model parameters, quantised or compiled artifact")
+    serving = commands.add_parser("serve", help="serve the model over HTTP with micro-batching")
+    serving.add_argument("--host", default=None, help="the interface to listen on")
+    serving.add_argument("--port", type=int, default=None, help="the port to listen on")
+    serving.add_argument("--model", default=None, help="model parameters, quantised or compiled artifact")
+    commands.add_parser("compile", help="compile the trained model into a TorchScript artifact")
+    quantising = commands.add_parser("quantise", help="export the int8 model and report it against float32")
+    quantising.add_argument("--limit", type=int, default=None, help="number of test reviews used for the report")
+    args = parser.parse_args()
+
+    match args.command:
+        case "pack":
+            pack_dataset()
+        case "bench":
+            benchmark(args.batches, args.seq_len, args.epochs)
+        case "predict":
+            predict(args.input, args.output, args.field, args.model)
+        case "serve":
+            serve(args.host, args.port, args.model)
+        case "compile":
+            compile_model()
+        case "quantise":
+            quantise(args.limit)
+        case _:
+            train(getattr(args, "resume", False), getattr(args, "finetune", False))
 
 
 if __name__ == "__main__":
@@ -6,17 +6,28 @@
 # @File     :   PT.py
 # @Desc     :   
 
-from numpy import ndarray, random as np_random
+from numpy import (ndarray, asarray, full, minimum, digitize, flatnonzero,
+                   int64 as np_int64, random as np_random)
+from os import cpu_count, environ
+from pathlib import Path
 from pandas import DataFrame, Series
 from random import seed as rnd_seed, getstate, setstate
-from torch import (cuda, backends, Tensor, tensor, float32, int64, long,
-                   manual_seed, get_rng_state, set_rng_state)
+from time import perf_counter
+from torch import (cuda, backends, Tensor, tensor, from_numpy, float32, int64, long,
+                   manual_seed, get_rng_state, set_rng_state, stack,
+                   set_num_threads, get_num_threads, set_num_interop_threads, get_num_interop_threads)
 
-from torch.utils.data import Dataset, DataLoader
-from typing import Union, Any
+from torch.utils.data import Dataset, DataLoader, Sampler, DistributedSampler
+from typing import Union, Any, Iterable, Iterator, Sequence
 
 from utils.decorator import timer
 
+try:
+    from os import sched_getaffinity, sched_setaffinity
+except ImportError:
+    # macOS and Windows do not expose the CPU affinity
+    sched_getaffinity = sched_setaffinity = None
+
 
 class TorchRandomSeed:
     """ Setting random seed for reproducibility """
@@ -65,6 +76,29 @@ class TorchRandomSeed:
         print("*" * 50)
         print()
 
+    @staticmethod
+    def get_states() -> dict:
+        """ Capture the current Python, NumPy, PyTorch and CUDA random states, e.g. for a checkpoint
+        :return: the random states
+        """
+        return {
+            "python": getstate(),
+            "numpy": np_random.get_state(),
+            "torch": get_rng_state(),
+            "cuda": cuda.get_rng_state_all() if cuda.is_available() else [],
+        }
+
+    @staticmethod
+    def set_states(states: dict) -> None:
+        """ Restore random states captured by get_states
+        :param states: the random states
+        """
+        setstate(states["python"])
+        np_random.set_state(states["numpy"])
+        set_rng_state(states["torch"])
+        if states["cuda"] and cuda.is_available():
+            cuda.set_rng_state_all(states["cuda"])
+
     def __repr__(self):
         """ Return a string representation of the random seed """
         return f"{self._description!r} is set to randomness {self._seed}."
@@ -158,6 +192,126 @@ def get_device(accelerator: str = "auto", cuda_mode: int = 0) -> str:
             return "cpu"
 
 
+def _read_cpulist(path: Path) -> list[int]:
+    """ Parse a Linux cpulist file such as '0-3,8-11'
+    :param path: path to the cpulist file
+    :return: the CPU ids, empty if the file cannot be read
+    """
+    try:
+        text: str = path.read_text().strip()
+    except OSError:
+        return []
+
+    cpus: list[int] = []
+    for part in filter(None, text.split(",")):
+        first, _, last = part.partition("-")
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+class TorchCPUProfile:
+    """ Thread and core layout of a CPU training process, derived from the NUMA topology """
+
+    def __init__(self, threads: int | None = None, interop_threads: int | None = None, workers: int = 0,
+                 is_pinned: bool = True) -> None:
+        """ Initialise the TorchCPUProfile class
+        :param threads: the intra-op threads, one per physical compute core if None
+        :param interop_threads: the inter-op threads, 1 if None as the LSTM has no parallel branches
+        :param workers: the number of data loading workers, each gets a core of its own
+        :param is_pinned: whether to pin the process and its workers to their cores
+        """
+        self._is_pinned: bool = is_pinned
+        # Processes launched by torchrun on this host split the cores between them
+        self._local_rank: int = int(environ.get("LOCAL_RANK", 0))
+        self._local_world: int = int(environ.get("LOCAL_WORLD_SIZE", 1))
+
+        available: set[int] = sched_getaffinity(0) if sched_getaffinity is not None else set(range(cpu_count() or 1))
+        nodes: list[list[int]] = [
+            [cpu for cpu in _read_cpulist(node / "cpulist") if cpu in available]
+            for node in sorted(Path("/sys/devices/system/node").glob("node[0-9]*"))
+        ]
+        self._nodes: list[list[int]] = [node for node in nodes if node] or [sorted(available)]
+
+        # A single process uses every node, otherwise ranks are spread over the nodes and share them evenly
+        self._node: int = self._local_rank % len(self._nodes) if self._local_world > 1 else 0
+        cpus: list[int] = self._nodes[self._node] if self._local_world > 1 else sorted(available)
+        # Hyper-threads of the same core share its vector units, so only the first sibling of a core is used
+        cores: list[int] = [
+            cpu for cpu in cpus
+            if (_read_cpulist(Path(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list")) or [cpu])[0] == cpu
+        ] or cpus
+        sharing: list[int] = [rank for rank in range(self._local_world) if rank % len(self._nodes) == self._node]
+        size: int = max(1, len(cores) // len(sharing))
+        index: int = sharing.index(self._local_rank) if self._local_rank in sharing else 0
+        cores = cores[index * size:(index + 1) * size] or cores
+
+        reserved: int = min(workers, len(cores) - 1)
+        self._worker_cores: list[int] = cores[len(cores) - reserved:] if reserved > 0 else []
+        self._compute_cores: list[int] = cores[:len(cores) - len(self._worker_cores)]
+        self._workers: int = workers
+        self._threads: int = threads or len(self._compute_cores)
+        self._interop_threads: int = interop_threads or 1
+
+    @property
+    def threads(self) -> int:
+        return self._threads
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def compute_cores(self) -> list[int]:
+        return self._compute_cores
+
+    @property
+    def worker_cores(self) -> list[int]:
+        return self._worker_cores
+
+    def apply(self) -> "TorchCPUProfile":
+        """ Set the PyTorch threads and the core affinity of this process """
+        set_num_threads(self._threads)
+        try:
+            set_num_interop_threads(self._interop_threads)
+        except RuntimeError:
+            # The inter-op pool can only be sized before its first use
+            print(f"The inter-op threads are already running, keeping {get_num_interop_threads()}.")
+        if self._is_pinned and sched_setaffinity is not None:
+            sched_setaffinity(0, self._compute_cores)
+
+        location: str = f"NUMA node {self._node}" if self._local_world > 1 else f"all {len(self._nodes)} NUMA node(s)"
+        print(f"CPU profile - local rank {self._local_rank}/{self._local_world} on {location}")
+        print(f"- Compute cores: {_format_cpus(self._compute_cores)} - intra-op threads: {get_num_threads()}, "
+              f"inter-op threads: {get_num_interop_threads()}")
+        print(f"- Worker cores: {_format_cpus(self._worker_cores) or 'shared'} - workers: {self._workers}")
+
+        return self
+
+    def init_worker(self, worker_id: int) -> None:
+        """ Pin a data loading worker to its own core, passed to the DataLoader as worker_init_fn
+        :param worker_id: the id of the worker
+        """
+        # The workers only collate, a single thread each avoids competing with the training threads
+        set_num_threads(1)
+        if self._is_pinned and self._worker_cores and sched_setaffinity is not None:
+            sched_setaffinity(0, [self._worker_cores[worker_id % len(self._worker_cores)]])
+
+    def __repr__(self) -> str:
+        return (f"TorchCPUProfile(threads={self._threads}, interop_threads={self._interop_threads}, "
+                f"compute_cores={_format_cpus(self._compute_cores)}, worker_cores={_format_cpus(self._worker_cores)})")
+
+
+def _format_cpus(cpus: list[int]) -> str:
+    """ Format CPU ids as a cpulist string such as '0-3,8' """
+    ranges: list[str] = []
+    for cpu in cpus:
+        if ranges and int(ranges[-1].split("-")[-1]) == cpu - 1:
+            ranges[-1] = f"{ranges[-1].split("-")[0]}-{cpu}"
+        else:
+            ranges.append(str(cpu))
+    return ",".join(ranges)
+
+
 @timer
 def arr2tensor(data: ndarray, accelerator: str, is_grad: bool = False) -> Tensor:
     """ Convert a NumPy array to a PyTorch tensor
@@ -289,26 +443,91 @@ class LabelTorchDataset(Dataset):
 class TorchDataLoader:
     """ A custom PyTorch DataLoader class for handling TorchDataset """
 
-    def __init__(self, dataset: Dataset, batch_size: int = 32, is_shuffle: bool = True):
+    def __init__(
+            self, dataset: Dataset, batch_size: int = 32, is_shuffle: bool = True,
+            batch_sampler: Sampler | None = None, collate_fn=None, sampler: Sampler | None = None,
+            workers: int | None = None, is_pinned: bool | None = None, prefetch: int = 2,
+            is_persistent: bool = True, accelerator: str = "cpu", rank: int = 0, world_size: int = 1,
+            worker_init_fn=None
+    ):
         """ Initialise the TorchDataLoader class
         :param dataset: the TorchDataset or Dataset to load data from
         :param batch_size: the number of samples per batch
         :param is_shuffle: whether to shuffle the data at every epoch
+        :param batch_sampler: the sampler yielding the indices of each batch, overrides batch_size and is_shuffle
+        :param collate_fn: the function merging samples into a batch
+        :param sampler: the sampler yielding the sample indices, overrides is_shuffle
+        :param workers: the number of loading worker processes, chosen from the cores and the device if None
+        :param is_pinned: whether to put batches in pinned memory, True on CUDA if None
+        :param prefetch: the number of batches loaded in advance by each worker
+        :param is_persistent: whether to keep the workers alive between epochs
+        :param accelerator: the device the batches are sent to
+        :param rank: the rank of this process, the samples are split across processes if world_size > 1
+        :param world_size: the number of processes sharing the dataset
+        :param worker_init_fn: the function called in each worker process on start, e.g. to pin it to a core
         """
         self._dataset: Union[Dataset, LabelTorchDataset] = dataset
         self._batches: int = batch_size
         self._is_shuffle: bool = is_shuffle
+        self._batch_sampler: Sampler | None = batch_sampler
+        self._workers: int = self.auto_workers(accelerator) if workers is None else workers
+        self._is_pinned: bool = accelerator.startswith("cuda") if is_pinned is None else is_pinned
+        # Time spent waiting on the next batch during the last pass
+        self._wait: float = 0.0
+
+        options: dict = {"collate_fn": collate_fn, "num_workers": self._workers, "pin_memory": self._is_pinned}
+        if self._workers > 0:
+            options.update(prefetch_factor=prefetch, persistent_workers=is_persistent, worker_init_fn=worker_init_fn)
+
+        if self._batch_sampler is None and sampler is None and world_size > 1:
+            sampler = DistributedSampler(self._dataset, num_replicas=world_size, rank=rank, shuffle=is_shuffle)
+
+        if self._batch_sampler is not None:
+            self._loader: DataLoader = DataLoader(
+                dataset=self._dataset,
+                batch_sampler=self._batch_sampler,
+                **options,
+            )
+        else:
+            self._loader: DataLoader = DataLoader(
+                dataset=self._dataset,
+                batch_size=self._batches,
+                shuffle=self._is_shuffle if sampler is None else None,
+                sampler=sampler,
+                **options,
+            )
 
-        self._loader: DataLoader = DataLoader(
-            dataset=self._dataset,
-            batch_size=self._batches,
-            shuffle=self._is_shuffle,
-        )
+    @staticmethod
+    def auto_workers(accelerator: str) -> int:
+        """ Choose the number of loading workers
+        :param accelerator: the device the batches are sent to
+        :return: the number of workers
+        """
+        cores: int = cpu_count() or 1
+        # On the CPU the workers compete with the training threads, so only a couple are worth it
+        if accelerator.startswith("cpu"):
+            return min(2, cores // 4)
+        return min(8, cores // 2)
 
     @property
     def dataset(self) -> Union[Dataset, LabelTorchDataset]:
         return self._dataset
 
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    @property
+    def wait_time(self) -> float:
+        """ Return the seconds spent waiting on batches during the last pass """
+        return self._wait
+
+    def set_epoch(self, epoch: int) -> None:
+        """ Pass the epoch on to the samplers which shuffle per epoch """
+        for sampler in (self._loader.batch_sampler, self._loader.sampler):
+            if hasattr(sampler, "set_epoch"):
+                sampler.set_epoch(epoch)
+
     def __getitem__(self, index: int) -> tuple[Tensor, Tensor]:
         """ Return a single (feature, label) pair or a batch via slice """
         if not isinstance(index, int):
@@ -316,15 +535,141 @@ class TorchDataLoader:
         return self._dataset[index]
 
     def __iter__(self):
-        return iter(self._loader)
+        self._wait = 0.0
+        iterator = iter(self._loader)
+        while True:
+            start: float = perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._wait += perf_counter() - start
+            yield batch
 
     def __len__(self) -> int:
         return len(self._loader)
 
     def __repr__(self):
+        if self._batch_sampler is not None:
+            return (f"TorchDataLoader(dataset={self._dataset}, batch_sampler={self._batch_sampler}, "
+                    f"workers={self._workers}, pinned={self._is_pinned})")
         return (f"TorchDataLoader(dataset={self._dataset}, "
                 f"batch_size={self._batches}, "
-                f"shuffle={self._is_shuffle})")
+                f"shuffle={self._is_shuffle}, "
+                f"workers={self._workers}, pinned={self._is_pinned})")
+
+
+class BucketBatchSampler(Sampler):
+    """ Batch sampler grouping sequences of similar length, so each batch only pads to its own longest sequence """
+
+    def __init__(
+            self, lengths: Iterable[int], batch_size: int = 32, boundaries: Sequence[int] = (),
+            is_shuffle: bool = True, is_drop_last: bool = False, seed: int = 27, rank: int = 0, world_size: int = 1
+    ) -> None:
+        """ Initialise the BucketBatchSampler class
+        :param lengths: the length of each sequence in the dataset
+        :param batch_size: the number of samples per batch
+        :param boundaries: the ascending upper bounds of the length buckets, sequences longer than the last bound
+                           share one final bucket
+        :param is_shuffle: whether to shuffle the samples within each bucket and the order of batches every epoch
+        :param is_drop_last: whether to drop the last incomplete batch of each bucket
+        :param seed: the seed of the shuffling, combined with the epoch
+        :param rank: the rank of this process, each process takes every world_size-th batch
+        :param world_size: the number of processes sharing the dataset
+        """
+        self._lengths: ndarray = asarray(lengths, dtype=np_int64)
+        self._batches: int = batch_size
+        self._boundaries: list[int] = sorted(boundaries)
+        self._is_shuffle: bool = is_shuffle
+        self._is_drop_last: bool = is_drop_last
+        self._seed: int = seed
+        self._epoch: int = 0
+        self._rank: int = rank
+        self._world_size: int = world_size
+
+        # Bucket i holds the sequences with boundaries[i - 1] < length <= boundaries[i]
+        buckets: ndarray = digitize(self._lengths, self._boundaries, right=True)
+        self._buckets: list[ndarray] = [
+            flatnonzero(buckets == i) for i in range(len(self._boundaries) + 1) if (buckets == i).any()
+        ]
+
+    @property
+    def boundaries(self) -> list[int]:
+        return self._boundaries
+
+    @property
+    def buckets(self) -> list[int]:
+        """ Return the number of samples in each non-empty bucket """
+        return [len(bucket) for bucket in self._buckets]
+
+    def set_epoch(self, epoch: int) -> None:
+        """ Set the epoch so that every epoch is shuffled differently but reproducibly """
+        self._epoch = epoch
+
+    def _split(self, bucket: ndarray) -> list[ndarray]:
+        """ Split a bucket into batches """
+        batches: list[ndarray] = [bucket[i:i + self._batches] for i in range(0, len(bucket), self._batches)]
+        if self._is_drop_last and batches and len(batches[-1]) < self._batches:
+            batches.pop()
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        rng = np_random.default_rng(self._seed + self._epoch)
+        self._epoch += 1
+
+        batches: list[ndarray] = []
+        for bucket in self._buckets:
+            if self._is_shuffle:
+                bucket = rng.permutation(bucket)
+            else:
+                # Sort within the bucket so that evaluation batches are as tight as possible
+                bucket = bucket[self._lengths[bucket].argsort(kind="stable")]
+            batches.extend(self._split(bucket))
+
+        order: list[int] = rng.permutation(len(batches)).tolist() if self._is_shuffle else list(range(len(batches)))
+        # Every process draws the same order, repeated batches pad it so all processes take as many steps
+        order += order[:len(self) * self._world_size - len(order)]
+        for i in order[self._rank::self._world_size]:
+            yield batches[i].tolist()
+
+    def __len__(self) -> int:
+        if self._is_drop_last:
+            batches: int = sum(len(bucket) // self._batches for bucket in self._buckets)
+        else:
+            batches: int = sum(-(-len(bucket) // self._batches) for bucket in self._buckets)
+        return -(-batches // self._world_size)
+
+    def __repr__(self) -> str:
+        return (f"BucketBatchSampler(samples={len(self._lengths)}, batch_size={self._batches}, "
+                f"boundaries={self._boundaries}, shuffle={self._is_shuffle}, "
+                f"rank={self._rank}, world_size={self._world_size})")
+
+
+class PadCollator:
+    """ Collate (sequence, label) samples into a batch padded to the longest sequence of the batch, with lengths """
+
+    def __init__(self, pad_token: int = 0) -> None:
+        """ Initialise the PadCollator class
+        :param pad_token: the padding token to use
+        """
+        self._pad: int = pad_token
+
+    def __call__(self, batch: list[tuple[Tensor, Tensor]]) -> tuple[Tensor, Tensor, Tensor]:
+        """ Pad the sequences of a batch
+        :param batch: the (sequence, label) samples
+        :return: the padded features, shape (batch_size, longest_length), the labels and the sequence lengths
+        """
+        sequences, labels = zip(*batch)
+        lengths: ndarray = asarray([len(seq) for seq in sequences], dtype=np_int64)
+        features: ndarray = full((len(sequences), max(lengths.max(), 1)), self._pad, dtype=np_int64)
+        for i, seq in enumerate(sequences):
+            features[i, :len(seq)] = seq
+
+        return from_numpy(features), stack(labels), from_numpy(lengths)
+
+    def __repr__(self) -> str:
+        return f"PadCollator(pad_token={self._pad})"
 
 
 class SeqPredictionTorchDataset(Dataset):
@@ -421,58 +766,74 @@ class SeqPredictionTorchDataset(Dataset):
 class SeqClassificationTorchDataset(Dataset):
     """ A custom PyTorch Dataset class for handling sequential features and labels """
 
-    def __init__(self, feature_seqs: list, lbl_seqs: list, seq_max_len: int, pad_token: int = 0) -> None:
+    def __init__(self, feature_seqs: Sequence, lbl_seqs: Sequence, seq_max_len: int, pad_token: int = 0) -> None:
         """ Initialise the TorchDataset class for sequential data
-        :param feature_seqs: the input sequences
+        :param feature_seqs: the input sequences, e.g. a RaggedArray or a list of lists
         :param lbl_seqs: the label sequences
-        :param seq_max_len: the length of each sequence
+        :param seq_max_len: the length sequences are truncated to
         :param pad_token: the padding token to use
         """
         self._sequences = feature_seqs
         self._length = seq_max_len
         self._pad = pad_token
-        self._features = self._pad_to_fixed_len_tensor()
+        self._lengths: ndarray = self._get_lengths()
         self._labels = tensor(lbl_seqs, dtype=long)
+        self._collator: PadCollator = PadCollator(self._pad)
+
+    def _get_lengths(self) -> ndarray:
+        """ Get the length of each sequence after truncation """
+        lengths = getattr(self._sequences, "lengths", None)
+        if lengths is None:
+            lengths = [len(seq) for seq in self._sequences]
+        return minimum(asarray(lengths, dtype=np_int64), self._length)
 
     def _pad_to_fixed_len_tensor(self) -> Tensor:
         """ Convert input data to a PyTorch tensor via padding to fixed length
         :return: the converted PyTorch tensor
         """
-        _features = []
-        for seq in self._sequences:
-            if len(seq) < self._length:
-                padded_seq = seq + [self._pad] * (self._length - len(seq))
-            else:
-                padded_seq = seq[:self._length]
-            _features.append(padded_seq)
+        _features = full((len(self._sequences), self._length), self._pad, dtype=np_int64)
+        for i, seq in enumerate(self._sequences):
+            seq = seq[:self._length]
+            _features[i, :len(seq)] = seq
 
-        return tensor(_features)
+        return from_numpy(_features)
 
     @property
     def features(self) -> Tensor:
-        """ Return the feature tensor as a property """
-        return self._features
+        """ Return the feature tensor padded to the fixed length as a property """
+        return self._pad_to_fixed_len_tensor()
 
     @property
     def labels(self) -> Tensor:
         """ Return the label tensor as a property """
         return self._labels
 
+    @property
+    def lengths(self) -> ndarray:
+        """ Return the truncated length of each sequence as a property """
+        return self._lengths
+
+    @property
+    def collator(self) -> PadCollator:
+        """ Return the collate function padding batches of this dataset as a property """
+        return self._collator
+
     def __len__(self) -> int:
         """ Return the total number of samples in the dataset """
-        return len(self._features)
+        return len(self._labels)
 
-    def __getitem__(self, index: Union[int, slice]) -> tuple[Tensor, Tensor]:
-        """ Return a single (feature, label) pair or a batch via slice """
+    def __getitem__(self, index: Union[int, slice]) -> tuple[Tensor, ...]:
+        """ Return a single (sequence, label) pair or a padded (features, labels, lengths) batch via slice """
         if isinstance(index, slice):
             # Return a batch (for example dataset[:5])
-            return self._features[index], self._labels[index]
+            return self._collator([self[i] for i in range(*index.indices(len(self)))])
         elif isinstance(index, int):
-            # Return a single sample
-            return self._features[index], self._labels[index]
+            # Return a single sample, unpadded
+            seq = asarray(self._sequences[index][:self._length], dtype=np_int64)
+            return from_numpy(seq), self._labels[index]
         else:
             raise TypeError(f"Invalid index type: {type(index)}")
 
     def __repr__(self):
         """ Return a string representation of the dataset """
-        return f"SequentialTorchDataset(features={self._features.shape}, labels={self._labels.shape}, device={self._features.device})"
+        return f"SeqClassificationTorchDataset(samples={len(self)}, max_len={self._length}, labels={self._labels.shape})"
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/28 14:05
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   archive.py
+# @Desc     :   
+
+from numpy import ndarray, frombuffer, asarray, zeros, cumsum, int64, uint8
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence
+
+from utils.decorator import timer
+from utils.store import MappedArrays, save_arrays
+
+MAGIC: bytes = b"IMDBPACK"
+VERSION: int = 1
+
+
+class PackedTexts(Sequence):
+    """ Lazily decoded texts backed by a contiguous UTF-8 blob and an offsets index """
+
+    def __init__(self, blob: ndarray, offsets: ndarray) -> None:
+        """ Initialise the PackedTexts class
+        :param blob: the UTF-8 bytes of all texts one after another
+        :param offsets: the start position of each text followed by the blob size
+        """
+        self._blob: ndarray = blob
+        self._offsets: ndarray = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        """ Decode a single text """
+        if not isinstance(index, int):
+            raise TypeError(f"Invalid index type: {type(index)}")
+        if index < 0:
+            index += len(self)
+        return self._blob[self._offsets[index]:self._offsets[index + 1]].tobytes().decode("utf-8")
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"PackedTexts(texts={len(self)}, bytes={len(self._blob)})"
+
+
+class PackedCorpus:
+    """ Zero-copy reader of a packed corpus archive """
+
+    def __init__(self, filepath: str | Path) -> None:
+        """ Initialise the PackedCorpus class
+        :param filepath: path to the archive
+        """
+        self._filepath: Path = Path(filepath)
+        self._arrays: MappedArrays = MappedArrays(self._filepath, MAGIC, VERSION)
+
+    @property
+    def splits(self) -> list[str]:
+        return self._arrays.meta["splits"]
+
+    def read(self, split: str, base: str | Path | None = None) -> dict:
+        """ Read a split of the archive
+        :param split: the split name, e.g. 'train' or 'test'
+        :param base: the directory the file paths are resolved against, defaults to the split directory
+        :return: file paths, lazily decoded contents, and ids, ratings and labels as NumPy arrays
+        """
+        if split not in self:
+            raise KeyError(f"The split {split!r} is not in {self._filepath}.")
+        base = Path(base) if base is not None else self._filepath.parent / split
+        names: PackedTexts = PackedTexts(self._arrays[f"{split}/path_blob"], self._arrays[f"{split}/path_offsets"])
+
+        return {
+            "paths": [str(base / name) for name in names],
+            "ids": self._arrays[f"{split}/ids"],
+            "contents": PackedTexts(self._arrays[f"{split}/blob"], self._arrays[f"{split}/offsets"]),
+            "ratings": self._arrays[f"{split}/ratings"],
+            "labels": self._arrays[f"{split}/labels"],
+        }
+
+    def __contains__(self, split: str) -> bool:
+        return split in self.splits
+
+    def __repr__(self) -> str:
+        return f"PackedCorpus(filepath={str(self._filepath)!r}, splits={self.splits})"
+
+
+def encode_blob(texts: Iterable[str]) -> tuple[ndarray, ndarray]:
+    """ Encode texts into a contiguous UTF-8 blob
+    :param texts: the texts to encode
+    :return: the blob and the offsets index
+    """
+    encoded: list[bytes] = [text.encode("utf-8") for text in texts]
+    offsets: ndarray = zeros(len(encoded) + 1, dtype=int64)
+    cumsum([len(item) for item in encoded], out=offsets[1:])
+    return frombuffer(b"".join(encoded), dtype=uint8), offsets
+
+
+@timer
+def pack_corpus(splits: dict[str, dict], filepath: str | Path) -> None:
+    """ Write loaded splits into a packed corpus archive
+    :param splits: the split names mapped to the data returned by load_text_data_in_dir
+    :param filepath: path to the archive
+    """
+
+    def arrays() -> Iterator[tuple[str, ndarray]]:
+        """ Encode the splits one at a time """
+        for split, data in splits.items():
+            base: Path = Path(data["paths"][0]).parent.parent if data["paths"] else Path(split)
+            blob, offsets = encode_blob(data["contents"])
+            yield f"{split}/blob", blob
+            yield f"{split}/offsets", offsets
+            path_blob, path_offsets = encode_blob(Path(path).relative_to(base).as_posix() for path in data["paths"])
+            yield f"{split}/path_blob", path_blob
+            yield f"{split}/path_offsets", path_offsets
+            yield f"{split}/ids", asarray(data["ids"], dtype=int64)
+            yield f"{split}/ratings", asarray(data["ratings"], dtype=int64)
+            yield f"{split}/labels", asarray(data["labels"], dtype=int64)
+            print(f"Packed {len(offsets) - 1} texts ({len(blob) / 1024 ** 2:.1f} MB) of the {split!r} split.")
+
+    save_arrays(filepath, MAGIC, arrays(), {"splits": list(splits)}, VERSION)
+
+    print(f"The packed corpus archive has been saved to {filepath}")
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/28 10:40
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   cache.py
+# @Desc     :   
+
+from collections import OrderedDict
+from hashlib import blake2b
+from json import load, dump, dumps
+from math import inf
+from numpy import ndarray, array, asarray, frombuffer, int32, float32
+from os import replace
+from pathlib import Path
+from sqlite3 import Connection, connect
+from time import time
+
+from utils.store import RaggedArray, RaggedWriter
+
+
+class TokenCache:
+    """ Persistent token cache keyed by file path, content hash and tokeniser config """
+
+    def __init__(self, directory: str | Path, config: dict) -> None:
+        """ Initialise the TokenCache class
+        :param directory: the root directory of the token caches
+        :param config: the tokeniser config, each config owns a separate cache
+        """
+        self._config: dict = config
+        self._directory: Path = Path(directory) / self.digest(dumps(config, sort_keys=True))
+        # Cached entries, path -> (content hash, row in the token store)
+        self._entries: dict[str, tuple[str, int]] = {}
+        self._lexicon: list[str] = []
+        self._word2id: dict[str, int] = {}
+        self._words: ndarray = array([], dtype=object)
+        self._tokens: RaggedArray | None = None
+        # Entries added in this run, path -> (content hash, row in the token store), their rows go straight to disk
+        self._new: dict[str, tuple[str, int]] = {}
+        self._writer: RaggedWriter | None = None
+        self._hits: int = 0
+        self._misses: int = 0
+
+        self._load()
+
+    @staticmethod
+    def digest(content: str) -> str:
+        """ Hash a text content
+        :param content: the text content
+        :return: the hex digest of the content
+        """
+        return blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+    def _load(self) -> None:
+        """ Load the cache index and memory-map the token store if they exist """
+        index_path: Path = self._directory / "index.json"
+        if not index_path.exists() or not RaggedArray.exists(self._directory / "tokens"):
+            print(f"No token cache found in {self._directory}, a new one will be created.")
+            return
+
+        with open(index_path, "r", encoding="utf-8") as file:
+            index: dict = load(file)
+        tokens: RaggedArray = RaggedArray.load(self._directory / "tokens")
+        # Rows appended after the index was written are ignored, the cache is discarded if rows are missing
+        if index["rows"] > len(tokens):
+            print(f"The token cache in {self._directory} is inconsistent and has been discarded.")
+            return
+
+        self._entries = {path: (digest, row) for path, (digest, row) in index["entries"].items()}
+        self._lexicon = index["lexicon"]
+        self._word2id = {word: idx for idx, word in enumerate(self._lexicon)}
+        self._words = array(self._lexicon, dtype=object)
+        self._tokens = tokens
+
+        print(f"Token cache loaded {len(self._entries)} entries from {self._directory}")
+
+    @property
+    def config(self) -> dict:
+        return self._config
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    def get(self, path: str, digest: str) -> list[str] | None:
+        """ Get the cached tokens of a file
+        :param path: the file path
+        :param digest: the hash of the current file content
+        :return: the cached tokens, or None if the file is new or has changed
+        """
+        if path in self._entries and self._entries[path][0] == digest:
+            self._hits += 1
+            return self._words[self._tokens[self._entries[path][1]]].tolist()
+
+        self._misses += 1
+        return None
+
+    def put(self, path: str, digest: str, words: list[str]) -> None:
+        """ Add the tokens of a file to the cache
+        :param path: the file path
+        :param digest: the hash of the file content
+        :param words: the tokens of the file
+        """
+        ids: list[int] = []
+        for word in words:
+            if word not in self._word2id:
+                self._word2id[word] = len(self._lexicon)
+                self._lexicon.append(word)
+            ids.append(self._word2id[word])
+        # The rows are appended after the stored ones, so a cold cache never holds the tokenised corpus in memory
+        if self._writer is None:
+            self._writer = RaggedWriter(self._directory / "tokens", int32, is_appended=True)
+        self._new[path] = (digest, self._writer.rows)
+        self._writer.append(ids)
+
+    def flush(self) -> None:
+        """ Commit the appended rows and write the index, the stored rows are not rewritten """
+        if self._writer is None:
+            return
+
+        # The rows of the changed files stay unreferenced in the token store
+        self._writer.close()
+        rows: int = self._writer.rows
+        entries: dict[str, list] = {path: [digest, row] for path, (digest, row) in self._entries.items()}
+        entries.update((path, [digest, row]) for path, (digest, row) in self._new.items())
+
+        index_path: Path = self._directory / "index.json"
+        with open(f"{index_path}.tmp", "w", encoding="utf-8") as file:
+            dump({"config": self._config, "rows": rows, "lexicon": self._lexicon, "entries": entries}, file)
+        replace(f"{index_path}.tmp", index_path)
+
+        print(f"Token cache saved {len(entries)} entries ({len(self._new)} new) to {self._directory}")
+
+        self._new = {}
+        self._writer = None
+        self._load()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+        print(f"Token cache hits: {self._hits}, misses: {self._misses}")
+
+    def __repr__(self) -> str:
+        return f"TokenCache(directory={str(self._directory)!r}, entries={len(self._entries)}, new={len(self._new)})"
+
+
+class PredictionCache:
+    """ LRU cache of class probabilities keyed by the hash of an encoded review, with an optional TTL and disk spill
+
+    The cache is not thread-safe, the predictor uses it from a single thread.
+    """
+
+    # Approximate bytes taken by an entry besides its probabilities: the key, the tuple, the slot and the array header
+    ENTRY_OVERHEAD: int = 256
+
+    def __init__(
+            self, max_bytes: int = 64 << 20, ttl: float | None = None,
+            directory: str | Path | None = None, namespace: str = "", commit_every: int = 1024
+    ) -> None:
+        """ Initialise the PredictionCache class
+        :param max_bytes: the memory budget of the entries, the least recently used ones are evicted beyond it
+        :param ttl: the seconds an entry stays valid, forever if None
+        :param directory: the directory evicted entries are spilled to, nothing is spilled if None
+        :param namespace: the model and vocabulary the predictions belong to, each namespace owns a separate spill
+        :param commit_every: the spilled entries per commit, a crash loses at most this many
+        """
+        self._max_bytes: int = max_bytes
+        self._ttl: float | None = ttl
+        self._entries: OrderedDict[bytes, tuple[ndarray, float]] = OrderedDict()
+        self._bytes: int = 0
+        self._hits: int = 0
+        self._misses: int = 0
+        self._spill_hits: int = 0
+        self._evictions: int = 0
+
+        self._db: Connection | None = None
+        self._commit_every: int = max(1, commit_every)
+        self._uncommitted: int = 0
+        if directory is not None:
+            directory = Path(directory)
+            directory.mkdir(parents=True, exist_ok=True)
+            self._db = connect(directory / f"{TokenCache.digest(namespace)}.sqlite", check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS predictions (key BLOB PRIMARY KEY, probabilities BLOB, expires REAL)"
+            )
+
+    @staticmethod
+    def key(ids: ndarray) -> bytes:
+        """ Hash an encoded review, reviews differing only in whitespace or dropped tokens share a key
+        :param ids: the word ids of the review as fed to the model
+        :return: the key of the review
+        """
+        return blake2b(asarray(ids, dtype=int32).tobytes(), digest_size=16).digest()
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def evictions(self) -> int:
+        return self._evictions
+
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
+
+    @property
+    def stats(self) -> dict:
+        """ Return the counters and the memory usage """
+        lookups: int = self._hits + self._misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            "spill_hits": self._spill_hits,
+            "evictions": self._evictions,
+        }
+
+    def _add(self, key: bytes, probabilities: ndarray, expires: float) -> None:
+        """ Insert an entry as the most recently used one and evict beyond the memory budget """
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[0].nbytes + self.ENTRY_OVERHEAD
+        self._entries[key] = (probabilities, expires)
+        self._bytes += probabilities.nbytes + self.ENTRY_OVERHEAD
+
+        while self._bytes > self._max_bytes and self._entries:
+            evicted, (probs, until) = self._entries.popitem(last=False)
+            self._bytes -= probs.nbytes + self.ENTRY_OVERHEAD
+            self._evictions += 1
+            self._spill(evicted, probs, until)
+
+    def _spill(self, key: bytes, probabilities: ndarray, expires: float) -> None:
+        """ Write an entry to the disk spill, if any """
+        if self._db is not None and expires > time():
+            self._db.execute(
+                "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?)",
+                (key, probabilities.tobytes(), None if expires == inf else expires)
+            )
+            self._uncommitted += 1
+            if self._uncommitted >= self._commit_every:
+                self._db.commit()
+                self._uncommitted = 0
+
+    def get(self, key: bytes) -> ndarray | None:
+        """ Look up the probabilities of a review, in memory first and then in the disk spill
+        :param key: the key of the review
+        :return: the class probabilities, or None on a miss
+        """
+        if key in self._entries:
+            probabilities, expires = self._entries[key]
+            if expires > time():
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return probabilities
+            self._bytes -= self._entries.pop(key)[0].nbytes + self.ENTRY_OVERHEAD
+
+        if self._db is not None:
+            row = self._db.execute(
+                "SELECT probabilities, expires FROM predictions WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                (key, time())
+            ).fetchone()
+            if row is not None:
+                probabilities: ndarray = frombuffer(row[0], dtype=float32)
+                self._add(key, probabilities, inf if row[1] is None else row[1])
+                self._hits += 1
+                self._spill_hits += 1
+                return probabilities
+
+        self._misses += 1
+        return None
+
+    def put(self, key: bytes, probabilities: ndarray) -> None:
+        """ Cache the probabilities of a review
+        :param key: the key of the review
+        :param probabilities: the class probabilities
+        """
+        expires: float = inf if self._ttl is None else time() + self._ttl
+        self._add(key, asarray(probabilities, dtype=float32).copy(), expires)
+
+    def flush(self) -> None:
+        """ Spill the entries held in memory and drop the expired ones, so a restart starts warm """
+        if self._db is None:
+            return
+        for key, (probabilities, expires) in self._entries.items():
+            self._spill(key, probabilities, expires)
+        self._db.execute("DELETE FROM predictions WHERE expires IS NOT NULL AND expires <= ?", (time(),))
+        self._db.commit()
+        self._uncommitted = 0
+
+    def clear(self) -> None:
+        """ Drop every entry, in memory and on disk """
+        self._entries.clear()
+        self._bytes = 0
+        if self._db is not None:
+            self._db.execute("DELETE FROM predictions")
+            self._db.commit()
+            self._uncommitted = 0
+
+    def close(self) -> None:
+        """ Flush and close the disk spill """
+        self.flush()
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return (f"PredictionCache(entries={len(self._entries)}, bytes={self._bytes}, hits={self._hits}, "
+                f"misses={self._misses}, spilled={self._db is not None})")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/30 10:15
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   checkpoint.py
+# @Desc     :   
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from os import replace
+from pathlib import Path
+from torch import save, load, Tensor
+from typing import Any, Callable
+
+
+def snapshot(state: Any) -> Any:
+    """ Copy the tensors of a nested state to the CPU, so training can go on while the copy is written
+    :param state: the state, e.g. a state_dict, with tensors nested in dicts, lists and tuples
+    :return: the state with every tensor detached and copied to the CPU
+    """
+    if isinstance(state, Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: snapshot(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return state
+
+
+class CheckpointWriter:
+    """ Write checkpoints in a background thread, each file is moved into place once fully written """
+
+    def __init__(self) -> None:
+        """ Initialise the CheckpointWriter class """
+        # A single thread keeps the writes in order
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._pending: list[Future] = []
+
+    @staticmethod
+    def _write(state: Any, filepath: Path) -> None:
+        """ Write a state to a temporary file and rename it over the target """
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        save(state, f"{filepath}.tmp")
+        replace(f"{filepath}.tmp", filepath)
+
+    def save(self, state: Any, filepath: str | Path) -> Future:
+        """ Snapshot a state and write it asynchronously
+        :param state: the state to save
+        :param filepath: path to the checkpoint file
+        :return: the future of the write
+        """
+        return self.submit(self._write, snapshot(state), Path(filepath))
+
+    def submit(self, function: Callable, *args: Any) -> Future:
+        """ Run a function in the writer thread once the writes submitted before it are done
+        :param function: the function to run, e.g. saving the files paired with a checkpoint
+        :param args: the arguments of the function
+        :return: the future of the call
+        """
+        # Raise the errors of earlier writes instead of losing them
+        for future in [future for future in self._pending if future.done()]:
+            future.result()
+            self._pending.remove(future)
+        future: Future = self._executor.submit(function, *args)
+        self._pending.append(future)
+        return future
+
+    @staticmethod
+    def load(filepath: str | Path, map_location: str = "cpu") -> Any:
+        """ Load a checkpoint written by the writer
+        :param filepath: path to the checkpoint file
+        :param map_location: the device the tensors are loaded onto
+        :return: the saved state
+        """
+        # The checkpoint holds the Python and NumPy RNG states, which are not plain tensors
+        return load(filepath, map_location=map_location, weights_only=False)
+
+    def wait(self) -> None:
+        """ Block until all pending writes are done """
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self) -> None:
+        """ Finish the pending writes and stop the thread """
+        self.wait()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"CheckpointWriter(pending={sum(not future.done() for future in self._pending)})"
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/31 16:40
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   compiled.py
+# @Desc     :   
+
+from json import dumps, loads
+from os import replace
+from pathlib import Path
+from torch import nn, jit, device, randint, tensor, inference_mode, allclose, int64, Tensor
+from zipfile import ZipFile, is_zipfile
+
+FORMAT: str = "imdb-rnn-torchscript"
+VERSION: int = 1
+META: str = "model.json"
+
+
+def compile_model(model: nn.Module, filepath: str | Path) -> None:
+    """ Trace a float32 model into a frozen TorchScript program, batch size and sequence length stay dynamic
+    :param model: the model, called as model(X, lengths)
+    :param filepath: path to the compiled artifact
+    """
+    model = model.cpu().eval()
+    vocab_size: int = model.config["vocab_size"]
+    example: tuple[Tensor, Tensor] = randint(1, vocab_size, (2, 8), dtype=int64), tensor([8, 3], dtype=int64)
+    with inference_mode():
+        program = jit.freeze(jit.trace(model, example))
+
+        # A trace records one run, make sure no shape of the example was baked into the program
+        check: tuple[Tensor, Tensor] = randint(1, vocab_size, (5, 17), dtype=int64), tensor([17, 1, 9, 17, 4])
+        if not allclose(program(*check), model(*check), atol=1e-5):
+            raise RuntimeError("The traced program does not generalise to other batch sizes and sequence lengths.")
+
+    meta: dict = {"format": FORMAT, "version": VERSION, "config": model.config}
+    jit.save(program, f"{filepath}.tmp", _extra_files={META: dumps(meta)})
+    replace(f"{filepath}.tmp", filepath)
+
+    print(f"The compiled model has been saved to {filepath}")
+
+
+def is_compiled(filepath: str | Path) -> bool:
+    """ Check whether a file is a compiled artifact written by compile_model
+    :param filepath: path to the model file
+    :return: True if the archive holds the compiled model metadata
+    """
+    if not is_zipfile(filepath):
+        return False
+    with ZipFile(filepath) as archive:
+        return any(name.endswith(f"/extra/{META}") for name in archive.namelist())
+
+
+class CompiledModel:
+    """ Compiled inference program, it runs without the Python model class """
+
+    def __init__(self, program: jit.ScriptModule, config: dict) -> None:
+        """ Initialise the CompiledModel class
+        :param program: the frozen TorchScript program
+        :param config: the sizes the model was built from
+        """
+        self._program: jit.ScriptModule = program
+        self._config: dict = config
+
+    @property
+    def config(self) -> dict:
+        return self._config
+
+    @property
+    def num_classes(self) -> int:
+        return self._config["num_classes"]
+
+    def __call__(self, X: Tensor, lengths: Tensor) -> Tensor:
+        """ Classify a padded batch
+        :param X: the word ids, shape (batch_size, sequence_length)
+        :param lengths: the true length of each sequence, shape (batch_size,)
+        :return: the logits, shape (batch_size, num_classes)
+        """
+        return self._program(X, lengths)
+
+    def __repr__(self) -> str:
+        return f"CompiledModel(config={self._config})"
+
+
+def load_compiled(filepath: str | Path, map_location: str | device = "cpu") -> CompiledModel:
+    """ Load a compiled artifact written by compile_model
+    :param filepath: path to the compiled artifact
+    :param map_location: the device the program is loaded onto
+    :return: the compiled model
+    """
+    extra: dict = {META: ""}
+    program: jit.ScriptModule = jit.load(filepath, map_location=map_location, _extra_files=extra)
+    meta: dict = loads(extra[META] or "{}")
+    if meta.get("format") != FORMAT:
+        raise ValueError(f"{filepath} is not a {FORMAT} artifact.")
+    if meta["version"] != VERSION:
+        raise ValueError(f"Unsupported {FORMAT} version {meta["version"]} in {filepath}.")
+
+    return CompiledModel(program, meta["config"])
@@ -7,6 +7,7 @@
 # @Desc     :   
 
 from dataclasses import dataclass, field
+from os import cpu_count
 from pathlib import Path
 from torch import cuda
 
@@ -16,12 +17,24 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 @dataclass
 class FilePaths:
     MODEL: Path = BASE_DIR / "models/model.pth"
+    CHECKPOINT: Path = BASE_DIR / "models/checkpoint.pt"
+    QUANTISED_MODEL: Path = BASE_DIR / "models/model.int8.pth"
+    COMPILED_MODEL: Path = BASE_DIR / "models/model.torchscript.pt"
     SPACY_EN_MODEL = BASE_DIR / "models/spacy/en_core_web_md"
     SPACY_ZH_MODEL = BASE_DIR / "models/spacy/zh_core_web_md"
     STANZA_MODEL = BASE_DIR / "models/stanza"
     DATASET_TRAIN = BASE_DIR / "data/train/"
     DATASET_TEST = BASE_DIR / "data/test/"
+    DATASET_PACK = BASE_DIR / "data/imdb.pack"
     DICTIONARY = BASE_DIR / "data/dictionary.json"
+    VOCABULARY = BASE_DIR / "data/vocabulary.bin"
+    FREQUENCY_STORE = BASE_DIR / "data/frequency.bin"
+    SUBWORD_TOKENISER = BASE_DIR / "models/subword.json"
+    TOKEN_CACHE = BASE_DIR / "data/cache/tokens"
+    TOKEN_SPOOL = BASE_DIR / "data/cache/spool"
+    ID_STORE = BASE_DIR / "data/cache/ids"
+    PENDING_FREQUENCY_STORE = BASE_DIR / "data/cache/frequency.bin"
+    PREDICTION_CACHE = BASE_DIR / "data/cache/predictions"
 
 
 @dataclass
@@ -31,6 +44,31 @@ class DataPreprocessor:
     VALID_SIZE: float = 0.7
     IS_SHUFFLE: bool = True
     BATCH_SIZE: int = 32
+    TOKENISER_BATCH_SIZE: int = 256
+    TOKENISER_WORKERS: int = cpu_count() or 1
+    TOKENISER_CHUNK_SIZE: int = 512
+    TOKENISER_BACKEND: str = "spacy"
+    SUBWORD_MODEL: str = "bpe"
+    SUBWORD_VOCAB_SIZE: int = 16000
+    SUBWORD_MIN_FREQUENCY: int = 2
+    IS_TOKEN_CACHED: bool = True
+    IS_VOCAB_INCREMENTAL: bool = True
+    PIPELINE_CHUNK_SIZE: int = 16384
+    LOADER_WORKERS: int = 16
+    LOADER_QUEUE_SIZE: int = 256
+    IS_BUCKETED: bool = True
+    BUCKET_BOUNDARIES: tuple[int, ...] = (64, 128, 192, 256, 384, 512, 768, 1024, 1536)
+    DATALOADER_WORKERS: int | None = None
+    IS_PIN_MEMORY: bool | None = None
+    PREFETCH_FACTOR: int = 2
+    IS_PERSISTENT_WORKERS: bool = True
+    PREDICT_BATCH_SIZE: int = 256
+    PREDICT_CHUNK_SIZE: int = 4096
+    INFERENCE_CHUNK_LEN: int | None = 2048
+    IS_PREDICTION_CACHED: bool = True
+    PREDICTION_CACHE_MB: int = 64
+    PREDICTION_CACHE_TTL: float | None = None
+    IS_PREDICTION_SPILLED: bool = False
 
 
 @dataclass
@@ -41,6 +79,7 @@ class ModelParameters:
     RNN_HIDDEN_SIZE: int = 128
     RNN_LAYERS: int = 2
     RNN_TEMPERATURE: float = 1.0
+    QUANTISED_EMBEDDING: str = "fp16"
 
 
 @dataclass
@@ -48,6 +87,28 @@ class Hyperparameters:
     ALPHA: float = 1e-3
     EPOCHS: int = 50
     ACCELERATOR: str = "cuda" if cuda.is_available() else "cpu"
+    PRECISION: str = "fp32"
+    SYNC_STEPS: int = 0
+    ACCUMULATION_STEPS: int = 1
+    IS_LR_SCALED: bool = False
+    BACKEND: str = "gloo"
+
+
+@dataclass
+class CPUProfile:
+    IS_ENABLED: bool = True
+    THREADS: int | None = None
+    INTEROP_THREADS: int | None = None
+    IS_PINNED: bool = True
+
+
+@dataclass
+class ServerParameters:
+    HOST: str = "127.0.0.1"
+    PORT: int = 8000
+    MAX_BATCH_SIZE: int = 64
+    MAX_WAIT_MS: float = 5.0
+    MAX_BODY_BYTES: int = 1 << 20
 
 
 @dataclass
@@ -56,6 +117,8 @@ class Configration:
     PREPROCESSOR: DataPreprocessor = field(default_factory=DataPreprocessor)
     PARAMETERS: ModelParameters = field(default_factory=ModelParameters)
     HYPERPARAMETERS: Hyperparameters = field(default_factory=Hyperparameters)
+    CPU: CPUProfile = field(default_factory=CPUProfile)
+    SERVER: ServerParameters = field(default_factory=ServerParameters)
 
 
 CONFIG = Configration()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/30 15:30
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   distributed.py
+# @Desc     :   
+
+from os import environ
+from torch import distributed as dist
+
+
+class TorchDistributed:
+    """ Set up the process group of a run launched by torchrun, a no-op for a single process """
+
+    def __init__(self, backend: str = "gloo") -> None:
+        """ Initialise the TorchDistributed class
+        :param backend: the torch.distributed backend, gloo runs on CPUs
+        """
+        self._backend: str = backend
+        # torchrun passes the topology through the environment
+        self._rank: int = int(environ.get("RANK", 0))
+        self._local_rank: int = int(environ.get("LOCAL_RANK", 0))
+        self._world_size: int = int(environ.get("WORLD_SIZE", 1))
+        self._is_owner: bool = False
+
+    def __enter__(self):
+        """ Join the process group """
+        if self.is_enabled and not dist.is_initialized():
+            dist.init_process_group(self._backend, rank=self._rank, world_size=self._world_size)
+            self._is_owner = True
+
+            print(f"Rank {self._rank}/{self._world_size} joined the {self._backend!r} process group.")
+
+        return self
+
+    def __exit__(self, *args):
+        """ Leave the process group """
+        if self._is_owner:
+            dist.destroy_process_group()
+            self._is_owner = False
+
+    @property
+    def rank(self) -> int:
+        return self._rank
+
+    @property
+    def local_rank(self) -> int:
+        return self._local_rank
+
+    @property
+    def world_size(self) -> int:
+        return self._world_size
+
+    @property
+    def is_enabled(self) -> bool:
+        return self._world_size > 1
+
+    @property
+    def is_main(self) -> bool:
+        return self._rank == 0
+
+    def barrier(self) -> None:
+        """ Wait for every process of the group """
+        if self.is_enabled and dist.is_initialized():
+            dist.barrier()
+
+    def __repr__(self) -> str:
+        return f"TorchDistributed(backend={self._backend!r}, rank={self._rank}, world_size={self._world_size})"
+
+
+def get_world() -> tuple[int, int]:
+    """ Get the rank of this process and the number of processes of the initialised process group
+    :return: the rank and the world size, (0, 1) without a process group
+    """
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
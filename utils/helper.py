@@ -6,13 +6,19 @@
 # @File     :   helper.py
 # @Desc     :   
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
 from json import load, dump
+from numpy import array, int64
+from os import scandir
 from random import seed as rnd_seed, getstate, setstate
 from pathlib import Path
 from pandas import DataFrame, read_csv
 from time import perf_counter
 from tqdm import tqdm
+from typing import Iterator, Sequence
 
+from utils.archive import PackedCorpus
 from utils.decorator import timer
 
 LENGTH: int = 50
@@ -172,38 +178,126 @@ def save_json(json_data: dict, json_path: str | Path) -> None:
         dump(json_data, file, indent=2)
 
 
+def _read_text(file_path: str) -> str:
+    """ Read and strip the content of a text file
+    :param file_path: path to the file
+    :return: content read from the file
+    """
+    with open(file_path, "r", encoding="utf-8") as file:
+        return file.read().strip()
+
+
+class TextFiles(Sequence):
+    """ Lazily read text files, iterating reads them ahead with a thread pool """
+
+    def __init__(self, paths: list[str], workers: int = 16, queue_size: int = 256) -> None:
+        """ Initialise the TextFiles class
+        :param paths: paths to the text files
+        :param workers: number of threads reading the files concurrently
+        :param queue_size: maximum number of file reads in flight
+        """
+        self._paths: list[str] = paths
+        self._workers: int = workers
+        self._queue: int = queue_size
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def __getitem__(self, index: int) -> str:
+        """ Read a single file """
+        if not isinstance(index, int):
+            raise TypeError(f"Invalid index type: {type(index)}")
+        return _read_text(self._paths[index])
+
+    def __iter__(self) -> Iterator[str]:
+        """ Read the files with a thread pool, keeping a bounded number of reads in flight """
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            pending: deque[Future] = deque()
+            for path in self._paths:
+                pending.append(executor.submit(_read_text, path))
+                if len(pending) >= self._queue:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def __repr__(self) -> str:
+        return f"TextFiles(files={len(self._paths)}, workers={self._workers}, queue_size={self._queue})"
+
+
+def _is_archive_stale(base: Path, archive: Path) -> bool:
+    """ Check whether a directory has been modified after its archive was packed
+    :param base: path to the directory
+    :param archive: path to the archive
+    :return: True if files were added to, removed from or edited in the directory after packing
+    """
+    if not base.exists():
+        return False
+    packed: float = archive.stat().st_mtime
+    for directory in [base, *(path for path in base.iterdir() if path.is_dir())]:
+        # Adding or removing a file touches its directory, editing it in place only touches the file
+        if directory.stat().st_mtime > packed:
+            return True
+        with scandir(directory) as entries:
+            if any(entry.is_file() and entry.stat().st_mtime > packed for entry in entries):
+                return True
+    return False
+
+
 @timer
-def load_text_data_in_dir(filepath: str | Path):
+def load_text_data_in_dir(
+        filepath: str | Path, workers: int = 16, queue_size: int = 256,
+        archive: str | Path | None = None, is_streamed: bool = False
+) -> dict:
     """ Load text data from a directory
     :param filepath: path to the directory
-    :return: concatenated text data from all files in the directory
+    :param workers: number of threads reading the files concurrently
+    :param queue_size: maximum number of file reads in flight
+    :param archive: path to the packed archive read instead of the directory if it is up to date, never read if None
+    :param is_streamed: whether to return the contents as a lazy sequence instead of reading them all
+    :return: file paths and contents as sequences, ids, ratings and labels as NumPy arrays
     """
-    data: dict[str, list] = {
-        "ids": [],
-        "contents": [],
-        "ratings": [],
-        "labels": [],
-    }
+    paths: list[str] = []
+    labels: list[int] = []
     base: Path = Path(filepath)
+
+    # Read the packed archive instead of the individual files if it is up to date
+    archive: Path | None = Path(archive) if archive is not None else None
+    if archive is not None and archive.exists():
+        if _is_archive_stale(base, archive):
+            print(f"The archive {archive} is older than the directory {filepath} and has been ignored.")
+        else:
+            corpus = PackedCorpus(archive)
+            if base.name in corpus:
+                data: dict = corpus.read(base.name, base)
+                print(f"Loaded {len(data["ids"])} text files from archive: {archive}")
+                return data
+
     if base.exists():
-        for subdir in base.iterdir():
-            if subdir.name == "pos":
-                label: int = 1
-            else:
-                label: int = 0
+        # List the directory once, the files are read in a stable order
+        for subdir in sorted(base.iterdir()):
             if subdir.is_dir():
-                for file in tqdm(subdir.iterdir(), total=12500, desc=f"Processing {subdir.name} in {base.name}"):
-                    if file.suffix == ".txt":
-                        with open(str(file), "r", encoding="utf-8") as f:
-                            content: str = f.read().strip()
-                        names: list[str] = file.stem.split("_")
-                        data["ids"].append(int(names[0]))
-                        data["contents"].append(str(content))
-                        data["ratings"].append(int(names[1]))
-                        data["labels"].append(int(label))
-
-        print(f"Loaded {len(data["ids"])} text files from directory: {filepath}")
+                label: int = 1 if subdir.name == "pos" else 0
+                with scandir(subdir) as entries:
+                    names: list[str] = sorted(entry.name for entry in entries if entry.name.endswith(".txt"))
+                paths.extend(str(subdir / name) for name in names)
+                labels.extend([label] * len(names))
     else:
         print(f"The directory {filepath} does not exist.")
 
+    contents: TextFiles | list[str] = TextFiles(paths, workers, queue_size)
+    if not is_streamed:
+        contents = list(tqdm(contents, total=len(paths), desc=f"Loading files in {base.name}"))
+
+    stems: list[list[str]] = [Path(path).stem.split("_") for path in paths]
+    data: dict = {
+        "paths": paths,
+        "ids": array([int(names[0]) for names in stems], dtype=int64),
+        "contents": contents,
+        "ratings": array([int(names[1]) for names in stems], dtype=int64),
+        "labels": array(labels, dtype=int64),
+    }
+
+    if paths:
+        print(f"{"Listed" if is_streamed else "Loaded"} {len(data["ids"])} text files from directory: {filepath}")
+
     return data
@@ -6,7 +6,8 @@
 # @File     :   models.py
 # @Desc     :   
 
-from torch import nn, relu, cat
+from torch import nn, relu, cat, lstm, zeros, no_grad, is_autocast_enabled, get_autocast_dtype, Tensor
+from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
 from torchsummary import summary
 
 
@@ -39,6 +40,50 @@ class RNNClassificationTorchModel(nn.Module):
 
         self._init_params()
 
+    @classmethod
+    def from_state_dict(cls, state: dict, dropout_rate: float = 0.3) -> "RNNClassificationTorchModel":
+        """ Rebuild a model from its saved parameters, the sizes are read from the parameter shapes
+        :param state: the state_dict of a model
+        :param dropout_rate: dropout rate for regularization, it has no effect on inference
+        :return: the model with the parameters loaded
+        """
+        vocab_size, embedding_dim = state["_embed.weight"].shape
+        model = cls(
+            vocab_size=vocab_size,
+            embedding_dim=embedding_dim,
+            hidden_size=state["_lstm.weight_hh_l0"].shape[1],
+            num_layers=sum(1 for name in state if name.startswith("_lstm.weight_ih_l") and "reverse" not in name),
+            num_classes=state["_classifier.weight"].shape[0],
+            dropout_rate=dropout_rate
+        )
+        model.load_state_dict(state)
+        return model
+
+    def resize_embedding(self, vocab_size: int, init_id: int | None = None) -> None:
+        """ Grow the embedding to an extended vocabulary, the rows of the existing ids are kept
+        :param vocab_size: the size of the extended vocabulary, not smaller than the current one
+        :param init_id: the id whose row the new rows start from, e.g. the unknown token the new words were mapped to
+                        so far, which leaves the predictions unchanged until training, Xavier initialisation if None
+        """
+        if vocab_size < self._L:
+            raise ValueError(f"Cannot shrink the embedding from {self._L} to {vocab_size} rows, ids must stay stable.")
+        if vocab_size == self._L:
+            return
+
+        weight: Tensor = self._embed.weight
+        embed = nn.Embedding(vocab_size, self._N, device=weight.device, dtype=weight.dtype)
+        with no_grad():
+            embed.weight[:self._L] = weight
+            if init_id is None:
+                nn.init.xavier_uniform_(embed.weight[self._L:])
+            else:
+                embed.weight[self._L:] = weight[init_id]
+
+        print(f"The embedding has been resized from {self._L} to {vocab_size} rows.")
+
+        self._embed = embed
+        self._L = vocab_size
+
     def _init_params(self):
         """ Initialize model parameters """
         for name, param in self.named_parameters():
@@ -47,13 +92,19 @@ class RNNClassificationTorchModel(nn.Module):
             elif "bias" in name:
                 nn.init.zeros_(param)
 
-    def forward(self, X):
+    def forward(self, X, lengths: Tensor | None = None):
         """ Forward pass of the model
         :param X: input tensor, shape (batch_size, sequence_length)
+        :param lengths: the true length of each sequence, shape (batch_size,), the padding is skipped if given
         :return: output tensor and new hidden state tensor, shapes (batch_size, sequence_length, vocab_size) and (num_layers, batch_size, hidden_dim)
         """
         out = self._embed(X)
-        _, (hn, _) = self._lstm(out)
+        if lengths is not None:
+            # Pack the batch so both directions start and end on the real tokens, lengths must live on the CPU
+            out = pack_padded_sequence(out, lengths.cpu().clamp(min=1), batch_first=True, enforce_sorted=False)
+            hn = self._run_packed(out)
+        else:
+            _, (hn, _) = self._lstm(out)
 
         forward_hn = hn[-2]  # [batch_size, hidden_size]
         backward_hn = hn[-1]  # [batch_size, hidden_size]
@@ -65,6 +116,127 @@ class RNNClassificationTorchModel(nn.Module):
 
         return out
 
+    def _run_packed(self, packed: PackedSequence) -> Tensor:
+        """ Run the LSTM over a packed batch, in the autocast dtype when autocast is enabled
+        CPU autocast only lowers the padded LSTM, a packed one would stay in float32 whatever the precision mode,
+        so the inputs and the weights are cast here, the gradients still reach the float32 weights.
+        :param packed: the packed embeddings of the batch
+        :return: the final hidden states, shape (num_layers * 2, batch_size, hidden_size)
+        """
+        device_type: str = packed.data.device.type
+        if not is_autocast_enabled(device_type) or not self.is_chunkable:
+            _, (hn, _) = self._lstm(packed)
+            return hn
+
+        dtype = get_autocast_dtype(device_type)
+        weights: list[Tensor] = [weight.to(dtype) for weight in self._lstm._flat_weights]
+        initial: Tensor = zeros(
+            self._C * 2, int(packed.batch_sizes[0]), self._M, dtype=dtype, device=packed.data.device
+        )
+        _, hn, _ = lstm(
+            packed.data.to(dtype), packed.batch_sizes, (initial, initial), weights, True, self._C,
+            self._lstm.dropout, self.training, True
+        )
+        # The batch was sorted by length when packed, restore the input order
+        return hn.index_select(1, packed.unsorted_indices)
+
+    def _run_direction(
+            self, inputs: Tensor, layer: int, is_reverse: bool, state: tuple[Tensor, Tensor]
+    ) -> tuple[Tensor, tuple[Tensor, Tensor]]:
+        """ Run one direction of one LSTM layer over a chunk
+        :param inputs: the inputs of the layer, shape (1, chunk_length, input_size)
+        :param layer: the layer index
+        :param is_reverse: whether to run the backward direction, which reads the chunk from its end
+        :param state: the (h, c) state the direction enters the chunk with, shapes (1, 1, hidden_size)
+        :return: the outputs in time order, shape (1, chunk_length, hidden_size), and the state leaving the chunk
+        """
+        suffix: str = "_reverse" if is_reverse else ""
+        weights: list[Tensor] = [
+            getattr(self._lstm, f"{name}_l{layer}{suffix}") for name in ("weight_ih", "weight_hh", "bias_ih", "bias_hh")
+        ]
+        if is_reverse:
+            inputs = inputs.flip(1)
+        outputs, h, c = lstm(inputs, state, weights, True, 1, 0.0, False, False, True)
+        return (outputs.flip(1) if is_reverse else outputs), (h, c)
+
+    def _chunk_inputs(self, X: Tensor, span: tuple[int, int], layer: int, entering: list) -> Tensor:
+        """ Recompute the inputs of a layer over a chunk from the states the lower layers entered it with
+        :param X: the word ids of the sequence, shape (1, sequence_length)
+        :param span: the start and end of the chunk
+        :param layer: the layer whose inputs are needed
+        :param entering: the (forward, backward) states each lower layer entered this chunk with
+        :return: the inputs of the layer, shape (1, chunk_length, input_size)
+        """
+        out = self._embed(X[:, span[0]:span[1]])
+        for lower in range(layer):
+            forward, _ = self._run_direction(out, lower, False, entering[lower][0])
+            backward, _ = self._run_direction(out, lower, True, entering[lower][1])
+            out = cat([forward, backward], dim=2)
+        return out
+
+    def forward_chunked(self, X: Tensor, chunk_len: int = 1024) -> Tensor:
+        """ Classify a single sequence of any length chunk by chunk, with the same result as forward in evaluation mode
+        Each direction of each layer carries its (h, c) state across the chunks, forwards for the forward direction
+        and backwards for the backward one. Only the states at the chunk boundaries are kept, the outputs of the lower
+        layers are recomputed per chunk, so activations never exceed a chunk. Dropout is not applied.
+        :param X: the word ids of one sequence, shape (sequence_length,) or (1, sequence_length)
+        :param chunk_len: the number of tokens per chunk
+        :return: output tensor, shape (1, num_classes)
+        """
+        X = X.reshape(1, -1)
+        length: int = X.shape[1]
+        if length == 0:
+            raise ValueError("Cannot classify an empty sequence in chunks.")
+        spans: list[tuple[int, int]] = [
+            (start, min(start + chunk_len, length)) for start in range(0, length, chunk_len)
+        ]
+        initial: Tensor = zeros(1, 1, self._M, dtype=self._embed.weight.dtype, device=X.device)
+
+        # entering[k][layer] holds the (forward, backward) states that layer enters chunk k with
+        entering: list[list] = [[] for _ in spans]
+        finals: tuple[Tensor, Tensor] = (initial, initial)
+        for layer in range(self._C):
+            forward_states: list = [None] * len(spans)
+            state: tuple[Tensor, Tensor] = (initial, initial)
+            for k, span in enumerate(spans):
+                forward_states[k] = state
+                _, state = self._run_direction(self._chunk_inputs(X, span, layer, entering[k]), layer, False, state)
+            forward_final: Tensor = state[0]
+
+            backward_states: list = [None] * len(spans)
+            state = (initial, initial)
+            for k in reversed(range(len(spans))):
+                backward_states[k] = state
+                _, state = self._run_direction(self._chunk_inputs(X, spans[k], layer, entering[k]), layer, True, state)
+            finals = (forward_final, state[0])
+
+            for k in range(len(spans)):
+                entering[k].append((forward_states[k], backward_states[k]))
+
+        # The forward direction ends on the last token, the backward one on the first
+        out = cat([finals[0][0], finals[1][0]], dim=1)  # [1, hidden_size*2]
+        return self._classifier(out)
+
+    @property
+    def is_chunkable(self) -> bool:
+        """ Whether forward_chunked can run, the LSTM weights of quantised models are packed """
+        return type(self._lstm) is nn.LSTM
+
+    @property
+    def num_classes(self) -> int:
+        return self._classifier.out_features
+
+    @property
+    def config(self) -> dict:
+        """ Return the sizes the model is built from, the keyword arguments of the constructor """
+        return {
+            "vocab_size": self._L,
+            "embedding_dim": self._N,
+            "hidden_size": self._M,
+            "num_layers": self._C,
+            "num_classes": self.num_classes,
+        }
+
     def summary(self):
         """ Print the model summary """
         print("=" * 64)
@@ -6,12 +6,17 @@
 # @File     :   nlp.py
 # @Desc     :   
 
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, Future
+from itertools import islice
+from json import load as load_json
 from pathlib import Path
 from re import compile, sub
 from pandas import DataFrame
-from spacy import load
+from spacy import load, about
+from spacy.language import Language
 from stanza import Pipeline
+from typing import Iterable, Iterator
 
 from utils.config import CONFIG
 from utils.decorator import timer
@@ -32,15 +37,24 @@ def regular_chinese(words: list[str]) -> list[str]:
     return chinese
 
 
+ENGLISH_WORD = compile(r"^[A-Za-z]+$")
+
+
+def filter_english(words: list[str]) -> list[str]:
+    """ Retain only English words, lower-cased, without logging so it can run once per text in a stream
+    :param words: list of words to process
+    :return: list of words containing only English characters
+    """
+    return [word.lower() for word in words if ENGLISH_WORD.match(word)]
+
+
 @timer
 def regular_english(words: list[str]) -> list[str]:
     """ Retain only English characters in the list of words
     :param words: list of words to process
     :return: list of words containing only English characters
     """
-    pattern = compile(r"^[A-Za-z]+$")
-
-    english: list[str] = [word.lower() for word in words if pattern.match(word)]
+    english: list[str] = filter_english(words)
 
     print(f"Retained {len(english)} English words from the original {len(words)} words.")
 
@@ -48,15 +62,15 @@ def regular_english(words: list[str]) -> list[str]:
 
 
 @timer
-def count_frequency(words: list[str], top_k: int = 10, freq_threshold: int = 3) -> tuple[list, DataFrame]:
+def count_frequency(words: list[str] | Counter, top_k: int = 10, freq_threshold: int = 3) -> tuple[list, DataFrame]:
     """ Get frequency of Chinese words
-    :param words: list of words to process
+    :param words: list of words to process, or a Counter of words already counted
     :param top_k: number of top frequent words to return
     :param freq_threshold: frequency threshold to separate high and low frequency words
     :return: DataFrame containing words and their frequencies
     """
     # Get word frequency using Counter
-    counter = Counter(words)
+    counter = words if isinstance(words, Counter) else Counter(words)
     words_high_freq: list[str] = [word for word, count in counter.most_common() if count > freq_threshold]
     words_low_freq: list[str] = [word for word, count in counter.most_common() if count <= freq_threshold]
 
@@ -111,24 +125,221 @@ def extract_zh_chars(filepath: str | Path, pattern: str = r"[^\u4e00-\u9fa5]") -
     return chars, lines
 
 
+class SpacyTokeniser:
+    """ Batched SpaCy tokeniser loading each language pipeline only once """
+    _MODELS: dict[str, Path] = {
+        "en": CONFIG.FILEPATHS.SPACY_EN_MODEL,
+        "zh": CONFIG.FILEPATHS.SPACY_ZH_MODEL,
+    }
+    _pipelines: dict[tuple[str, tuple[str, ...]], Language] = {}
+
+    def __init__(self, lang: str = "en", batch_size: int = 256, excluded: Iterable[str] = ("parser", "ner")) -> None:
+        """ Initialise the SpacyTokeniser class
+        :param lang: language code for the texts (e.g., 'en' for English, 'zh' for Chinese)
+        :param batch_size: the number of texts buffered by spaCy per batch
+        :param excluded: the pipeline components which are not needed for tokenisation
+        """
+        if lang not in self._MODELS:
+            raise ValueError(f"Unsupported language: {lang}")
+        self._lang: str = lang
+        self._batches: int = batch_size
+        self._excluded: tuple[str, ...] = tuple(excluded)
+        self._nlp: Language = self.load_pipeline(self._lang, self._excluded)
+
+    @classmethod
+    def load_pipeline(cls, lang: str, excluded: tuple[str, ...] = ("parser", "ner")) -> Language:
+        """ Load a SpaCy pipeline once and reuse it for the following calls
+        :param lang: language code for the pipeline
+        :param excluded: the pipeline components which are not loaded
+        :return: the cached SpaCy pipeline
+        """
+        key: tuple[str, tuple[str, ...]] = (lang, excluded)
+        if key not in cls._pipelines:
+            cls._pipelines[key] = load(cls._MODELS[lang], exclude=list(excluded))
+            print(f"The SpaCy {lang!r} pipeline has been loaded with {cls._pipelines[key].pipe_names}.")
+        return cls._pipelines[key]
+
+    @classmethod
+    def describe(cls, lang: str, excluded: tuple[str, ...]) -> dict:
+        """ Describe a pipeline config, used to tell apart the outputs of different tokenisers
+        :param lang: language code for the pipeline
+        :param excluded: the pipeline components which are not loaded
+        :return: the description of the pipeline
+        """
+        meta_path: Path = Path(cls._MODELS[lang]) / "meta.json"
+        meta: dict = {}
+        if meta_path.exists():
+            with open(meta_path, "r", encoding="utf-8") as file:
+                meta = load_json(file)
+
+        return {
+            "backend": "spacy",
+            "spacy": about.__version__,
+            "lang": lang,
+            "model": f"{meta.get("lang", lang)}_{meta.get("name", Path(cls._MODELS[lang]).name)}-{meta.get("version")}",
+            "excluded": list(excluded),
+        }
+
+    @property
+    def lang(self) -> str:
+        return self._lang
+
+    @property
+    def batch_size(self) -> int:
+        return self._batches
+
+    @property
+    def excluded(self) -> tuple[str, ...]:
+        return self._excluded
+
+    @property
+    def config(self) -> dict:
+        return self.describe(self._lang, self._excluded)
+
+    def _words(self, doc) -> list[str]:
+        """ Get the words of a processed document
+        :param doc: the SpaCy document
+        :return: list of lemmas for English, or list of texts for Chinese
+        """
+        if self._lang == "en":
+            return [token.lemma_.lower() for token in doc]
+        return [token.text for token in doc]
+
+    def pipe(self, contents: Iterable[str]) -> Iterator[list[str]]:
+        """ Stream texts through the pipeline in batches
+        :param contents: texts to tokenise
+        :return: iterator of token lists in the same order as the texts
+        """
+        for doc in self._nlp.pipe(contents, batch_size=self._batches):
+            yield self._words(doc)
+
+    def __call__(self, content: str) -> list[str]:
+        """ Tokenise a single text """
+        return self._words(self._nlp(content))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __repr__(self) -> str:
+        return f"SpacyTokeniser(lang={self._lang!r}, batch_size={self._batches}, excluded={self._excluded})"
+
+
+_worker_tokeniser: SpacyTokeniser | None = None
+
+
+def _init_tokeniser_worker(lang: str, batch_size: int, excluded: tuple[str, ...]) -> None:
+    """ Load the SpaCy pipeline once per worker process
+    :param lang: language code for the pipeline
+    :param batch_size: the number of texts buffered by spaCy per batch
+    :param excluded: the pipeline components which are not loaded
+    """
+    global _worker_tokeniser
+    _worker_tokeniser = SpacyTokeniser(lang, batch_size, excluded)
+
+
+def _tokenise_shard(contents: list[str]) -> list[list[str]]:
+    """ Tokenise a shard of texts in a worker process
+    :param contents: texts to tokenise
+    :return: list of token lists in the same order as the texts
+    """
+    return list(_worker_tokeniser.pipe(contents))
+
+
+class SpacyTokeniserPool:
+    """ Multi-process SpaCy tokeniser sharding texts across worker processes """
+
+    def __init__(
+            self,
+            lang: str = "en", workers: int = 2, chunk_size: int = 512,
+            batch_size: int = 256, excluded: Iterable[str] = ("parser", "ner")
+    ) -> None:
+        """ Initialise the SpacyTokeniserPool class
+        :param lang: language code for the texts (e.g., 'en' for English, 'zh' for Chinese)
+        :param workers: the number of worker processes
+        :param chunk_size: the number of texts sent to a worker at a time
+        :param batch_size: the number of texts buffered by spaCy per batch in each worker
+        :param excluded: the pipeline components which are not needed for tokenisation
+        """
+        self._lang: str = lang
+        self._workers: int = workers
+        self._chunks: int = chunk_size
+        self._batches: int = batch_size
+        self._excluded: tuple[str, ...] = tuple(excluded)
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def lang(self) -> str:
+        return self._lang
+
+    @property
+    def batch_size(self) -> int:
+        return self._batches
+
+    @property
+    def excluded(self) -> tuple[str, ...]:
+        return self._excluded
+
+    @property
+    def config(self) -> dict:
+        return SpacyTokeniser.describe(self._lang, self._excluded)
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        """ Start the worker processes on first use and keep them for the following calls """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self._workers,
+                initializer=_init_tokeniser_worker,
+                initargs=(self._lang, self._batches, self._excluded),
+            )
+            print(f"The SpaCy tokeniser pool has started {self._workers} worker processes.")
+        return self._executor
+
+    def pipe(self, contents: Iterable[str]) -> Iterator[list[str]]:
+        """ Stream texts through the worker processes in shards
+        :param contents: texts to tokenise
+        :return: iterator of token lists in the same order as the texts
+        """
+        executor: ProcessPoolExecutor = self._get_executor()
+        iterator: Iterator[str] = iter(contents)
+        # Keep a bounded number of shards in flight and collect them in submission order
+        pending: deque[Future] = deque()
+        while True:
+            while len(pending) < self._workers * 2:
+                shard: list[str] = list(islice(iterator, self._chunks))
+                if not shard:
+                    break
+                pending.append(executor.submit(_tokenise_shard, shard))
+            if not pending:
+                break
+            yield from pending.popleft().result()
+
+    def close(self) -> None:
+        """ Shut down the worker processes """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return (f"SpacyTokeniserPool(lang={self._lang!r}, workers={self._workers}, "
+                f"chunk_size={self._chunks}, batch_size={self._batches})")
+
+
 def spacy_tokeniser(content: str, lang: str) -> list[str]:
     """ SpaCy NLP Processor for an English or a Chinese text
     :param content: a text content to process
     :param lang: language code for the text (e.g., 'en' for English, 'zh' for Chinese)
     :return: list of tokens
     """
-    words: list[str] = []
-    match lang:
-        case "en":
-            nlp = load(CONFIG.FILEPATHS.SPACY_EN_MODEL)
-            doc = nlp(content)
-            words = [token.lemma_.lower() for token in doc]
-        case "zh":
-            nlp = load(CONFIG.FILEPATHS.SPACY_ZH_MODEL)
-            doc = nlp(content)
-            words = [token.text for token in doc]
-        case _:
-            raise ValueError(f"Unsupported language: {lang}")
+    words: list[str] = SpacyTokeniser(lang)(content)
 
     print(f"The {len(words)} words has been segmented using SpaCy Tokeniser.")
 
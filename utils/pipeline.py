@@ -0,0 +1,188 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/29 09:30
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   pipeline.py
+# @Desc     :   
+
+from collections import Counter
+from itertools import batched, repeat
+from json import load, dump
+from numpy import ndarray, int32
+from os import replace
+from pathlib import Path
+from typing import Container, Iterable, Iterator
+
+from utils.cache import TokenCache
+from utils.decorator import timer
+from utils.nlp import SpacyTokeniser, SpacyTokeniserPool, filter_english
+from utils.store import RaggedArray, RaggedWriter
+from utils.subword import SubwordTokeniser
+from utils.vocab import Vocabulary
+
+
+def stream_tokens(
+        texts: Iterable[str], tokeniser: SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser,
+        cache: TokenCache | None = None, paths: Iterable[str] | None = None, chunk_size: int = 16384
+) -> Iterator[list[str]]:
+    """ Tokenise and filter texts lazily, in order
+    :param texts: texts to tokenise
+    :param tokeniser: the tokeniser to use, subword pieces are kept whole while spaCy tokens are filtered
+    :param cache: the token cache to read from and write to, the cache is skipped if None
+    :param paths: file paths of the texts, used as the cache keys
+    :param chunk_size: number of texts looked up in the cache at a time
+    :return: iterator of filtered token lists
+    """
+    if cache is None or paths is None:
+        is_filtered: bool = not isinstance(tokeniser, SubwordTokeniser)
+        for words in tokeniser.pipe(texts):
+            yield filter_english(words) if is_filtered else words
+        return
+
+    for _, words in stream_digested_tokens(texts, tokeniser, cache, paths, chunk_size):
+        yield words
+
+
+def stream_digested_tokens(
+        texts: Iterable[str], tokeniser: SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser,
+        cache: TokenCache | None = None, paths: Iterable[str] | None = None, chunk_size: int = 16384
+) -> Iterator[tuple[str, list[str]]]:
+    """ Tokenise and filter texts lazily, in order, with the content digest of each text, which is read and hashed once
+    :param texts: texts to tokenise
+    :param tokeniser: the tokeniser to use, subword pieces are kept whole while spaCy tokens are filtered
+    :param cache: the token cache to read from and write to, the cache is skipped if None
+    :param paths: file paths of the texts, used as the cache keys
+    :param chunk_size: number of texts looked up in the cache at a time
+    :return: iterator of the content digests and the filtered token lists
+    """
+    is_filtered: bool = not isinstance(tokeniser, SubwordTokeniser)
+    is_cached: bool = cache is not None and paths is not None
+    # Only tokenise the texts which are new or have changed since they were cached
+    for chunk in batched(zip(paths if is_cached else repeat(None), texts), chunk_size):
+        digests: list[str] = [TokenCache.digest(text) for _, text in chunk]
+        tokens: list[list[str] | None] = (
+            [cache.get(path, digest) for (path, _), digest in zip(chunk, digests)] if is_cached else [None] * len(chunk)
+        )
+        missing: list[int] = [i for i, words in enumerate(tokens) if words is None]
+        for i, words in zip(missing, tokeniser.pipe(chunk[i][1] for i in missing)):
+            words = filter_english(words) if is_filtered else words
+            if is_cached:
+                cache.put(chunk[i][0], digests[i], words)
+            tokens[i] = words
+        yield from zip(digests, tokens)
+
+
+class TokenSpool:
+    """ Spool token lists to disk as lexicon ids, counting word frequencies on the way """
+
+    def __init__(self, prefix: str | Path) -> None:
+        """ Initialise the TokenSpool class
+        :param prefix: the path prefix of the spool files
+        """
+        self._prefix: Path = Path(prefix)
+        self._writer: RaggedWriter = RaggedWriter(self._prefix, int32)
+        self._lexicon: list[str] = []
+        self._word2id: dict[str, int] = {}
+        self._counter: Counter = Counter()
+
+    @property
+    def counter(self) -> Counter:
+        return self._counter
+
+    @property
+    def lexicon(self) -> list[str]:
+        return self._lexicon
+
+    def append(self, words: list[str], is_counted: bool = True) -> None:
+        """ Spool the tokens of a text
+        :param words: the tokens of the text
+        :param is_counted: whether the tokens count towards the word frequencies
+        """
+        ids: list[int] = []
+        for word in words:
+            if word not in self._word2id:
+                self._word2id[word] = len(self._lexicon)
+                self._lexicon.append(word)
+            ids.append(self._word2id[word])
+        self._writer.append(ids)
+        if is_counted:
+            self._counter.update(words)
+
+    def extend(self, tokens: Iterable[list[str]], is_counted: Iterable[bool] | bool = True) -> None:
+        """ Spool the tokens of several texts
+        :param tokens: the token lists of the texts
+        :param is_counted: whether the tokens count towards the word frequencies, for all texts or per text
+        """
+        if isinstance(is_counted, bool):
+            for words in tokens:
+                self.append(words, is_counted)
+        else:
+            for words, counted in zip(tokens, is_counted):
+                self.append(words, bool(counted))
+
+    def extend_unseen(
+            self, documents: Iterable[tuple[str, list[str]]], seen: Container[str],
+            is_selected: Iterable[bool] | bool = True
+    ) -> list[str]:
+        """ Spool the tokens of several texts, counting only the selected texts whose digest has not been seen before
+        :param documents: the content digests and the token lists of the texts
+        :param seen: the digests of the texts counted by earlier runs
+        :param is_selected: whether the tokens may count towards the word frequencies, for all texts or per text
+        :return: the digests of the counted texts
+        """
+        if isinstance(is_selected, bool):
+            is_selected = repeat(is_selected)
+        counted: list[str] = []
+        for (digest, words), selected in zip(documents, is_selected):
+            is_counted: bool = bool(selected) and digest not in seen
+            self.append(words, is_counted)
+            if is_counted:
+                counted.append(digest)
+        return counted
+
+    def close(self) -> None:
+        """ Close the spool and save its lexicon """
+        self._writer.close()
+        with open(f"{self._prefix}.lexicon.json.tmp", "w", encoding="utf-8") as file:
+            dump(self._lexicon, file)
+        replace(f"{self._prefix}.lexicon.json.tmp", f"{self._prefix}.lexicon.json")
+
+        print(f"Spooled {self._writer.rows} texts with {len(self._lexicon)} distinct words to {self._prefix}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"TokenSpool(prefix={str(self._prefix)!r}, texts={self._writer.rows}, lexicon={len(self._lexicon)})"
+
+
+@timer
+def encode_spool(prefix: str | Path, vocabulary: Vocabulary, output: str | Path, chunk_size: int = 4096) -> RaggedArray:
+    """ Encode a token spool to word ids without reading it into memory
+    :param prefix: the path prefix of the spool files
+    :param vocabulary: the vocabulary mapping words to ids
+    :param output: the path prefix of the encoded id store
+    :param chunk_size: number of texts encoded at a time
+    :return: the encoded id store, memory-mapped
+    """
+    with open(f"{prefix}.lexicon.json", "r", encoding="utf-8") as file:
+        lexicon: list[str] = load(file)
+    # Map every spooled lexicon id to its word id at once
+    table: ndarray = vocabulary.lookup_table(lexicon)
+
+    spool: RaggedArray = RaggedArray.load(prefix)
+    with RaggedWriter(output, int32) as writer:
+        for start in range(0, len(spool), chunk_size):
+            stop: int = min(start + chunk_size, len(spool))
+            offsets: ndarray = spool.offsets[start:stop + 1]
+            writer.extend_flat(table[spool.values[offsets[0]:offsets[-1]]], offsets - offsets[0])
+
+    store: RaggedArray = RaggedArray.load(output)
+
+    print(f"Encoded {len(store)} texts with {len(store.values)} tokens to {output}")
+
+    return store
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/31 09:20
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   predictor.py
+# @Desc     :   
+
+from itertools import batched
+from json import loads, dumps
+from numpy import ndarray, empty, zeros, flatnonzero, float32 as np_float32, int64 as np_int64
+from pathlib import Path
+from torch import nn, device, inference_mode, softmax
+from typing import TYPE_CHECKING, Iterable, Iterator, Sequence, TextIO
+
+from utils.cache import PredictionCache
+from utils.compiled import CompiledModel, is_compiled, load_compiled
+from utils.PT import SeqClassificationTorchDataset, BucketBatchSampler, get_device
+from utils.store import RaggedArray
+from utils.subword import SubwordTokeniser
+from utils.vocab import Vocabulary
+
+if TYPE_CHECKING:
+    from utils.nlp import SpacyTokeniser, SpacyTokeniserPool
+
+SENTIMENTS: tuple[str, ...] = ("neg", "pos")
+
+
+class RNNClassificationTorchPredictor:
+    """ Batched sentiment inference with a trained model, the model and the vocabulary are loaded once """
+
+    def __init__(
+            self, model_path: str | Path, vocabulary_path: str | Path,
+            tokeniser: "SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser | None" = None, accelerator: str = "cpu",
+            batch_size: int = 256, boundaries: Sequence[int] = (), max_len: int | None = None,
+            cache: PredictionCache | None = None, chunk_len: int | None = None
+    ) -> None:
+        """ Initialise the RNNClassificationTorchPredictor class
+        :param model_path: path to the saved model parameters, to a quantised artifact or to a compiled artifact
+        :param vocabulary_path: path to the binary vocabulary saved by Vocabulary.save
+        :param tokeniser: the tokeniser used in training, spaCy or subword, an English spaCy tokeniser if None and the
+            vocabulary was built from spaCy tokens
+        :param accelerator: the target device string ("auto", "cuda", "mps", "cpu")
+        :param batch_size: the number of reviews per forward pass
+        :param boundaries: the length buckets reviews are grouped by, so batches are padded as little as possible
+        :param max_len: the length reviews are truncated to, no truncation if None
+        :param cache: the cache of predictions keyed by the encoded reviews, nothing is cached if None
+        :param chunk_len: reviews longer than this are run alone in chunks of this many tokens, never if None
+        """
+        self._device: device = device(get_device(accelerator))
+        # Bulk scoring looks up millions of tokens, a dictionary beats probing the mapped hash index per token
+        self._vocabulary: Vocabulary = Vocabulary.load(vocabulary_path, is_mapped=False)
+        if is_compiled(model_path):
+            self._model: nn.Module | CompiledModel = load_compiled(model_path, self._device)
+        else:
+            # Imported here, a compiled artifact runs without the Python model class
+            from utils.quantise import load_model
+            self._model: nn.Module | CompiledModel = load_model(model_path).to(self._device)
+        if len(self._vocabulary) > self._model.config["vocab_size"]:
+            raise ValueError(f"The vocabulary of {len(self._vocabulary)} words outgrows the embedding of "
+                             f"{self._model.config["vocab_size"]} rows, fine-tune the model on the grown vocabulary.")
+        self._tokeniser: "SpacyTokeniser | SpacyTokeniserPool | SubwordTokeniser" = tokeniser or self._build_tokeniser()
+        backend: str = "subword" if isinstance(self._tokeniser, SubwordTokeniser) else "spacy"
+        if self._vocabulary.tokeniser.get("backend", backend) != backend:
+            raise ValueError(f"The vocabulary was built by the {self._vocabulary.tokeniser["backend"]} tokeniser, "
+                             f"it cannot encode the outputs of the {backend} tokeniser.")
+        # A retrained subword model gives its pieces other ids, the vocabulary records the digest of its own
+        digest: str | None = self._tokeniser.config["digest"] if backend == "subword" else None
+        if self._vocabulary.tokeniser.get("digest", digest) != digest:
+            raise ValueError("The subword model differs from the one the vocabulary was built from, train the model "
+                             "on the current subword model.")
+        self._batches: int = batch_size
+        self._boundaries: list[int] = list(boundaries)
+        self._max_len: int | None = max_len
+        self._cache: PredictionCache | None = cache
+        # Compiled and quantised models cannot run in chunks, long reviews then go through the batches
+        self._chunk_len: int | None = chunk_len if getattr(self._model, "is_chunkable", False) else None
+
+    def _build_tokeniser(self) -> "SpacyTokeniser":
+        """ Build the default tokeniser, spaCy and its pipeline are only imported for a vocabulary of spaCy tokens
+        :return: an English spaCy tokeniser
+        """
+        if self._vocabulary.tokeniser.get("backend") == "subword":
+            raise ValueError("The vocabulary was built by the subword tokeniser, pass the subword model it was "
+                             "trained with.")
+        from utils.nlp import SpacyTokeniser
+
+        return SpacyTokeniser("en")
+
+    @property
+    def vocabulary(self) -> Vocabulary:
+        return self._vocabulary
+
+    @property
+    def model(self) -> nn.Module | CompiledModel:
+        return self._model
+
+    @property
+    def cache(self) -> PredictionCache | None:
+        return self._cache
+
+    def encode(self, texts: Iterable[str]) -> RaggedArray:
+        """ Tokenise, filter and encode raw reviews with the training pipeline
+        :param texts: the raw reviews
+        :return: the word ids of the reviews
+        """
+        if isinstance(self._tokeniser, SubwordTokeniser):
+            # The ids of the subword model are the ids of the vocabulary, no token lists are built
+            return self._tokeniser.encode_many(texts)
+        from utils.pipeline import stream_tokens
+
+        return self._vocabulary.encode_many(stream_tokens(texts, self._tokeniser))
+
+    def _infer(self, sequences: Sequence) -> tuple[ndarray, ndarray]:
+        """ Run the model on encoded reviews
+        :param sequences: the word ids of the reviews
+        :return: the predicted labels and the class probabilities, in the input order
+        """
+        max_len: int = self._max_len or max((len(seq) for seq in sequences), default=1)
+        dataset = SeqClassificationTorchDataset(
+            sequences, zeros(len(sequences), dtype=np_int64), max_len, self._vocabulary.pad_id
+        )
+        labels: ndarray = empty(len(dataset), dtype=np_int64)
+        probabilities: ndarray = empty((len(dataset), self._model.num_classes), dtype=np_float32)
+
+        # Long reviews run alone chunk by chunk, so they neither stretch the padding nor the memory of a batch
+        is_long: ndarray = dataset.lengths > (self._chunk_len or max_len)
+        short: ndarray = flatnonzero(~is_long)
+
+        # Reviews of similar lengths are batched together, the results are scattered back to the input order
+        sampler = BucketBatchSampler(dataset.lengths[short], self._batches, self._boundaries, is_shuffle=False)
+        with inference_mode():
+            for i in flatnonzero(is_long).tolist():
+                outputs = self._model.forward_chunked(dataset[i][0].to(self._device), self._chunk_len)
+                probabilities[i] = softmax(outputs.float(), dim=1).cpu().numpy()[0]
+                labels[i] = probabilities[i].argmax()
+
+            for positions in sampler:
+                indices = short[positions]
+                features, _, lengths = dataset.collator([dataset[int(i)] for i in indices])
+                outputs = self._model(features.to(self._device, non_blocking=True), lengths)
+                probs = softmax(outputs.float(), dim=1).cpu().numpy()
+                probabilities[indices] = probs
+                labels[indices] = probs.argmax(axis=1)
+
+        return labels, probabilities
+
+    def predict_encoded(self, sequences: Sequence) -> tuple[ndarray, ndarray]:
+        """ Classify encoded reviews, cached reviews and repeats within the call are only run once
+        :param sequences: the word ids of the reviews
+        :return: the predicted labels and the class probabilities, in the input order
+        """
+        if self._cache is None:
+            return self._infer(sequences)
+
+        probabilities: ndarray = empty((len(sequences), self._model.num_classes), dtype=np_float32)
+        # The misses grouped by key, with the sequence the model sees
+        misses: dict[bytes, tuple[ndarray, list[int]]] = {}
+        for i, seq in enumerate(sequences):
+            seq = seq[:self._max_len] if self._max_len else seq
+            key: bytes = PredictionCache.key(seq)
+            if key in misses:
+                misses[key][1].append(i)
+            elif (cached := self._cache.get(key)) is not None:
+                probabilities[i] = cached
+            else:
+                misses[key] = (seq, [i])
+
+        if misses:
+            _, computed = self._infer([seq for seq, _ in misses.values()])
+            for (key, (_, indices)), probs in zip(misses.items(), computed):
+                probabilities[indices] = probs
+                self._cache.put(key, probs)
+
+        return probabilities.argmax(axis=1), probabilities
+
+    def predict(self, texts: Iterable[str]) -> tuple[ndarray, ndarray]:
+        """ Classify raw reviews
+        :param texts: the raw reviews
+        :return: the predicted labels and the class probabilities, in the input order
+        """
+        return self.predict_encoded(self.encode(texts))
+
+    def predict_records(self, records: Iterable[dict], field: str = "text", chunk_size: int = 4096) -> Iterator[dict]:
+        """ Classify a stream of records chunk by chunk
+        :param records: the records holding a review each
+        :param field: the key of the review in the records
+        :param chunk_size: number of records classified at a time
+        :return: the records without the review, with the predicted label, sentiment and probabilities added
+        """
+        for chunk in batched(records, chunk_size):
+            labels, probabilities = self.predict(record[field] for record in chunk)
+            for record, label, probs in zip(chunk, labels.tolist(), probabilities.tolist()):
+                result: dict = {key: value for key, value in record.items() if key != field}
+                result.update(label=label, sentiment=SENTIMENTS[label], probabilities=probs)
+                yield result
+
+    def predict_jsonl(self, source: TextIO, target: TextIO, field: str = "text", chunk_size: int = 4096) -> int:
+        """ Classify the reviews of a JSON Lines stream into another JSON Lines stream
+        :param source: the input stream, one JSON object with a review per line
+        :param target: the output stream, one JSON object per input line in the same order
+        :param field: the key of the review in the input objects
+        :param chunk_size: number of lines classified at a time
+        :return: the number of classified lines
+        """
+        count: int = 0
+        records: Iterator[dict] = (loads(line) for line in source if line.strip())
+        for result in self.predict_records(records, field, chunk_size):
+            target.write(dumps(result) + "\n")
+            count += 1
+        target.flush()
+
+        return count
+
+    def __repr__(self) -> str:
+        return (f"RNNClassificationTorchPredictor(vocabulary={len(self._vocabulary)}, device={self._device}, "
+                f"batch_size={self._batches}, max_len={self._max_len}, chunk_len={self._chunk_len}, "
+                f"cache={self._cache})")
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/31 14:10
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   quantise.py
+# @Desc     :   
+
+from copy import deepcopy
+from os import replace
+from pathlib import Path
+from pickle import UnpicklingError
+from torch import nn, save, load, empty, qint8, float16, Tensor
+from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+from torch.nn.functional import embedding
+
+from utils.models import RNNClassificationTorchModel
+
+FORMAT: str = "imdb-rnn-int8"
+VERSION: int = 1
+EMBEDDINGS: tuple[str, ...] = ("fp32", "fp16", "int8")
+
+
+class HalfEmbedding(nn.Module):
+    """ Embedding table stored in float16, the looked up rows are returned in float32 """
+
+    def __init__(self, num_embeddings: int, embedding_dim: int) -> None:
+        """ Initialise the HalfEmbedding class
+        :param num_embeddings: size of the vocabulary
+        :param embedding_dim: dimension of the embeddings
+        """
+        super().__init__()
+        self.register_buffer("weight", empty(num_embeddings, embedding_dim, dtype=float16))
+
+    @classmethod
+    def from_float(cls, module: nn.Embedding) -> "HalfEmbedding":
+        """ Convert a float32 embedding """
+        half = cls(module.num_embeddings, module.embedding_dim)
+        half.weight.copy_(module.weight.detach())
+        return half
+
+    def forward(self, X: Tensor) -> Tensor:
+        return embedding(X, self.weight).float()
+
+    def extra_repr(self) -> str:
+        return f"{self.weight.shape[0]}, {self.weight.shape[1]}, dtype=float16"
+
+
+def quantise_model(model: nn.Module, embedding_dtype: str = "fp32") -> nn.Module:
+    """ Quantise the LSTM and linear weights of a model to int8, activations are quantised on the fly
+    :param model: the float32 model, it is left unchanged
+    :param embedding_dtype: the storage of the embedding table, "fp32", "fp16" or "int8" (per-row scales)
+    :return: the quantised model in evaluation mode
+    """
+    if embedding_dtype not in EMBEDDINGS:
+        raise ValueError(f"Unsupported embedding dtype {embedding_dtype!r}, expected one of {list(EMBEDDINGS)}.")
+
+    model = deepcopy(model).eval()
+    spec: dict = {nn.LSTM: default_dynamic_qconfig, nn.Linear: default_dynamic_qconfig}
+    if embedding_dtype == "int8":
+        spec[nn.Embedding] = float_qparams_weight_only_qconfig
+    model = quantize_dynamic(model, spec, dtype=qint8)
+
+    if embedding_dtype == "fp16":
+        for name, module in model.named_children():
+            if isinstance(module, nn.Embedding):
+                setattr(model, name, HalfEmbedding.from_float(module))
+
+    return model
+
+
+def save_quantised(model: RNNClassificationTorchModel, filepath: str | Path, embedding_dtype: str = "fp32") -> nn.Module:
+    """ Quantise a model and save it as an artifact recognised by load_model
+    :param model: the float32 model
+    :param filepath: path to the artifact
+    :param embedding_dtype: the storage of the embedding table, "fp32", "fp16" or "int8"
+    :return: the quantised model
+    """
+    quantised: nn.Module = quantise_model(model, embedding_dtype)
+    artifact: dict = {
+        "format": FORMAT,
+        "version": VERSION,
+        "embedding": embedding_dtype,
+        "config": model.config,
+        "state": quantised.state_dict(),
+    }
+    save(artifact, f"{filepath}.tmp")
+    replace(f"{filepath}.tmp", filepath)
+
+    print(f"The int8 model with {embedding_dtype} embeddings has been saved to {filepath}")
+
+    return quantised
+
+
+def load_model(filepath: str | Path) -> nn.Module:
+    """ Load a model saved either as float32 parameters or as a quantised artifact
+    :param filepath: path to the model file
+    :return: the model in evaluation mode, on the CPU
+    """
+    try:
+        return RNNClassificationTorchModel.from_state_dict(load(filepath, map_location="cpu", weights_only=True)).eval()
+    except UnpicklingError:
+        # Quantised weights are packed objects which the safe loader rejects, only load trusted artifacts
+        artifact = load(filepath, map_location="cpu", weights_only=False)
+
+    if not isinstance(artifact, dict) or artifact.get("format") != FORMAT:
+        raise ValueError(f"{filepath} is neither a model state_dict nor a {FORMAT} artifact.")
+    if artifact["version"] != VERSION:
+        raise ValueError(f"Unsupported {FORMAT} version {artifact["version"]} in {filepath}.")
+
+    # Rebuild the same quantised structure, then fill it with the saved parameters
+    model: nn.Module = quantise_model(RNNClassificationTorchModel(**artifact["config"]), artifact["embedding"])
+    model.load_state_dict(artifact["state"])
+
+    return model.eval()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/11/01 10:30
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   server.py
+# @Desc     :   
+
+from asyncio import (Future, Queue, StreamReader, StreamWriter, IncompleteReadError, create_task, gather,
+                     get_running_loop, run, start_server, wait_for)
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from json import dumps, loads
+from numpy import ndarray
+from time import perf_counter
+from typing import Callable, Sequence
+
+from utils.cache import PredictionCache
+from utils.predictor import SENTIMENTS
+
+LATENCY_BOUNDS: tuple[float, ...] = tuple(round(0.5 * 2 ** (i / 2), 3) for i in range(33))
+
+
+class Histogram:
+    """ Fixed-bucket histogram, the percentiles are read from the bucket bounds so the memory stays constant """
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        """ Initialise the Histogram class
+        :param bounds: the ascending upper bounds of the buckets, larger values go to an overflow bucket
+        """
+        self._bounds: list[float] = list(bounds)
+        self._counts: list[int] = [0] * (len(self._bounds) + 1)
+        self._count: int = 0
+        self._sum: float = 0.0
+        self._max: float = 0.0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self._count if self._count else 0.0
+
+    def add(self, value: float) -> None:
+        """ Record a value """
+        self._counts[bisect_left(self._bounds, value)] += 1
+        self._count += 1
+        self._sum += value
+        self._max = max(self._max, value)
+
+    def percentile(self, q: float) -> float:
+        """ Estimate a percentile as the upper bound of the bucket it falls in
+        :param q: the percentile, between 0 and 100
+        :return: the estimate, never above the largest recorded value
+        """
+        if not self._count:
+            return 0.0
+        target: float = q / 100 * self._count
+        cumulative: int = 0
+        for bound, count in zip(self._bounds, self._counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self._max)
+        return self._max
+
+    def to_dict(self) -> dict:
+        """ Return the summary and the non-empty buckets """
+        labels: list[str] = [f"<={bound:g}" for bound in self._bounds] + [f">{self._bounds[-1]:g}"]
+        return {
+            "count": self._count,
+            "mean": round(self.mean, 3),
+            "p50": round(self.percentile(50), 3),
+            "p99": round(self.percentile(99), 3),
+            "max": round(self._max, 3),
+            "buckets": {label: count for label, count in zip(labels, self._counts) if count},
+        }
+
+    def __repr__(self) -> str:
+        return f"Histogram(count={self._count}, p50={self.percentile(50):g}, p99={self.percentile(99):g})"
+
+
+class MicroBatcher:
+    """ Coalesce queued reviews into micro-batches which run one at a time on a single inference thread """
+
+    def __init__(
+            self, predict: Callable[[list[str]], tuple[ndarray, ndarray]],
+            max_batch_size: int = 64, max_wait_ms: float = 5.0
+    ) -> None:
+        """ Initialise the MicroBatcher class
+        :param predict: classifies a list of reviews, returning the labels and the class probabilities
+        :param max_batch_size: the most reviews in a micro-batch
+        :param max_wait_ms: how long the first review of a micro-batch waits for others to join it
+        """
+        self._predict = predict
+        self._max_batch: int = max_batch_size
+        self._max_wait: float = max_wait_ms / 1000
+        self._queue: Queue[tuple[str, Future, float]] = Queue()
+        # A single thread runs the model, the event loop keeps accepting requests meanwhile
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+        self._latency: Histogram = Histogram(LATENCY_BOUNDS)
+        self._batch_sizes: Histogram = Histogram(range(1, max_batch_size + 1))
+
+    @property
+    def latency(self) -> Histogram:
+        return self._latency
+
+    @property
+    def batch_sizes(self) -> Histogram:
+        return self._batch_sizes
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    async def submit(self, text: str) -> dict:
+        """ Queue a review and wait for its result
+        :param text: the raw review
+        :return: the predicted label, sentiment and class probabilities
+        """
+        future: Future = get_running_loop().create_future()
+        await self._queue.put((text, future, perf_counter()))
+        return await future
+
+    async def _collect(self) -> list[tuple[str, Future, float]]:
+        """ Wait for a review, then gather more until the batch is full or the wait is over """
+        items: list[tuple[str, Future, float]] = [await self._queue.get()]
+        deadline: float = perf_counter() + self._max_wait
+        while len(items) < self._max_batch:
+            if not self._queue.empty():
+                items.append(self._queue.get_nowait())
+                continue
+            timeout: float = deadline - perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                items.append(await wait_for(self._queue.get(), timeout))
+            except TimeoutError:
+                break
+        return items
+
+    async def _resolve(self, items: list[tuple[str, Future, float]]) -> None:
+        """ Classify a micro-batch and resolve its futures, a failed micro-batch is retried review by review
+        so that only the reviews which fail on their own get the error
+        :param items: the queued reviews of the micro-batch
+        """
+        try:
+            labels, probabilities = await get_running_loop().run_in_executor(
+                self._executor, self._predict, [text for text, _, _ in items]
+            )
+        except Exception as error:
+            if len(items) > 1:
+                for item in items:
+                    await self._resolve([item])
+            elif not items[0][1].done():
+                items[0][1].set_exception(error)
+            return
+
+        self._batch_sizes.add(len(items))
+        finished: float = perf_counter()
+        for (_, future, queued), label, probs in zip(items, labels.tolist(), probabilities.tolist()):
+            self._latency.add((finished - queued) * 1000)
+            if not future.done():
+                future.set_result({"label": label, "sentiment": SENTIMENTS[label], "probabilities": probs})
+
+    async def run(self) -> None:
+        """ Serve micro-batches until cancelled """
+        while True:
+            items: list[tuple[str, Future, float]] = await self._collect()
+            # Requests whose clients have gone away are dropped
+            items = [item for item in items if not item[1].done()]
+            if items:
+                await self._resolve(items)
+
+    def close(self) -> None:
+        """ Stop the inference thread """
+        self._executor.shutdown(cancel_futures=True)
+
+    def __repr__(self) -> str:
+        return (f"MicroBatcher(max_batch_size={self._max_batch}, max_wait_ms={self._max_wait * 1000:g}, "
+                f"pending={self.pending})")
+
+
+class SentimentServer:
+    """ Minimal HTTP/1.1 sentiment scoring service on asyncio streams
+
+    POST /predict   {"text": "..."} or {"texts": ["...", ...]}
+    GET  /metrics   p50/p99 latency and the latency and batch size histograms
+    GET  /health    liveness probe
+    """
+
+    def __init__(
+            self, predict: Callable[[list[str]], tuple[ndarray, ndarray]], host: str = "127.0.0.1", port: int = 8000,
+            max_batch_size: int = 64, max_wait_ms: float = 5.0, max_body_bytes: int = 1 << 20,
+            cache: PredictionCache | None = None
+    ) -> None:
+        """ Initialise the SentimentServer class
+        :param predict: classifies a list of reviews, e.g. RNNClassificationTorchPredictor.predict
+        :param host: the interface to listen on
+        :param port: the port to listen on, 0 picks a free port
+        :param max_batch_size: the most reviews in a micro-batch
+        :param max_wait_ms: how long the first review of a micro-batch waits for others to join it
+        :param max_body_bytes: the largest accepted request body
+        :param cache: the prediction cache behind predict, its counters are reported with the metrics
+        """
+        self._host: str = host
+        self._port: int = port
+        self._max_body: int = max_body_bytes
+        self._batcher: MicroBatcher = MicroBatcher(predict, max_batch_size, max_wait_ms)
+        self._cache: PredictionCache | None = cache
+        self._requests: int = 0
+        self._started: float = perf_counter()
+
+    @property
+    def batcher(self) -> MicroBatcher:
+        return self._batcher
+
+    @property
+    def port(self) -> int:
+        return self._port
+
+    def metrics(self) -> dict:
+        """ Return the request counters, the histograms and the cache counters """
+        metrics: dict = {
+            "uptime_s": round(perf_counter() - self._started, 3),
+            "requests": self._requests,
+            "pending": self._batcher.pending,
+            "latency_ms": self._batcher.latency.to_dict(),
+            "batch_size": self._batcher.batch_sizes.to_dict(),
+        }
+        if self._cache is not None:
+            metrics["cache"] = self._cache.stats
+        return metrics
+
+    async def _route(self, method: str, path: str, body: bytes) -> tuple[HTTPStatus, dict]:
+        """ Dispatch a request
+        :return: the status and the JSON payload of the response
+        """
+        match method, path:
+            case "GET", "/health":
+                return HTTPStatus.OK, {"status": "ok"}
+            case "GET", "/metrics":
+                return HTTPStatus.OK, self.metrics()
+            case "POST", "/predict":
+                try:
+                    payload = loads(body)
+                except ValueError:
+                    return HTTPStatus.BAD_REQUEST, {"error": "The body is not valid JSON."}
+                if isinstance(payload, dict) and isinstance(payload.get("text"), str):
+                    return HTTPStatus.OK, await self._batcher.submit(payload["text"])
+                if (isinstance(payload, dict) and isinstance(payload.get("texts"), list)
+                        and all(isinstance(text, str) for text in payload["texts"])):
+                    # Each review joins the micro-batches on its own
+                    results = await gather(*(self._batcher.submit(text) for text in payload["texts"]))
+                    return HTTPStatus.OK, {"results": list(results)}
+                return HTTPStatus.BAD_REQUEST, {"error": "Expected {\"text\": str} or {\"texts\": [str, ...]}."}
+            case _, "/health" | "/metrics" | "/predict":
+                return HTTPStatus.METHOD_NOT_ALLOWED, {"error": f"{method} is not allowed on {path}."}
+            case _:
+                return HTTPStatus.NOT_FOUND, {"error": f"{path} not found."}
+
+    @staticmethod
+    async def _respond(writer: StreamWriter, status: HTTPStatus, payload: dict, is_kept: bool) -> None:
+        """ Write a JSON response """
+        body: bytes = dumps(payload).encode("utf-8")
+        head: str = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {"keep-alive" if is_kept else "close"}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _handle(self, reader: StreamReader, writer: StreamWriter) -> None:
+        """ Serve the requests of a connection, kept alive unless the client asks otherwise """
+        try:
+            while line := await reader.readline():
+                try:
+                    method, path, version = line.decode("latin-1").split()
+                except ValueError:
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Malformed request line."}, False)
+                    break
+
+                headers: dict[str, str] = {}
+                while (header := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = header.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                is_kept: bool = (headers.get("connection", "").lower() != "close"
+                                 and (version == "HTTP/1.1" or headers.get("connection", "").lower() == "keep-alive"))
+
+                try:
+                    size: int = int(headers.get("content-length", 0) or 0)
+                except ValueError:
+                    size = -1
+                if size < 0:
+                    # Without a valid length the body cannot be skipped, so the connection is closed
+                    await self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": "Invalid Content-Length."}, False)
+                    break
+                if size > self._max_body:
+                    await self._respond(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Body too large."}, False)
+                    break
+                body: bytes = await reader.readexactly(size) if size else b""
+
+                self._requests += 1
+                try:
+                    status, payload = await self._route(method, path.split("?")[0], body)
+                except Exception as error:
+                    print(f"{method} {path} failed: {error!r}")
+                    status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": f"{type(error).__name__}: {error}"}
+                await self._respond(writer, status, payload, is_kept)
+                if not is_kept:
+                    break
+        except (ConnectionError, IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self) -> None:
+        """ Listen and serve until cancelled """
+        server = await start_server(self._handle, self._host, self._port)
+        self._port = server.sockets[0].getsockname()[1]
+        worker = create_task(self._batcher.run())
+        print(f"Serving on http://{self._host}:{self._port} with {self._batcher}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            worker.cancel()
+            self._batcher.close()
+
+    def run(self) -> None:
+        """ Serve until interrupted """
+        try:
+            run(self.serve())
+        except KeyboardInterrupt:
+            print("The server has been stopped.")
+
+    def __repr__(self) -> str:
+        return f"SentimentServer(host={self._host!r}, port={self._port}, batcher={self._batcher})"
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/28 10:12
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   store.py
+# @Desc     :   
+
+from json import load, dump, dumps, loads
+from mmap import mmap, ACCESS_READ
+from numpy import (ndarray, dtype as np_dtype, memmap, fromfile, frombuffer, empty, zeros, asarray, concatenate,
+                   cumsum, int32, int64)
+from os import replace
+from pathlib import Path
+from struct import pack, unpack, calcsize
+from typing import Iterable, Iterator, Union
+
+PREAMBLE: str = "<8sIQQ"
+ALIGNMENT: int = 64
+
+
+class RaggedArray:
+    """ Variable-length rows stored as one flat values array plus an offsets array """
+
+    def __init__(self, values: ndarray, offsets: ndarray, index: ndarray | None = None) -> None:
+        """ Initialise the RaggedArray class
+        :param values: the flat array holding all rows one after another
+        :param offsets: the start position of each row followed by the total size, shape (rows + 1,)
+        :param index: the stored rows selected by this array, all rows if None
+        """
+        self._values: ndarray = values
+        self._offsets: ndarray = offsets
+        self._index: ndarray | None = index
+
+    @classmethod
+    def from_sequences(cls, sequences: Iterable[Iterable[int]], dtype=int32) -> "RaggedArray":
+        """ Build a ragged array from nested sequences
+        :param sequences: the rows to store
+        :param dtype: the dtype of the values
+        :return: the ragged array
+        """
+        rows: list[ndarray] = [asarray(seq, dtype=dtype) for seq in sequences]
+        offsets: ndarray = zeros(len(rows) + 1, dtype=int64)
+        cumsum([len(row) for row in rows], out=offsets[1:])
+        values: ndarray = concatenate(rows) if rows else empty(0, dtype=dtype)
+        return cls(values.astype(dtype, copy=False), offsets)
+
+    @classmethod
+    def load(cls, prefix: str | Path, mmap: bool = True) -> "RaggedArray":
+        """ Load a ragged array written by RaggedWriter
+        :param prefix: the path prefix of the stored files
+        :param mmap: whether to memory-map the files instead of reading them into memory
+        :return: the ragged array
+        """
+        prefix = Path(prefix)
+        with open(f"{prefix}.json", "r", encoding="utf-8") as file:
+            meta: dict = load(file)
+
+        values: ndarray = _read_array(Path(f"{prefix}.values.bin"), np_dtype(meta["dtype"]), meta["size"], mmap)
+        offsets: ndarray = _read_array(Path(f"{prefix}.offsets.bin"), np_dtype(int64), meta["rows"] + 1, mmap)
+
+        return cls(values, offsets)
+
+    @staticmethod
+    def exists(prefix: str | Path) -> bool:
+        """ Check whether a ragged array has been stored under the prefix """
+        return Path(f"{prefix}.json").exists()
+
+    def save(self, prefix: str | Path) -> None:
+        """ Save the ragged array under the prefix
+        :param prefix: the path prefix of the stored files
+        """
+        with RaggedWriter(prefix, self._values.dtype) as writer:
+            writer.extend(self)
+
+    @property
+    def values(self) -> ndarray:
+        return self._values
+
+    @property
+    def offsets(self) -> ndarray:
+        return self._offsets
+
+    @property
+    def lengths(self) -> ndarray:
+        """ Return the length of each row """
+        lengths: ndarray = self._offsets[1:] - self._offsets[:-1]
+        return lengths if self._index is None else lengths[self._index]
+
+    def subset(self, indices: Iterable[int]) -> "RaggedArray":
+        """ Select rows without copying the values
+        :param indices: the row indices to select
+        :return: the ragged array viewing the selected rows
+        """
+        indices = asarray(indices, dtype=int64)
+        return RaggedArray(self._values, self._offsets, indices if self._index is None else self._index[indices])
+
+    def take(self, indices: Iterable[int]) -> "RaggedArray":
+        """ Gather the selected rows into a new in-memory ragged array
+        :param indices: the row indices to gather
+        :return: the gathered ragged array
+        """
+        return RaggedArray.from_sequences((self[int(i)] for i in indices), self._values.dtype)
+
+    def __len__(self) -> int:
+        """ Return the number of rows """
+        return len(self._offsets) - 1 if self._index is None else len(self._index)
+
+    def __getitem__(self, index: int) -> ndarray:
+        """ Return a single row as a view on the values """
+        if not isinstance(index, int):
+            raise TypeError(f"Invalid index type: {type(index)}")
+        if index < 0:
+            index += len(self)
+        if self._index is not None:
+            index = int(self._index[index])
+        return self._values[self._offsets[index]:self._offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[ndarray]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f"RaggedArray(rows={len(self)}, size={len(self._values)}, dtype={self._values.dtype})"
+
+
+class RaggedWriter:
+    """ Append rows to a ragged array on disk without keeping them in memory """
+
+    def __init__(self, prefix: str | Path, dtype=int32, is_appended: bool = False) -> None:
+        """ Initialise the RaggedWriter class
+        :param prefix: the path prefix of the stored files
+        :param dtype: the dtype of the values
+        :param is_appended: whether to append to the rows already stored under the prefix instead of replacing them
+        """
+        self._prefix: Path = Path(prefix)
+        self._dtype = np_dtype(dtype)
+        self._rows: int = 0
+        self._size: int = 0
+        self._prefix.parent.mkdir(parents=True, exist_ok=True)
+        self._is_appended: bool = is_appended and RaggedArray.exists(self._prefix)
+        if self._is_appended:
+            with open(f"{self._prefix}.json", "r", encoding="utf-8") as file:
+                meta: dict = load(file)
+            if np_dtype(meta["dtype"]) != self._dtype:
+                raise ValueError(f"Cannot append {self._dtype} rows to the {meta["dtype"]} rows of {self._prefix}.")
+            self._rows, self._size = meta["rows"], meta["size"]
+            # The rows are written in place after the stored ones, the metadata still bounds the readers until close
+            self._values = open(f"{self._prefix}.values.bin", "r+b")
+            self._values.seek(self._size * self._dtype.itemsize)
+            self._offsets = open(f"{self._prefix}.offsets.bin", "r+b")
+            self._offsets.seek((self._rows + 1) * np_dtype(int64).itemsize)
+        else:
+            self._values = open(f"{self._prefix}.values.bin.tmp", "wb")
+            self._offsets = open(f"{self._prefix}.offsets.bin.tmp", "wb")
+            self._offsets.write(zeros(1, dtype=int64).tobytes())
+
+    def append(self, row: Union[ndarray, Iterable[int]]) -> None:
+        """ Append a single row
+        :param row: the row values
+        """
+        row = asarray(row, dtype=self._dtype)
+        self._values.write(row.tobytes())
+        self._size += len(row)
+        self._rows += 1
+        self._offsets.write(asarray([self._size], dtype=int64).tobytes())
+
+    def extend(self, rows: Iterable[Union[ndarray, Iterable[int]]]) -> None:
+        """ Append several rows
+        :param rows: the rows to append
+        """
+        for row in rows:
+            self.append(row)
+
+    def extend_flat(self, values: ndarray, offsets: ndarray) -> None:
+        """ Append a block of rows given as flat values and offsets
+        :param values: the values of the rows one after another
+        :param offsets: the start position of each row in the values followed by their size
+        """
+        self._values.write(asarray(values, dtype=self._dtype).tobytes())
+        self._offsets.write((asarray(offsets[1:], dtype=int64) + self._size).tobytes())
+        self._size += len(values)
+        self._rows += len(offsets) - 1
+
+    def close(self) -> None:
+        """ Flush the files and move them into place, the metadata file is written last """
+        if self._values.closed:
+            return
+        self._values.close()
+        self._offsets.close()
+        if not self._is_appended:
+            replace(f"{self._prefix}.values.bin.tmp", f"{self._prefix}.values.bin")
+            replace(f"{self._prefix}.offsets.bin.tmp", f"{self._prefix}.offsets.bin")
+        with open(f"{self._prefix}.json.tmp", "w", encoding="utf-8") as file:
+            dump({"dtype": self._dtype.name, "rows": self._rows, "size": self._size}, file)
+        replace(f"{self._prefix}.json.tmp", f"{self._prefix}.json")
+
+    @property
+    def rows(self) -> int:
+        return self._rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __repr__(self) -> str:
+        return f"RaggedWriter(prefix={str(self._prefix)!r}, rows={self._rows}, size={self._size})"
+
+
+class MappedArrays:
+    """ Zero-copy reader of named arrays saved by save_arrays """
+
+    def __init__(self, filepath: str | Path, magic: bytes, version: int = 1) -> None:
+        """ Initialise the MappedArrays class
+        :param filepath: path to the file
+        :param magic: the 8 bytes identifying the file format
+        :param version: the supported version of the file format
+        """
+        self._filepath: Path = Path(filepath)
+        with open(self._filepath, "rb") as file:
+            self._buffer: mmap = mmap(file.fileno(), 0, access=ACCESS_READ)
+
+        found, found_version, header_offset, header_size = unpack(PREAMBLE, self._buffer[:calcsize(PREAMBLE)])
+        if found != magic:
+            raise ValueError(f"{self._filepath} is not a {magic.decode()} file.")
+        if found_version != version:
+            raise ValueError(f"Unsupported {magic.decode()} version {found_version} in {self._filepath}.")
+        self._header: dict = loads(self._buffer[header_offset:header_offset + header_size].decode("utf-8"))
+
+    @property
+    def meta(self) -> dict:
+        return self._header["meta"]
+
+    @property
+    def names(self) -> list[str]:
+        return list(self._header["arrays"])
+
+    def __getitem__(self, name: str) -> ndarray:
+        """ Get a read-only view on an array of the file """
+        meta: dict = self._header["arrays"][name]
+        return frombuffer(self._buffer, dtype=np_dtype(meta["dtype"]), count=meta["count"], offset=meta["offset"])
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._header["arrays"]
+
+    def __repr__(self) -> str:
+        return f"MappedArrays(filepath={str(self._filepath)!r}, arrays={len(self._header["arrays"])})"
+
+
+def save_arrays(
+        filepath: str | Path, magic: bytes, arrays: Iterable[tuple[str, ndarray]],
+        meta: dict | None = None, version: int = 1
+) -> None:
+    """ Save named arrays into a single file readable by MappedArrays
+    :param filepath: path to the file
+    :param magic: the 8 bytes identifying the file format
+    :param arrays: the names and the arrays, written one at a time
+    :param meta: the metadata stored in the header
+    :param version: the version of the file format
+    """
+    filepath = Path(filepath)
+    header: dict = {"meta": meta or {}, "arrays": {}}
+
+    with open(f"{filepath}.tmp", "wb") as file:
+        # Reserve the preamble, it is written last once the header position is known
+        file.write(bytes(calcsize(PREAMBLE)))
+        for name, array in arrays:
+            array = asarray(array)
+            # Align every array so that it can be viewed in place
+            file.write(bytes(-file.tell() % ALIGNMENT))
+            header["arrays"][name] = {"dtype": array.dtype.name, "offset": file.tell(), "count": len(array)}
+            file.write(array.tobytes())
+
+        encoded: bytes = dumps(header).encode("utf-8")
+        header_offset: int = file.tell()
+        file.write(encoded)
+        file.seek(0)
+        file.write(pack(PREAMBLE, magic, version, header_offset, len(encoded)))
+
+    replace(f"{filepath}.tmp", filepath)
+
+
+def _read_array(path: Path, dtype, count: int, mmap: bool) -> ndarray:
+    """ Read a raw binary array from disk
+    :param path: path to the binary file
+    :param dtype: the dtype of the values
+    :param count: the number of values
+    :param mmap: whether to memory-map the file
+    :return: the array
+    """
+    if count == 0:
+        return empty(0, dtype=dtype)
+    if mmap:
+        return memmap(path, dtype=dtype, mode="r", shape=(count,))
+    return fromfile(path, dtype=dtype, count=count)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/11/02 09:50
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   subword.py
+# @Desc     :   
+
+from hashlib import blake2b
+from itertools import batched, chain
+from json import load, dump
+from numpy import ndarray, fromiter, zeros, cumsum, concatenate, empty, int32, int64
+from os import replace
+from pathlib import Path
+from tokenizers import Tokenizer, Regex, decoders, models, normalizers, pre_tokenizers, trainers
+from typing import Iterable, Iterator
+
+from utils.store import RaggedArray, RaggedWriter
+from utils.vocab import Vocabulary
+
+SUBWORD_MODELS: tuple[str, ...] = ("bpe", "unigram")
+
+
+class SubwordTokeniser:
+    """ BPE or unigram subword tokeniser trained on the corpus, encoding raw texts straight to ids """
+
+    def __init__(
+            self, filepath: str | Path, batch_size: int = 1024, pad_token: str = "<PAD>", unk_token: str = "<UNK>"
+    ) -> None:
+        """ Initialise the SubwordTokeniser class
+        :param filepath: path to the subword model saved by train
+        :param batch_size: the number of texts encoded per call into the native tokeniser
+        :param pad_token: the padding token, the first special token of the model
+        :param unk_token: the token standing for characters never seen in training
+        """
+        self._filepath: Path = Path(filepath)
+        if not self._filepath.exists():
+            raise FileNotFoundError(f"No subword model at {self._filepath}, preprocess the corpus to train one.")
+        self._tokenizer: Tokenizer = Tokenizer.from_file(str(self._filepath))
+        self._batches: int = batch_size
+        self._pad: str = pad_token
+        self._unk: str = unk_token
+
+    @staticmethod
+    def settings_path(filepath: str | Path) -> Path:
+        """ Locate the training settings saved next to a subword model
+        :param filepath: path to the subword model
+        :return: path to its training settings
+        """
+        return Path(filepath).with_suffix(".settings.json")
+
+    @classmethod
+    def is_trained(cls, filepath: str | Path, model: str, vocab_size: int, min_frequency: int) -> bool:
+        """ Check the subword model exists and was trained with the given settings, so a changed config retrains it
+        :param filepath: path to the subword model
+        :param model: the subword model, "bpe" or "unigram"
+        :param vocab_size: the number of pieces, including the special tokens
+        :param min_frequency: the fewest occurrences of a pair before BPE merges it
+        :return: whether the saved model can be reused
+        """
+        settings_path: Path = cls.settings_path(filepath)
+        if not Path(filepath).exists():
+            return False
+        if not settings_path.exists():
+            print(f"No training settings found at {settings_path}, the subword model will be trained again.")
+            return False
+
+        with open(settings_path, "r", encoding="utf-8") as file:
+            settings: dict = load(file)
+        requested: dict = {"model": model, "vocab_size": vocab_size, "min_frequency": min_frequency}
+        if stale := {key: settings.get(key) for key, value in requested.items() if settings.get(key) != value}:
+            print(f"The subword model at {filepath} was trained with {stale}, it is trained again with {requested}.")
+            return False
+        return True
+
+    @staticmethod
+    def _build(model: str, unk_token: str) -> Tokenizer:
+        """ Build an untrained tokeniser: lower-cased NFKC text with HTML line breaks and runs of spaces collapsed,
+        split on spaces and punctuation
+        :param model: the subword model, "bpe" or "unigram"
+        :param unk_token: the token standing for characters never seen in training
+        :return: the tokeniser
+        """
+        if model not in SUBWORD_MODELS:
+            raise ValueError(f"Unsupported subword model {model!r}, expected one of {list(SUBWORD_MODELS)}.")
+
+        tokenizer = Tokenizer(models.BPE(unk_token=unk_token) if model == "bpe" else models.Unigram())
+        tokenizer.normalizer = normalizers.Sequence([
+            normalizers.NFKC(),
+            normalizers.Replace(Regex(r"(<br\s*/?>|\s)+"), " "),
+            normalizers.Strip(),
+            normalizers.Lowercase(),
+        ])
+        tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.Metaspace(), pre_tokenizers.Punctuation()])
+        tokenizer.decoder = decoders.Metaspace()
+        return tokenizer
+
+    @classmethod
+    def train(
+            cls, texts: Iterable[str], filepath: str | Path, model: str = "bpe", vocab_size: int = 16000,
+            min_frequency: int = 2, special: Iterable[str] = ("<PAD>", "<UNK>"), batch_size: int = 1024
+    ) -> "SubwordTokeniser":
+        """ Train a subword model on raw texts and save it
+        :param texts: the training texts
+        :param filepath: path to the subword model
+        :param model: the subword model, "bpe" or "unigram"
+        :param vocab_size: the number of pieces, including the special tokens
+        :param min_frequency: the fewest occurrences of a pair before BPE merges it
+        :param special: the padding and the unknown tokens, given the first ids
+        :param batch_size: the number of texts encoded per call into the native tokeniser
+        :return: the trained tokeniser
+        """
+        special = list(special)
+        tokenizer: Tokenizer = cls._build(model, special[1])
+        if model == "bpe":
+            trainer = trainers.BpeTrainer(
+                vocab_size=vocab_size, min_frequency=min_frequency, special_tokens=special, show_progress=False
+            )
+        else:
+            trainer = trainers.UnigramTrainer(
+                vocab_size=vocab_size, special_tokens=special, unk_token=special[1], show_progress=False
+            )
+        tokenizer.train_from_iterator(texts, trainer)
+
+        filepath = Path(filepath)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tokenizer.save(f"{filepath}.tmp")
+        replace(f"{filepath}.tmp", filepath)
+        # The tokenizers file format has no room for the trainer settings, they are kept next to the model
+        settings_path: Path = cls.settings_path(filepath)
+        with open(f"{settings_path}.tmp", "w", encoding="utf-8") as file:
+            dump({"model": model, "vocab_size": vocab_size, "min_frequency": min_frequency, "special": special}, file)
+        replace(f"{settings_path}.tmp", settings_path)
+
+        print(f"The {model} subword model of {tokenizer.get_vocab_size()} pieces has been saved to {filepath}")
+
+        return cls(filepath, batch_size, *special[:2])
+
+    @property
+    def batch_size(self) -> int:
+        return self._batches
+
+    @property
+    def config(self) -> dict:
+        """ Describe the subword model, used to tell apart the outputs of different tokenisers """
+        with open(self._filepath, "rb") as file:
+            digest: str = blake2b(file.read(), digest_size=16).hexdigest()
+        return {
+            "backend": "subword",
+            "model": type(self._tokenizer.model).__name__.lower(),
+            "vocab_size": self._tokenizer.get_vocab_size(),
+            "digest": digest,
+        }
+
+    @property
+    def vocabulary(self) -> Vocabulary:
+        """ Return the pieces as a vocabulary, the ids are those of the subword model """
+        pieces: list[str] = [self._tokenizer.id_to_token(idx) for idx in range(self._tokenizer.get_vocab_size())]
+        return Vocabulary(pieces, self._pad, self._unk, self.config)
+
+    def _encode_chunks(self, texts: Iterable[str]) -> Iterator[tuple[ndarray, ndarray]]:
+        """ Encode texts a batch at a time
+        :param texts: the raw texts
+        :return: iterator of the ids of each batch as flat values plus offsets
+        """
+        for chunk in batched(texts, self._batches):
+            ids: list[list[int]] = [encoding.ids for encoding in self._tokenizer.encode_batch_fast(list(chunk))]
+            offsets: ndarray = zeros(len(ids) + 1, dtype=int64)
+            cumsum([len(row) for row in ids], out=offsets[1:])
+            yield fromiter(chain.from_iterable(ids), dtype=int32, count=int(offsets[-1])), offsets
+
+    def encode_many(self, texts: Iterable[str]) -> RaggedArray:
+        """ Encode raw texts to ids without building token lists
+        :param texts: the raw texts
+        :return: the ids as a flat int32 array plus offsets
+        """
+        values: list[ndarray] = []
+        offsets: list[ndarray] = [zeros(1, dtype=int64)]
+        for chunk_values, chunk_offsets in self._encode_chunks(texts):
+            offsets.append(chunk_offsets[1:] + offsets[-1][-1])
+            values.append(chunk_values)
+
+        return RaggedArray(concatenate(values) if values else empty(0, dtype=int32), concatenate(offsets))
+
+    def encode_to(self, texts: Iterable[str], output: str | Path) -> RaggedArray:
+        """ Encode raw texts to an id store on disk without keeping them in memory
+        :param texts: the raw texts
+        :param output: the path prefix of the id store
+        :return: the id store, memory-mapped
+        """
+        with RaggedWriter(output, int32) as writer:
+            for values, offsets in self._encode_chunks(texts):
+                writer.extend_flat(values, offsets)
+
+        store: RaggedArray = RaggedArray.load(output)
+
+        print(f"Encoded {len(store)} texts with {len(store.values)} subword pieces to {output}")
+
+        return store
+
+    def pipe(self, contents: Iterable[str]) -> Iterator[list[str]]:
+        """ Stream texts through the tokeniser in batches
+        :param contents: texts to tokenise
+        :return: iterator of piece lists in the same order as the texts
+        """
+        for chunk in batched(contents, self._batches):
+            for encoding in self._tokenizer.encode_batch_fast(list(chunk)):
+                yield encoding.tokens
+
+    def __call__(self, content: str) -> list[str]:
+        """ Tokenise a single text """
+        return self._tokenizer.encode(content).tokens
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __repr__(self) -> str:
+        return (f"SubwordTokeniser(filepath={str(self._filepath)!r}, "
+                f"vocab_size={self._tokenizer.get_vocab_size()}, batch_size={self._batches})")
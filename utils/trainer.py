@@ -6,23 +6,108 @@
 # @File     :   trainer.py
 # @Desc     :   
 
+from contextlib import nullcontext
+from pathlib import Path
 from PySide6.QtCore import QObject, Signal
-from torch import nn, no_grad, save, device, Tensor
+from time import perf_counter
+from torch import (nn, no_grad, device, autocast, zeros, tensor, stack, cuda, distributed as dist, Tensor,
+                   float32, float64, bfloat16, float16)
+from torch.amp import GradScaler
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
+from typing import Any, Callable
 
-from utils.PT import get_device, TorchDataLoader
+from utils.checkpoint import CheckpointWriter
+from utils.distributed import get_world
+from utils.PT import get_device, TorchDataLoader, TorchRandomSeed
 
 
 class RNNClassificationTorchTrainer(QObject):
     """ Trainer class for managing training process """
     losses: Signal = Signal(int, float, float, float)
+    PRECISIONS: dict = {"fp32": float32, "bf16": bfloat16, "fp16": float16}
 
-    def __init__(self, model: nn.Module, optimiser, criterion, accelerator: str = "auto") -> None:
+    def __init__(
+            self, model: nn.Module, optimiser, criterion, accelerator: str = "auto", precision: str = "fp32",
+            sync_steps: int = 0, accumulation_steps: int = 1, is_lr_scaled: bool = False
+    ) -> None:
+        """ Initialise the RNNClassificationTorchTrainer class
+        :param model: the model to train
+        :param optimiser: the optimiser updating the model parameters
+        :param criterion: the loss function
+        :param accelerator: the target device string ("auto", "cuda", "mps", "cpu")
+        :param precision: "fp32", "bf16" for bfloat16 autocast, or "fp16" for float16 autocast with gradient scaling
+        :param sync_steps: read the running loss back and report it every N training steps, only once per epoch if 0
+        :param accumulation_steps: number of micro-batches whose gradients are accumulated per optimiser step
+        :param is_lr_scaled: whether to scale the learning rate linearly with the accumulation steps
+        """
         super().__init__()
-        self._model = model
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unsupported precision {precision!r}, expected one of {list(self.PRECISIONS)}.")
+        if accumulation_steps < 1:
+            raise ValueError(f"The accumulation steps must be at least 1, got {accumulation_steps}.")
+        self._module = model
         self._optimiser = optimiser
         self._criterion = criterion
         self._accelerator = get_device(accelerator)
+        # Resolve the device once, the metrics are accumulated on it to avoid a host sync per step
+        self._device: device = device(self._accelerator)
+        self._device_type: str = self._device.type
+        # Inside a process group the gradients are averaged across processes, only rank 0 logs and saves
+        self._rank, self._world_size = get_world()
+        if self._world_size > 1:
+            self._model = DistributedDataParallel(model, device_ids=[self._device] if self._device_type == "cuda" else None)
+        else:
+            self._model = model
+        self._precision: str = precision
+        self._sync_steps: int = sync_steps
+        # Float16 gradients underflow without loss scaling, the scaler is a no-op otherwise
+        self._scaler: GradScaler = GradScaler(self._device_type, enabled=precision == "fp16")
+        self._accumulation: int = accumulation_steps
+        if is_lr_scaled:
+            # Linear scaling rule, the effective batch is accumulation_steps times larger
+            for group in self._optimiser.param_groups:
+                group["lr"] *= self._accumulation
+
+        if self.is_main:
+            print(f"Training precision: {self._precision}")
+            print(f"Gradient accumulation: {self._accumulation} micro-batches per step, learning rate scaled: {is_lr_scaled}")
+            print(f"Training processes: {self._world_size}")
+
+    @property
+    def is_main(self) -> bool:
+        return self._rank == 0
+
+    def _reduce(self, *values: Tensor | float) -> list[float]:
+        """ Sum metrics over all processes and read them back in a single transfer
+        :param values: the metrics of this process
+        :return: the metrics summed over the processes
+        """
+        # Tensors are converted rather than copy-constructed, which torch warns about
+        metrics: Tensor = stack([
+            value.to(self._device, float64) if isinstance(value, Tensor)
+            else tensor(value, dtype=float64, device=self._device)
+            for value in values
+        ])
+        if self._world_size > 1:
+            dist.all_reduce(metrics)
+        return metrics.tolist()
+
+    def _no_sync(self, is_stepped: bool):
+        """ Skip the gradient all-reduce on the micro-batches which do not step the optimiser """
+        if self._world_size > 1 and not is_stepped:
+            return self._model.no_sync()
+        return nullcontext()
+
+    def _autocast(self) -> autocast:
+        """ Return the autocast context of the precision mode, disabled for fp32 """
+        return autocast(self._device_type, dtype=self.PRECISIONS[self._precision], enabled=self._precision != "fp32")
+
+    @staticmethod
+    def _unpack(batch: tuple[Tensor, ...]) -> tuple[Tensor, Tensor, Tensor | None]:
+        """ Split a batch into features, labels and the sequence lengths if the loader provides them """
+        features, labels, *rest = batch
+        return features, labels, rest[0] if rest else None
 
     def _epoch_train(self, dataloader: DataLoader | TorchDataLoader) -> float:
         """ Train the model for one epoch
@@ -32,22 +117,40 @@ class RNNClassificationTorchTrainer(QObject):
         # Set model to training mode
         self._model.train()
 
-        _loss: float = 0.0
-        _total: float = 0.0
-        for features, labels in dataloader:
-            features, labels = features.to(device(self._accelerator)), labels.to(device(self._accelerator))
+        _loss: Tensor = zeros((), dtype=float32, device=self._device)
+        _total: int = 0
+        _steps: int = len(dataloader)
+        # The trailing micro-batches of the epoch form a smaller group
+        _tail_start: int = _steps - _steps % self._accumulation
+        self._optimiser.zero_grad(set_to_none=True)
+        for step, batch in enumerate(dataloader, 1):
+            features, labels, lengths = self._unpack(batch)
+            features = features.to(self._device, non_blocking=True)
+            labels = labels.to(self._device, non_blocking=True)
 
-            self._optimiser.zero_grad()
-            outputs = self._model(features)
-            # print(outputs.shape, labels.shape)
+            is_stepped: bool = step % self._accumulation == 0 or step == _steps
+            with self._no_sync(is_stepped):
+                with self._autocast():
+                    outputs = self._model(features, lengths)
+                    # print(outputs.shape, labels.shape)
 
-            loss = self._criterion(outputs, labels)
-            loss.backward()
-            self._optimiser.step()
+                    loss = self._criterion(outputs, labels)
+                # Average the gradients over the micro-batches of the group
+                group: int = self._accumulation if step <= _tail_start else _steps - _tail_start
+                self._scaler.scale(loss / group).backward()
 
-            _loss += loss.item() * features.size(0)
+            if is_stepped:
+                self._scaler.step(self._optimiser)
+                self._scaler.update()
+                self._optimiser.zero_grad(set_to_none=True)
+
+            _loss += loss.detach().float() * labels.numel()
             _total += labels.numel()
 
+            if self._sync_steps and step % self._sync_steps == 0 and self.is_main:
+                print(f"Step [{step}/{len(dataloader)}] - Train Loss: {_loss.item() / _total:.4f}")
+
+        _loss, _total = self._reduce(_loss, _total)
         return _loss / _total
 
     def _epoch_valid(self, dataloader: DataLoader | TorchDataLoader) -> tuple[float, float]:
@@ -58,72 +161,172 @@ class RNNClassificationTorchTrainer(QObject):
         # Set model to evaluation mode
         self._model.eval()
 
-        _loss: float = 0.0
-        _correct: float = 0.0
-        _total: float = 0.0
+        _loss: Tensor = zeros((), dtype=float32, device=self._device)
+        _correct: Tensor = zeros((), dtype=float32, device=self._device)
+        _total: int = 0
         with no_grad():
-            for features, labels in dataloader:
-                features, labels = features.to(device(self._accelerator)), labels.to(device(self._accelerator))
+            for batch in dataloader:
+                features, labels, lengths = self._unpack(batch)
+                features = features.to(self._device, non_blocking=True)
+                labels = labels.to(self._device, non_blocking=True)
 
-                outputs = self._model(features)
-                # print(outputs.shape, labels.shape)
+                with self._autocast():
+                    outputs = self._model(features, lengths)
+                    # print(outputs.shape, labels.shape)
 
-                loss = self._criterion(outputs, labels)
+                    loss = self._criterion(outputs, labels)
 
-                _loss += loss.item() * features.size(0)
+                _loss += loss.float() * labels.numel()
                 _correct += self._get_accuracy(outputs, labels)
                 _total += labels.numel()
 
+        # A single read back per epoch
+        _loss, _correct, _total = self._reduce(_loss, _correct, _total)
         return _loss / _total, _correct / _total
 
     @staticmethod
-    def _get_accuracy(outputs: Tensor, labels: Tensor) -> float:
-        """ Get accuracy of the model """
+    def _get_accuracy(outputs: Tensor, labels: Tensor) -> Tensor:
+        """ Get the number of correct predictions of the model, left on the device """
         predictions = outputs.argmax(dim=1)
-        return predictions.eq(labels).sum().item()
+        return predictions.eq(labels).sum()
+
+    def _synchronise(self) -> None:
+        """ Wait for the queued device work, so that timings are not cut short """
+        if self._device_type == "cuda":
+            cuda.synchronize(self._device)
+
+    def benchmark(self, dataloader: DataLoader | TorchDataLoader, epochs: int = 1, warmup: int = 1) -> float:
+        """ Measure the training throughput
+        :param dataloader: DataLoader for training data
+        :param epochs: number of timed epochs
+        :param warmup: number of untimed epochs run first
+        :return: the training steps per second
+        """
+        for _ in range(warmup):
+            self._epoch_train(dataloader)
+        self._synchronise()
+
+        start: float = perf_counter()
+        for _ in range(epochs):
+            self._epoch_train(dataloader)
+        self._synchronise()
+        elapsed: float = perf_counter() - start
+
+        steps: float = epochs * len(dataloader) / elapsed
+        if self.is_main:
+            print(f"Benchmark - {epochs * len(dataloader)} steps in {elapsed:.2f}s - {steps:.1f} steps/s "
+                  f"per process, {self._world_size} processes")
+
+        return steps
+
+    def _state(self, epoch: int, best_valid_loss: float, patience_counter: int) -> dict:
+        """ Collect everything needed to resume training after an epoch
+        :param epoch: number of completed epochs
+        :param best_valid_loss: the best validation loss so far
+        :param patience_counter: number of epochs without improvement
+        :return: the training state
+        """
+        return {
+            "epoch": epoch,
+            "model": self._module.state_dict(),
+            "optimiser": self._optimiser.state_dict(),
+            "scaler": self._scaler.state_dict(),
+            "best_valid_loss": best_valid_loss,
+            "patience_counter": patience_counter,
+            "rng": TorchRandomSeed.get_states(),
+        }
+
+    def _resume(self, checkpoint_path: str) -> tuple[int, float, int]:
+        """ Restore the training state from a checkpoint
+        :param checkpoint_path: path to the checkpoint
+        :return: number of completed epochs, the best validation loss and the patience counter
+        """
+        state: dict = CheckpointWriter.load(checkpoint_path, str(self._device))
+        self._module.load_state_dict(state["model"])
+        self._optimiser.load_state_dict(state["optimiser"])
+        self._scaler.load_state_dict(state["scaler"])
+        TorchRandomSeed.set_states(state["rng"])
+
+        if self.is_main:
+            print(f"Resumed training from {checkpoint_path} after {state["epoch"]} epochs.")
+
+        return state["epoch"], state["best_valid_loss"], state["patience_counter"]
 
     def fit(self,
             train_loader: DataLoader | TorchDataLoader, valid_loader: DataLoader | TorchDataLoader,
-            epochs: int, model_save_path: str | None = None
+            epochs: int, model_save_path: str | None = None,
+            checkpoint_path: str | None = None, is_resumed: bool = False,
+            on_saved: Callable[[], Any] | None = None
             ) -> None:
         """ Fit the model to the training data
         :param train_loader: DataLoader for training data
         :param valid_loader: DataLoader for validation data
         :param epochs: number of training epochs
         :param model_save_path: path to save the best model parameters
+        :param checkpoint_path: path to save the full training state after every epoch, nothing is saved if None
+        :param is_resumed: whether to resume from the checkpoint if it exists
+        :param on_saved: called in the writer thread after each write of the best model, e.g. to save its vocabulary
         :return: None
         """
         _best_valid_loss = float("inf")
         _patience = 4
         _patience_counter = 0
         _min_delta = 5e-4
+        _start = 0
+
+        if is_resumed and checkpoint_path is not None and Path(checkpoint_path).exists():
+            _start, _best_valid_loss, _patience_counter = self._resume(checkpoint_path)
 
-        for epoch in range(epochs):
-            train_loss = self._epoch_train(train_loader)
-            valid_loss, accuracy = self._epoch_valid(valid_loader)
-
-            # Emit training and validation progress signal
-            self.losses.emit(epoch + 1, train_loss, valid_loss, accuracy)
-
-            print(f"Epoch [{epoch + 1}/{epochs}] - "
-                  f"Train Loss: {train_loss:.4f} - "
-                  f"Valid Loss: {valid_loss:.4f} - "
-                  f"Accuracy: {accuracy:.2%}")
-
-            # Save the model if it has the best validation loss so far
-            if valid_loss < _best_valid_loss - _min_delta:
-                _patience_counter = 0
-                _best_valid_loss = valid_loss
-                save(self._model.state_dict(), model_save_path)
-                print(f"Model's parameters saved to {model_save_path}")
-            else:
-                _patience_counter += 1
-                print(f"Validation loss [{_patience_counter}/{_patience}]did not improve.")
+        with CheckpointWriter() as writer:
+            for epoch in range(_start, epochs):
                 if _patience_counter >= _patience:
-                    print(f"Early stopping triggered at the {epoch} epoch and the loss is {_best_valid_loss:4f}.")
                     break
+                if isinstance(train_loader, TorchDataLoader):
+                    train_loader.set_epoch(epoch)
+
+                train_loss = self._epoch_train(train_loader)
+                valid_loss, accuracy = self._epoch_valid(valid_loader)
+
+                # Every process holds the same reduced metrics, so they all stop at the same epoch
+                if valid_loss < _best_valid_loss - _min_delta:
+                    _patience_counter = 0
+                    _best_valid_loss = valid_loss
+                    is_improved = True
+                else:
+                    _patience_counter += 1
+                    is_improved = False
+
+                if not self.is_main:
+                    continue
+
+                # Emit training and validation progress signal
+                self.losses.emit(epoch + 1, train_loss, valid_loss, accuracy)
+
+                print(f"Epoch [{epoch + 1}/{epochs}] - "
+                      f"Train Loss: {train_loss:.4f} - "
+                      f"Valid Loss: {valid_loss:.4f} - "
+                      f"Accuracy: {accuracy:.2%}")
+                if isinstance(train_loader, TorchDataLoader) and isinstance(valid_loader, TorchDataLoader):
+                    print(f"Data wait - Train: {train_loader.wait_time:.2f}s - Valid: {valid_loader.wait_time:.2f}s")
+
+                # Save the model if it has the best validation loss so far
+                if is_improved:
+                    writer.save(self._module.state_dict(), model_save_path)
+                    print(f"Model's parameters saved to {model_save_path}")
+                    if on_saved is not None:
+                        # Queued behind the write, the files paired with the model never land before it
+                        writer.submit(on_saved)
+                else:
+                    print(f"Validation loss [{_patience_counter}/{_patience}]did not improve.")
+
+                # Checkpoint before stopping, so a resumed run knows it has already stopped early
+                if checkpoint_path is not None:
+                    writer.save(self._state(epoch + 1, _best_valid_loss, _patience_counter), checkpoint_path)
+
+                if _patience_counter >= _patience:
+                    print(f"Early stopping triggered at the {epoch} epoch and the loss is {_best_valid_loss:4f}.")
 
-        if _patience_counter < _patience:
+        if _patience_counter < _patience and self.is_main:
             print(f"Training completed after {epochs} epochs.")
 
 
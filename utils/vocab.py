@@ -0,0 +1,355 @@
+#!/usr/bin/env python3.12
+# -*- Coding: UTF-8 -*-
+# @Time     :   2025/10/29 15:20
+# @Author   :   Shawn
+# @Version  :   Version 0.1.0
+# @File     :   vocab.py
+# @Desc     :   
+
+from collections import Counter
+from itertools import repeat
+from numpy import ndarray, array, asarray, fromiter, full, zeros, cumsum, int32, int64
+from pathlib import Path
+from typing import Iterable, Iterator, Sequence
+from zlib import crc32
+
+from utils.archive import PackedTexts, encode_blob
+from utils.store import RaggedArray, MappedArrays, save_arrays
+
+MAGIC: bytes = b"IMDBVOCB"
+VERSION: int = 1
+FREQUENCY_MAGIC: bytes = b"IMDBFREQ"
+FREQUENCY_VERSION: int = 2
+
+
+class Vocabulary:
+    """ Word2id vocabulary with bulk encoding of tokenised texts """
+
+    def __init__(
+            self, words: Iterable[str], pad_token: str = "<PAD>", unk_token: str = "<UNK>",
+            tokeniser: dict | None = None
+    ) -> None:
+        """ Initialise the Vocabulary class
+        :param words: the words in id order, including the special tokens
+        :param pad_token: the padding token
+        :param unk_token: the token standing for words missing in the vocabulary
+        :param tokeniser: the config of the tokeniser producing the words, stored with the vocabulary
+        """
+        self._words: Sequence[str] = list(words)
+        self._word2id: dict[str, int] = {word: idx for idx, word in enumerate(self._words)}
+        self._lookup = self._word2id.get
+        self._pad: str = pad_token
+        self._unk: str = unk_token
+        self._tokeniser: dict = tokeniser or {}
+
+    @classmethod
+    def build(
+            cls, freq_words: list[str], special: Iterable[str] = ("<PAD>", "<UNK>"), tokeniser: dict | None = None
+    ) -> "Vocabulary":
+        """ Build a vocabulary from the words sorted by frequency
+        :param freq_words: the words sorted by frequency
+        :param special: the special tokens placed in front of the words
+        :param tokeniser: the config of the tokeniser producing the words
+        :return: the vocabulary
+        """
+        special = list(special)
+        return cls(special + freq_words, *special[:2], tokeniser)
+
+    @classmethod
+    def from_dict(cls, dictionary: dict[str, int], pad_token: str = "<PAD>", unk_token: str = "<UNK>") -> "Vocabulary":
+        """ Build a vocabulary from a word2id mapping dictionary
+        :param dictionary: word2id mapping dictionary
+        :param pad_token: the padding token
+        :param unk_token: the token standing for words missing in the vocabulary
+        :return: the vocabulary
+        """
+        return cls(sorted(dictionary, key=dictionary.__getitem__), pad_token, unk_token)
+
+    def extend(self, words: Iterable[str]) -> "Vocabulary":
+        """ Grow the vocabulary without touching the existing ids, so a trained embedding stays valid
+        :param words: the words to add in id order, e.g. sorted by frequency, the known ones are skipped
+        :return: a vocabulary with the new words appended
+        """
+        new: dict[str, None] = {}
+        for word in words:
+            if word not in self:
+                new[word] = None
+        print(f"The vocabulary has grown by {len(new)} words to {len(self) + len(new)}.")
+
+        return Vocabulary([*self._words, *new], self._pad, self._unk, self._tokeniser)
+
+    @staticmethod
+    def load(filepath: str | Path, is_mapped: bool = True) -> "MappedVocabulary":
+        """ Load a vocabulary saved in the binary format, without building a dictionary unless asked to
+        :param filepath: path to the vocabulary file
+        :param is_mapped: whether words are looked up in the mapped hash index, else in a dictionary built once,
+            which costs tens of milliseconds but makes bulk encoding an order of magnitude faster
+        :return: the memory-mapped vocabulary
+        """
+        return MappedVocabulary(filepath, is_mapped)
+
+    def save(self, filepath: str | Path) -> None:
+        """ Save the vocabulary in the binary format: a sorted string table plus a hash index
+        :param filepath: path to the vocabulary file
+        """
+        encoded: list[bytes] = [word.encode("utf-8") for word in self._words]
+        # Sort the string table by bytes, remembering where each id went
+        order: list[int] = sorted(range(len(encoded)), key=encoded.__getitem__)
+        positions: ndarray = zeros(len(encoded), dtype=int32)
+        positions[order] = range(len(order))
+        blob, offsets = encode_blob(self._words[i] for i in order)
+
+        # Open addressing hash index over the sorted positions, at most half full
+        slots: ndarray = full(max(2, 1 << (2 * len(encoded)).bit_length()), -1, dtype=int32)
+        mask: int = len(slots) - 1
+        for position, idx in enumerate(order):
+            slot: int = crc32(encoded[idx]) & mask
+            while slots[slot] != -1:
+                slot = (slot + 1) & mask
+            slots[slot] = position
+
+        save_arrays(
+            filepath, MAGIC,
+            [
+                ("blob", blob),
+                ("offsets", offsets),
+                ("ids", asarray(order, dtype=int32)),
+                ("positions", positions),
+                ("slots", slots),
+            ],
+            {"pad_token": self._pad, "unk_token": self._unk, "size": len(encoded), "tokeniser": self._tokeniser},
+            VERSION
+        )
+
+        print(f"The vocabulary of {len(encoded)} words has been saved to {filepath}")
+
+    def to_dict(self) -> dict[str, int]:
+        """ Return the word2id mapping dictionary """
+        return dict(self._word2id)
+
+    @property
+    def pad_id(self) -> int:
+        return self._lookup(self._pad)
+
+    @property
+    def unk_id(self) -> int:
+        return self._lookup(self._unk)
+
+    @property
+    def words(self) -> Sequence[str]:
+        return self._words
+
+    @property
+    def tokeniser(self) -> dict:
+        """ Return the config of the tokeniser producing the words, empty if unknown """
+        return self._tokeniser
+
+    def word(self, idx: int) -> str:
+        """ Return the word of an id """
+        return self._words[idx]
+
+    def get(self, word: str, default: int | None = None) -> int | None:
+        """ Return the id of a word, or the default if the word is not in the vocabulary """
+        return self._lookup(word, default)
+
+    def encode(self, words: Iterable[str]) -> ndarray:
+        """ Encode a tokenised text, unknown words fall back to the unknown token
+        :param words: the tokens of a text
+        :return: the word ids
+        """
+        return fromiter(map(self._lookup, words, repeat(self.unk_id)), dtype=int32)
+
+    def encode_many(self, contents: Iterable[Iterable[str]]) -> RaggedArray:
+        """ Encode tokenised texts in one pass over all their tokens
+        :param contents: the token lists of the texts
+        :return: the word ids as a flat int32 array plus offsets
+        """
+        lengths: list[int] = []
+
+        def flatten() -> Iterator[str]:
+            for content in contents:
+                content = list(content)
+                lengths.append(len(content))
+                yield from content
+
+        values: ndarray = fromiter(map(self._lookup, flatten(), repeat(self.unk_id)), dtype=int32)
+        offsets: ndarray = zeros(len(lengths) + 1, dtype=int64)
+        cumsum(lengths, out=offsets[1:])
+
+        return RaggedArray(values, offsets)
+
+    def lookup_table(self, lexicon: list[str]) -> ndarray:
+        """ Compile the ids of a lexicon into a lookup table, so ids of the lexicon map to word ids by indexing
+        :param lexicon: the words of the lexicon in lexicon id order
+        :return: the word id of every lexicon id
+        """
+        unk_id: int = self.unk_id
+        return array([self._lookup(word, unk_id) for word in lexicon], dtype=int32)
+
+    def __len__(self) -> int:
+        return len(self._words)
+
+    def __contains__(self, word: str) -> bool:
+        return self._lookup(word) is not None
+
+    def __getitem__(self, word: str) -> int:
+        idx: int | None = self._lookup(word)
+        if idx is None:
+            raise KeyError(word)
+        return idx
+
+    def __repr__(self) -> str:
+        return f"Vocabulary(size={len(self._words)}, pad={self._pad!r}, unk={self._unk!r})"
+
+
+class MappedWords(Sequence):
+    """ Lazy id2word view on a memory-mapped vocabulary """
+
+    def __init__(self, table: PackedTexts, positions: ndarray) -> None:
+        """ Initialise the MappedWords class
+        :param table: the sorted string table
+        :param positions: the position of each id in the string table
+        """
+        self._table: PackedTexts = table
+        self._positions: ndarray = positions
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __getitem__(self, idx: int) -> str:
+        return self._table[int(self._positions[idx])]
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+class MappedVocabulary(Vocabulary):
+    """ Vocabulary read in place from the binary format, words are looked up through its hash index """
+
+    def __init__(self, filepath: str | Path, is_mapped: bool = True) -> None:
+        """ Initialise the MappedVocabulary class
+        :param filepath: path to the vocabulary file
+        :param is_mapped: whether words are looked up in the hash index, else in a dictionary built from it
+        """
+        self._filepath: Path = Path(filepath)
+        self._arrays: MappedArrays = MappedArrays(self._filepath, MAGIC, VERSION)
+        self._table: PackedTexts = PackedTexts(self._arrays["blob"], self._arrays["offsets"])
+        self._ids: ndarray = self._arrays["ids"]
+        self._slots: ndarray = self._arrays["slots"]
+        self._mask: int = len(self._slots) - 1
+
+        self._words: Sequence[str] = MappedWords(self._table, self._arrays["positions"])
+        self._lookup = self._find if is_mapped else self._word2id.get
+        self._pad: str = self._arrays.meta["pad_token"]
+        self._unk: str = self._arrays.meta["unk_token"]
+        # Vocabularies saved before the tokeniser was recorded were all built from spaCy words
+        self._tokeniser: dict = self._arrays.meta.get("tokeniser") or {"backend": "spacy"}
+
+    def _find(self, word: str, default: int | None = None) -> int | None:
+        """ Look a word up in the hash index
+        :param word: the word to look up
+        :param default: the value returned if the word is not in the vocabulary
+        :return: the id of the word
+        """
+        slot: int = crc32(word.encode("utf-8")) & self._mask
+        while (position := int(self._slots[slot])) != -1:
+            if self._table[position] == word:
+                return int(self._ids[position])
+            slot = (slot + 1) & self._mask
+        return default
+
+    @property
+    def _word2id(self) -> dict[str, int]:
+        """ Build the word2id mapping dictionary on demand, e.g. for exporting to JSON """
+        return dict(zip(self._table, self._ids.tolist()))
+
+    def __repr__(self) -> str:
+        return f"MappedVocabulary(filepath={str(self._filepath)!r}, size={len(self._words)})"
+
+
+class FrequencyStore:
+    """ Persistent word frequencies with the documents they were counted from, merged incrementally """
+
+    def __init__(self, counter: Counter | None = None, documents: Iterable[str] = ()) -> None:
+        """ Initialise the FrequencyStore class
+        :param counter: the word frequencies counted so far
+        :param documents: the content digests of the documents counted so far
+        """
+        self._counter: Counter = counter if counter is not None else Counter()
+        self._documents: set[str] = set(documents)
+
+    @classmethod
+    def load(cls, filepath: str | Path) -> "FrequencyStore":
+        """ Load the frequencies saved by save, an empty store if the file does not exist
+        :param filepath: path to the frequency store
+        :return: the frequency store
+        """
+        if not Path(filepath).exists():
+            print(f"No frequency store found at {filepath}, every document will be counted.")
+            return cls()
+
+        try:
+            arrays: MappedArrays = MappedArrays(filepath, FREQUENCY_MAGIC, FREQUENCY_VERSION)
+        except ValueError as error:
+            # A store keyed by file paths cannot tell which documents were counted, so the corpus is counted again
+            print(f"{error} Every document will be counted.")
+            return cls()
+        words: PackedTexts = PackedTexts(arrays["blob"], arrays["offsets"])
+        documents: PackedTexts = PackedTexts(arrays["document_blob"], arrays["document_offsets"])
+        store = cls(Counter(dict(zip(words, arrays["counts"].tolist()))), documents)
+
+        print(f"Frequency store loaded {len(store._counter)} words from {len(store._documents)} documents.")
+
+        return store
+
+    def save(self, filepath: str | Path) -> None:
+        """ Save the frequencies and the counted documents
+        :param filepath: path to the frequency store
+        """
+        blob, offsets = encode_blob(self._counter)
+        document_blob, document_offsets = encode_blob(sorted(self._documents))
+        save_arrays(
+            filepath, FREQUENCY_MAGIC,
+            [
+                ("blob", blob),
+                ("offsets", offsets),
+                ("counts", fromiter(self._counter.values(), dtype=int64, count=len(self._counter))),
+                ("document_blob", document_blob),
+                ("document_offsets", document_offsets),
+            ],
+            {"words": len(self._counter), "documents": len(self._documents)},
+            FREQUENCY_VERSION
+        )
+
+        print(f"The frequencies of {len(self._counter)} words have been saved to {filepath}")
+
+    @property
+    def counter(self) -> Counter:
+        return self._counter
+
+    @property
+    def documents(self) -> set[str]:
+        return self._documents
+
+    def update(self, counter: Counter, documents: Iterable[str]) -> None:
+        """ Merge the frequencies of newly counted documents
+        :param counter: the word frequencies of the new documents
+        :param documents: the content digests of the new documents
+        """
+        documents = set(documents)
+        if overlap := documents & self._documents:
+            raise ValueError(f"{len(overlap)} documents have already been counted, e.g. {next(iter(overlap))!r}.")
+        self._counter.update(counter)
+        self._documents |= documents
+
+        print(f"Merged the frequencies of {len(documents)} new documents, {len(self._documents)} in total.")
+
+    def __len__(self) -> int:
+        return len(self._counter)
+
+    def __contains__(self, document: str) -> bool:
+        return document in self._documents
+
+    def __repr__(self) -> str:
+        return f"FrequencyStore(words={len(self._counter)}, documents={len(self._documents)})"